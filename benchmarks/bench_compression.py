@@ -0,0 +1,102 @@
+"""Compare compression codecs, byte-shuffle and compression threads on BraTS-shaped
+MRI slices (float32) and labels (uint8): compression ratio, write and read throughput.
+
+    python -m benchmarks.bench_compression --slices 256 --workers 0 4 --output compression.json
+"""
+import os, json, time, argparse, tempfile
+import numpy as np
+from pipeline.chunked import ChunkedWriter, ChunkedArray, available_codecs
+from .synthetic import make_case
+
+def make_data(n_slices : int, shape : tuple = (128, 128), seed : int = 0) -> dict:
+    """Slices of a synthetic case, as written by the npy format
+
+    Parameters
+    ----------
+    n_slices : int
+        Number of slices
+    shape : tuple
+        Shape (width, height) of the slices. Default to (128, 128)
+    seed : int
+        Seed of the generator. Default to 0
+
+    Return
+    ----------
+    data : dict
+        MRI slices of shape (n_slices, 4, width, height) and labels of shape (n_slices, width, height)
+    """
+    volumes = make_case((n_slices, ) + tuple(shape), np.random.default_rng(seed))
+    return {'x': np.stack(volumes[:4], axis=1).astype(np.float32), 'y': volumes[4]}
+
+def bench_chunked(data : np.array, path : str, codec : str, shuffle : bool, workers : int,
+                  chunk_len : int, level : int = None) -> dict:
+    start = time.perf_counter()
+    with ChunkedWriter(path, data.shape[1:], data.dtype, codec=codec, level=level, shuffle=shuffle,
+                       chunk_len=chunk_len, workers=workers) as writer:
+        for case in np.array_split(data, max(1, len(data) // 64)):
+            writer.append(case)
+    write = time.perf_counter() - start
+    start = time.perf_counter()
+    read = ChunkedArray(path, workers=workers).read()
+    read_seconds = time.perf_counter() - start
+    assert np.array_equal(read, data)
+    size = os.path.getsize(path)
+    return {'ratio': data.nbytes / max(size, 1), 'write_mb_per_s': data.nbytes / 2 ** 20 / write,
+            'read_mb_per_s': data.nbytes / 2 ** 20 / read_seconds}
+
+def bench_h5(data : np.array, path : str, shuffle : bool, workers : int, chunk_len : int) -> dict:
+    import h5py
+    from pipeline.h5 import HDF5Store
+    start = time.perf_counter()
+    with HDF5Store(path, ['data'], [data.shape[1:]], [data.dtype], chunk_len=chunk_len,
+                   shuffle=shuffle, workers=workers) as store:
+        for case in np.array_split(data, max(1, len(data) // 64)):
+            store.append_batch('data', case)
+    write = time.perf_counter() - start
+    start = time.perf_counter()
+    with h5py.File(path, 'r') as f:
+        read = f['data'][:]
+    read_seconds = time.perf_counter() - start
+    assert np.array_equal(read, data)
+    return {'ratio': data.nbytes / os.path.getsize(path), 'write_mb_per_s': data.nbytes / 2 ** 20 / write,
+            'read_mb_per_s': data.nbytes / 2 ** 20 / read_seconds}
+
+def run(args) -> dict:
+    data = make_data(args.slices)
+    codecs = args.codecs or [codec for codec in available_codecs() if codec != 'none']
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, array in data.items():
+            for workers in args.workers:
+                for shuffle in [False, True]:
+                    for codec in codecs:
+                        key = '{} {} shuffle={} workers={}'.format(name, codec, int(shuffle), workers)
+                        results[key] = bench_chunked(array, os.path.join(tmp_dir, 'data.chunks'), codec, shuffle,
+                                                     workers, args.chunk_len, args.level)
+                    if not args.skip_h5:
+                        key = '{} h5-gzip shuffle={} workers={}'.format(name, int(shuffle), workers)
+                        results[key] = bench_h5(array, os.path.join(tmp_dir, 'data.h5'), shuffle, workers,
+                                                args.chunk_len)
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark chunked compression of MRI slices and labels')
+    parser.add_argument('--slices', help='Number of 128x128 slices', type=int, default=256)
+    parser.add_argument('--codecs', help='Codecs to benchmark, all installed ones by default', nargs='*', default=None)
+    parser.add_argument('--level', help='Compression level, codec default if not given', type=int, default=None)
+    parser.add_argument('--workers', help='Numbers of compression threads to compare', type=int, nargs='+', default=[0, 4])
+    parser.add_argument('--chunk_len', help='Number of slices per chunk', type=int, default=16)
+    parser.add_argument('--skip_h5', help='Do not benchmark the h5 gzip writer', action='store_true')
+    parser.add_argument('--output', help='Path of the JSON results', default=None)
+    args = parser.parse_args()
+
+    results = run(args)
+    print('{:<36} {:>7} {:>10} {:>10}'.format('configuration', 'ratio', 'write MB/s', 'read MB/s'))
+    for name, stats in results.items():
+        print('{:<36} {:>7.2f} {:>10.1f} {:>10.1f}'.format(name, stats['ratio'], stats['write_mb_per_s'],
+                                                          stats['read_mb_per_s']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,217 @@
+"""Benchmark every stage of the pipeline and every output format on synthetic data.
+
+    python -m benchmarks.bench_pipeline --cases 4 --output bench.json
+    python -m benchmarks.bench_pipeline --compare base.json bench.json
+"""
+import os, sys, json, time, argparse, tempfile, tracemalloc, importlib.util
+import numpy as np
+from pipeline.processing import get_scans, convert_scans, resize, augment
+from .synthetic import make_synthetic_dataset
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident set size of the process, so it can be measured per stage.
+    Only supported on Linux: ru_maxrss is the peak of the whole process lifetime.
+
+    Return
+    ----------
+    supported : bool
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def rss_mb(field : str = 'VmRSS') -> float:
+    """Resident set size of the process, or its peak with 'VmHWM', in MB"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 2 ** 10
+
+def data_bytes(items : list) -> int:
+    return sum(array.nbytes for item in items for array in item)
+
+def dir_bytes(path : str) -> int:
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+def measure(func : callable, trace_memory : bool = False) -> tuple:
+    """Run a function and measure its wall time and memory
+
+    Parameters
+    ----------
+    func : callable
+        Function to run
+    trace_memory : bool
+        Also measure the peak of memory allocated during the call with tracemalloc,
+        which slows down pure Python code. Default to False
+
+    Return
+    ----------
+    result : object
+        Return value of func
+    stats : dict
+        Measurements. Peak RSS during the call and its increase over the RSS before
+        the call are only measured on Linux
+    """
+    per_stage = reset_peak_rss()
+    baseline = rss_mb() if per_stage else None
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    stats = {'seconds': time.perf_counter() - start}
+    if per_stage:
+        stats['peak_rss_mb'] = rss_mb('VmHWM')
+        stats['rss_increase_mb'] = stats['peak_rss_mb'] - baseline
+    if trace_memory:
+        stats['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result, stats
+
+def throughput(stats : dict, n_cases : int, n_slices : int, n_bytes : int) -> dict:
+    seconds = max(stats['seconds'], 1e-9)
+    stats.update({
+        'cases': n_cases, 'slices': n_slices, 'mb': n_bytes / 2 ** 20,
+        'cases_per_s': n_cases / seconds, 'slices_per_s': n_slices / seconds,
+        'mb_per_s': n_bytes / 2 ** 20 / seconds
+    })
+    return stats
+
+def writers() -> dict:
+    """Writers of every output format, keyed by name. Formats whose dependencies
+    are missing are left out."""
+    try:
+        from pipeline import writers as w
+    except ImportError as e:
+        print('Skipping output formats: {}'.format(e))
+        return {}
+    formats = {
+        'npy': lambda path: w.NPYCaseWriter(path, 'bench'),
+        'npy_consolidated': lambda path: w.NPYSplitWriter(path, 'bench'),
+        'h5': lambda path: w.H5SplitWriter(path, 'bench', compression='gzip', chunk_len=16)
+    }
+    # The tfrecord writers only import TensorFlow when they are created
+    if importlib.util.find_spec('tensorflow') is None:
+        print('Skipping tfrecord formats: TensorFlow is not installed')
+        return formats
+    formats.update({
+        'tfrecord': lambda path: w.TFRecordCaseWriter(path, 'bench'),
+        'tfrecord_sharded': lambda path: w.TFRecordShardWriter(path, 'bench', shard_size_mb=64)
+    })
+    return formats
+
+def run(args) -> dict:
+    results = {'config': {'cases': args.cases, 'shape': args.shape, 'augment_ratio': args.augment_ratio},
+               'stages': {}, 'formats': {}}
+    stages = results['stages']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cases = make_synthetic_dataset(tmp_dir, args.cases, shape=tuple(args.shape))
+        source_bytes = dir_bytes(os.path.join(tmp_dir, 'training'))
+
+        data, stats = measure(lambda: list(convert_scans(get_scans(cases))), args.trace_memory)
+        stages['convert_scans'] = throughput(stats, len(data), sum(len(x) for x, _ in data), source_bytes)
+
+        resized, stats = measure(lambda: list(resize(data)), args.trace_memory)
+        stages['resize'] = throughput(stats, len(resized), sum(len(x) for x, _ in resized), data_bytes(resized))
+
+        copied, stats = measure(lambda: list(resize(data, copy=True)), args.trace_memory)
+        stages['resize_copy'] = throughput(stats, len(copied), sum(len(x) for x, _ in copied), data_bytes(copied))
+        del data, copied
+
+        augmented, stats = measure(lambda: list(augment(resized, augment_ratio=args.augment_ratio, seed=0)),
+                                   args.trace_memory)
+        stages['augment'] = throughput(stats, len(augmented), sum(len(x) for x, _ in augmented), data_bytes(augmented))
+        del augmented
+
+        for name, create in writers().items():
+            if args.formats and name not in args.formats:
+                continue
+            path = os.path.join(tmp_dir, 'output', name)
+            os.makedirs(path)
+            batches = [(x.copy(), y.copy()) for x, y in resized]
+
+            def write():
+                writer = create(path)
+                for idx, (case, (x, y)) in enumerate(zip(cases, batches)):
+                    writer.write(idx, case, x, y)
+                writer.close()
+
+            _, stats = measure(write, args.trace_memory)
+            stats = throughput(stats, len(batches), sum(len(x) for x, _ in batches), data_bytes(batches))
+            stats['output_mb'] = dir_bytes(path) / 2 ** 20
+            results['formats'][name] = stats
+    return results
+
+# Measurements compared between runs, all of them being better when lower
+METRICS = ['seconds', 'peak_rss_mb', 'peak_traced_mb', 'output_mb']
+
+def compare(base : dict, new : dict, threshold : float) -> bool:
+    """Print the timings, memory peaks and output sizes of two runs side by side
+
+    Parameters
+    ----------
+    base : dict
+        Results of the reference run
+    new : dict
+        Results of the run to check
+    threshold : float
+        Relative increase above which a measurement is reported as a regression
+
+    Return
+    ----------
+    regression : bool
+        Whether any measurement regressed
+    """
+    regression = False
+    print('{:<20} {:<16} {:>10} {:>10} {:>8}'.format('stage', 'measurement', 'base', 'new', 'ratio'))
+    for group in ['stages', 'formats']:
+        for name in base[group]:
+            if name not in new[group]:
+                continue
+            for metric in METRICS:
+                if metric not in base[group][name] or metric not in new[group][name]:
+                    continue
+                before, after = base[group][name][metric], new[group][name][metric]
+                ratio = after / max(before, 1e-9)
+                flag = ratio > 1 + threshold
+                regression |= flag
+                print('{:<20} {:<16} {:>10.3f} {:>10.3f} {:>8.2f}{}'.format(
+                    name, metric, before, after, ratio, '  REGRESSION' if flag else ''))
+    return regression
+
+def print_results(results : dict):
+    def column(stats, key):
+        return '{:.1f}'.format(stats[key]) if key in stats else '-'
+
+    print('{:<20} {:>9} {:>9} {:>10} {:>9} {:>10} {:>10} {:>10}'.format(
+        'stage', 'seconds', 'cases/s', 'slices/s', 'MB/s', 'peak RSS', 'RSS +', 'output MB'))
+    for group in ['stages', 'formats']:
+        for name, stats in results[group].items():
+            print('{:<20} {:>9.3f} {:>9.2f} {:>10.1f} {:>9.1f} {:>10} {:>10} {:>10}'.format(
+                name, stats['seconds'], stats['cases_per_s'], stats['slices_per_s'], stats['mb_per_s'],
+                column(stats, 'peak_rss_mb'), column(stats, 'rss_increase_mb'), column(stats, 'output_mb')))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic BraTS-shaped volumes')
+    parser.add_argument('--cases', help='Number of synthetic cases', type=int, default=4)
+    parser.add_argument('--shape', help='Shape of the volumes', type=int, nargs=3, default=[155, 240, 240])
+    parser.add_argument('--augment_ratio', help='Ratio of slices augmented', type=float, default=0.1)
+    parser.add_argument('--formats', help='Output formats to benchmark, all by default', nargs='*', default=None)
+    parser.add_argument('--trace_memory', help='Measure allocations of every stage with tracemalloc', action='store_true')
+    parser.add_argument('--output', help='Path of the JSON results', default=None)
+    parser.add_argument('--compare', help='Compare two JSON results', nargs=2, metavar=('BASE', 'NEW'), default=None)
+    parser.add_argument('--threshold', help='Relative increase of time, memory or output size reported as a regression', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f_base, open(args.compare[1]) as f_new:
+            sys.exit(int(compare(json.load(f_base), json.load(f_new), args.threshold)))
+
+    results = run(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
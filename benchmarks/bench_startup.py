@@ -0,0 +1,77 @@
+"""Measure the startup time and memory of the pipeline package and of the CLI,
+and check that heavy backends are only imported when needed.
+
+    python -m benchmarks.bench_startup --repeat 5 --max_seconds 2
+"""
+import os, sys, json, time, argparse, statistics, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['tensorflow', 'h5py', 'cv2', 'SimpleITK', 'scipy', 'matplotlib', 'tensorlayer']
+
+TARGETS = {
+    'import pipeline': 'import pipeline',
+    'import pipeline.writers': 'import pipeline.writers',
+    'make_training_data --help': "import sys, runpy; sys.argv = ['make_training_data.py', '--help']\n"
+                                 "try:\n    runpy.run_path('make_training_data.py', run_name='__main__')\n"
+                                 "except SystemExit:\n    pass"
+}
+
+REPORT = "\nimport sys, json\nsys.stderr.write(json.dumps(sorted(m for m in {} if m in sys.modules)))"
+
+def run_target(code : str) -> dict:
+    """Run Python code in a fresh interpreter
+
+    Parameters
+    ----------
+    code : str
+        Code to run
+
+    Return
+    ----------
+    stats : dict
+        Wall time, peak RSS and heavy modules imported by the code
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', code + REPORT.format(HEAVY_MODULES)], cwd=ROOT,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = status
+    seconds = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError(stderr.decode())
+    rss = usage.ru_maxrss / 2 ** 20 if sys.platform == 'darwin' else usage.ru_maxrss / 2 ** 10
+    return {'seconds': seconds, 'peak_rss_mb': rss, 'heavy_modules': json.loads(stderr.decode().splitlines()[-1])}
+
+def run(repeat : int) -> dict:
+    results = {}
+    for name, code in TARGETS.items():
+        runs = [run_target(code) for _ in range(repeat)]
+        results[name] = {
+            'seconds': statistics.median(r['seconds'] for r in runs),
+            'peak_rss_mb': max(r['peak_rss_mb'] for r in runs),
+            'heavy_modules': runs[-1]['heavy_modules']
+        }
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the startup of the pipeline and of the CLI')
+    parser.add_argument('--repeat', help='Number of runs of every target, the median time is reported', type=int, default=5)
+    parser.add_argument('--max_seconds', help='Exit with an error when a target starts slower than this', type=float, default=None)
+    parser.add_argument('--output', help='Path of the JSON results', default=None)
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    print('{:<28} {:>9} {:>10}  {}'.format('target', 'seconds', 'peak RSS', 'heavy modules'))
+    for name, stats in results.items():
+        print('{:<28} {:>9.3f} {:>10.1f}  {}'.format(name, stats['seconds'], stats['peak_rss_mb'],
+                                                   ', '.join(stats['heavy_modules']) or '-'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    failed = [name for name, stats in results.items()
+              if stats['heavy_modules'] or (args.max_seconds is not None and stats['seconds'] > args.max_seconds)]
+    sys.exit(int(len(failed) > 0))
@@ -0,0 +1,72 @@
+import os
+import numpy as np
+
+SEQUENCES = ['VSD.Brain.XX.O.MR_Flair', 'VSD.Brain.XX.O.MR_T1', 'VSD.Brain.XX.O.MR_T1c',
+             'VSD.Brain.XX.O.MR_T2', 'VSD.Brain_3more.XX.O.OT']
+
+def make_case(shape : tuple, rng) -> list:
+    """Generate the 4 sequences and the ground truth of a BraTS-like case:
+    an ellipsoid brain with noisy intensities and a labelled spherical tumor.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape (number_of_slices, width, height) of the volumes
+    rng : np.random.Generator
+        Random generator
+
+    Return
+    ----------
+    volumes : list
+        4 int16 sequences followed by the uint8 ground truth
+    """
+    z, r, c = np.ogrid[tuple(slice(0, n) for n in shape)]
+    center = np.array(shape) / 2
+    brain = ((z - center[0]) / (0.45 * shape[0])) ** 2 + ((r - center[1]) / (0.35 * shape[1])) ** 2 \
+        + ((c - center[2]) / (0.3 * shape[2])) ** 2 <= 1
+    tumor_center = center + rng.uniform(-0.1, 0.1, 3) * np.array(shape)
+    distance = np.sqrt(((z - tumor_center[0]) / shape[0]) ** 2 + ((r - tumor_center[1]) / shape[1]) ** 2
+                       + ((c - tumor_center[2]) / shape[2]) ** 2)
+    y = np.zeros(shape, dtype=np.uint8)
+    for label, radius in zip([2, 4, 1, 3], [0.12, 0.08, 0.05, 0.02]):
+        y[(distance <= radius) & brain] = label
+    volumes = []
+    for _ in range(4):
+        x = rng.normal(600, 150, shape).astype(np.float32) + 300. * y
+        volumes.append(np.where(brain, np.clip(x, 0, None), 0).astype(np.int16))
+    return volumes + [y]
+
+def make_synthetic_dataset(path : str, n_cases : int, split : str = 'training',
+                           shape : tuple = (155, 240, 240), seed : int = 0) -> list:
+    """Write a synthetic split laid out as the reorganized BraTS 2015 dataset,
+    i.e. path/split/case/sequence/sequence.mha
+
+    Parameters
+    ----------
+    path : str
+        Root of the dataset
+    n_cases : int
+        Number of cases
+    split : str
+        Name of the split. Default to 'training'
+    shape : tuple
+        Shape (number_of_slices, width, height) of the volumes. Default to (155, 240, 240)
+    seed : int
+        Seed of the generator. Default to 0
+
+    Return
+    ----------
+    cases : list
+        Paths of the generated cases
+    """
+    import SimpleITK as sitk
+    rng = np.random.default_rng(seed)
+    cases = []
+    for idx in range(n_cases):
+        case = os.path.join(path, split, 'synthetic_pat{:04d}'.format(idx))
+        for sequence, volume in zip(SEQUENCES, make_case(shape, rng)):
+            name = '{}.{}'.format(sequence, idx)
+            os.makedirs(os.path.join(case, name), exist_ok=True)
+            sitk.WriteImage(sitk.GetImageFromArray(volume), os.path.join(case, name, name + '.mha'))
+        cases.append(case)
+    return cases
@@ -1,15 +1,81 @@
 import os, argparse
 import os
+from functools import partial
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
-from tensorflow.keras.utils import to_categorical
-from tensorflow.keras.utils import normalize as knorm
 from utils import io, parser
 from pipeline import BraTSPipeline
 from pipeline.processing import *
-from pipeline.h5 import HDF5Store
-from pipeline.recorder import TrainingTFRecorder
+from pipeline.cache import VolumeCache
+from pipeline.buffers import get_pool
+from pipeline.manifest import RunManifest
+from pipeline.profiling import PipelineProfiler
+from pipeline.statistics import NORMALIZATION_METHODS, IntensityStats, compute_statistics, affine_normalize
+from pipeline.sharding import partition, shard_name
+from pipeline.dedup import DEDUP_MODES, SliceDeduplicator
+from pipeline.chunked import CODECS
+from pipeline.writers import *
 from tqdm import tqdm
 
+EXECUTION_ARGS = ['data_path', 'save_path', 'split_file', 'split_ratios', 'split_seed', 'stats_file',
+                  'num_shards', 'shard_index', 'workers', 'staged', 'queue_size', 'cache_dir', 'cache_size_gb',
+                  'profile', 'profile_memory', 'cprofile', 'compression_workers', 'buffer_pool']
+
+def slice_shape(args):
+    """Shape of a single slice, patch or volumetric block written by the pipeline
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Command line arguments
+
+    Return
+    ----------
+    shape : tuple
+        ([depth, ] width, height)
+    """
+    if args.slab_depth is not None:
+        return (args.slab_depth, 128, 128)
+    if args.patch_size is None:
+        return (128, 128)
+    return ((args.patch_depth, ) if args.patch_depth else ()) + (args.patch_size, args.patch_size)
+
+def create_writer(args, path, split, state=None):
+    """Create the writer of a split for the selected output format
+    
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Command line arguments
+    path : str
+        Directory of the split
+    split : str
+        Name of the split
+    state : dict
+        State to resume from, for writers keeping the whole split in one file
+        
+    Return
+    ----------
+    writer : SplitWriter
+    """
+    if args.format == 'tfrecord':
+        schema = {'label_encoding': args.label_encoding, 'image_dtype': args.image_dtype,
+                  'rescale': args.normalization == 'none'}
+        if args.samples_per_shard is None and args.shard_size_mb is None:
+            return TFRecordCaseWriter(path, split, **schema)
+        return TFRecordShardWriter(path, split, state=state, samples_per_shard=args.samples_per_shard,
+                                   shard_size_mb=args.shard_size_mb or 128,
+                                   compression=args.tfrecord_compression, **schema)
+    shape = slice_shape(args)
+    if args.format == 'npy':
+        if args.npy_layout == 'consolidated':
+            return NPYSplitWriter(path, split, state=state, shapes=[(4, ) + shape, shape],
+                                  compression=args.npy_compression, compression_opts=args.npy_compression_level,
+                                  chunk_len=args.npy_chunk_len, workers=args.compression_workers)
+        return NPYCaseWriter(path, split)
+    return H5SplitWriter(path, split, state=state, shapes=[(4, ) + shape, (5, ) + shape],
+                         normalization=args.h5_normalization,
+                         compression=args.h5_compression, compression_opts=args.h5_compression_level,
+                         chunk_len=1 if args.slab_depth else args.h5_chunk_len, shuffle=args.h5_shuffle, workers=args.compression_workers)
 
 
 if __name__ == "__main__":
@@ -30,63 +96,390 @@ if __name__ == "__main__":
         help='Format to save data',
         required=True
     )
+    parser.add_argument(
+        '--split_file',
+        help='Split of the cases, created if missing. Default to SAVE_PATH/split.json',
+        default=None
+    )
+    parser.add_argument(
+        '--split_ratios',
+        help='Fractions of the HGG and LGG cases in the training, validation and testing splits',
+        type=float,
+        nargs=3,
+        default=[0.9, 0., 0.1]
+    )
+    parser.add_argument(
+        '--split_seed',
+        help='Seed of the split of the cases',
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        '--num_shards',
+        help='Split the cases between this number of independent jobs, e.g. on several machines',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--shard_index',
+        help='Index of the job in [0, num_shards), its output is written to SAVE_PATH/shard-INDEX-of-NUM',
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of worker processes used to run the pipeline (0 runs it in the main process)',
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        '--staged',
+        help='Run every pipeline operation in its own thread so reading, processing and writing cases overlap',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--queue_size',
+        help='With --staged, maximum number of cases waiting between two operations',
+        type=int,
+        default=2
+    )
+    parser.add_argument(
+        '--cache_dir',
+        help='Directory of a cache of decoded .mha volumes, reused across runs',
+        default=None
+    )
+    parser.add_argument(
+        '--cache_size_gb',
+        help='Maximum size of the volume cache in GB',
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        '--buffer_pool',
+        help='Reuse preallocated arrays, sized to the largest case, from one case to the next in every process',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--slice_policy',
+        help='Slices kept from each case: with tumor, with brain, or all of them',
+        choices=SLICE_POLICIES,
+        default='tumor'
+    )
+    parser.add_argument(
+        '--background_ratio',
+        help='With the tumor policy, number of brain slices without tumor to keep per tumor slice',
+        type=float,
+        default=0.
+    )
+    parser.add_argument(
+        '--slab_depth',
+        help='Volumetric mode: write blocks of this number of consecutive slices, of shape (4, depth, 128, 128), '
+             'taken from the first to the last slice selected by the slice policy (h5 and npy only)',
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        '--slab_stride',
+        help='Number of slices between the starts of two blocks, the depth by default',
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        '--slab_pad',
+        help='Pad the last block of each case with empty slices instead of dropping it',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--patch_size',
+        help='Write patches of this size sampled around each label instead of the 128x128 center crop',
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        '--patches_per_case',
+        help='Number of patches extracted from each case',
+        type=int,
+        default=32
+    )
+    parser.add_argument(
+        '--patch_rates',
+        help='Fraction of the patches centered on each label, the first one being the brain outside the tumor',
+        type=float,
+        nargs=5,
+        default=[0.2, 0.2, 0.2, 0.2, 0.2]
+    )
+    parser.add_argument(
+        '--patch_depth',
+        help='Extract 3D patches spanning this number of consecutive slices (h5 and npy only, '
+             'with the brain or all slice policy)',
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        '--dedup',
+        help='Drop the duplicate slices of each split, or only flag them, recording them in dedup_index.jsonl',
+        choices=['none'] + DEDUP_MODES,
+        default='none'
+    )
+    parser.add_argument(
+        '--dedup_threshold',
+        help='Also treat as duplicates slices with the same tumor location whose 64-bit average hashes '
+             'differ by at most this number of bits. By default only exact duplicates are removed',
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        '--normalization',
+        help='Normalize every modality with dataset statistics: z-score, or percentiles mapped to [0, 1]. '
+             'tfrecord slices are then no longer scaled by their maximum',
+        choices=['none'] + NORMALIZATION_METHODS,
+        default='none'
+    )
+    parser.add_argument(
+        '--percentiles',
+        help='Low and high percentiles of the percentile normalization',
+        type=float,
+        nargs=2,
+        default=[1., 99.]
+    )
+    parser.add_argument(
+        '--stats_file',
+        help='Intensity statistics of the training cases, computed if missing. Default to SAVE_PATH/intensity_stats.json',
+        default=None
+    )
+    parser.add_argument(
+        '--npy_layout',
+        help='Write one npy file pair per case, or a single memory-mappable file per split with a slice index',
+        choices=['case', 'consolidated'],
+        default='case'
+    )
+    parser.add_argument(
+        '--npy_compression',
+        help='Write consolidated npy datasets as chunks compressed with this codec (with byte-shuffle), '
+             'read with NPYDataset. zstd, lz4 and blosc need their Python package',
+        choices=['none'] + list(CODECS),
+        default='none'
+    )
+    parser.add_argument(
+        '--npy_compression_level',
+        help='Compression level of the npy codec',
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        '--npy_chunk_len',
+        help='Number of slices per compressed npy chunk',
+        type=int,
+        default=16
+    )
+    parser.add_argument(
+        '--h5_compression',
+        help='Compression of the h5 datasets',
+        choices=['gzip', 'lzf', 'none'],
+        default='gzip'
+    )
+    parser.add_argument(
+        '--h5_compression_level',
+        help='Compression level of the gzip filter, in [0, 9]',
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        '--h5_normalization',
+        help='Normalization of the h5 slices: l2 norm across modalities of every pixel, or min-max per slice. '
+             'Default to l2, or none with --normalization',
+        choices=['l2', 'minmax', 'none'],
+        default=None
+    )
+    parser.add_argument(
+        '--h5_chunk_len',
+        help='Number of slices per h5 chunk',
+        type=int,
+        default=16
+    )
+    parser.add_argument(
+        '--h5_shuffle',
+        help='Byte-shuffle h5 chunks before compressing them, which compresses float slices better',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--compression_workers',
+        help='Number of threads compressing h5 (gzip) and npy chunks',
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        '--samples_per_shard',
+        help='Pack tfrecord slices into shards holding this number of examples',
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        '--shard_size_mb',
+        help='Pack tfrecord slices into shards of this size in MB',
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        '--tfrecord_compression',
+        help='Compression of the tfrecord shards',
+        choices=['GZIP', 'ZLIB'],
+        default=None
+    )
+    parser.add_argument(
+        '--label_encoding',
+        help='Storage of tfrecord ground truth, int64 list or raw uint8 bytes',
+        choices=LABEL_ENCODINGS,
+        default='int64'
+    )
+    parser.add_argument(
+        '--image_dtype',
+        help='Type of the tfrecord image bytes, uint8 only without --normalization',
+        choices=IMAGE_DTYPES,
+        default='float32'
+    )
+    parser.add_argument(
+        '--profile',
+        help='Write a report of the time, items and bytes of every pipeline operation to profile.json in each split',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--profile_memory',
+        help='Also measure the memory allocated by every operation with tracemalloc (slower)',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--cprofile',
+        help='Also profile every operation with cProfile and write one .prof file per operation',
+        action='store_true'
+    )
 
     args = parser.parse_args()
     
     """ INIT PARAMETERS """
 
-    split_names = ['training', 'testing']
     data_path = io.check_path(args.data_path, '.mha', lvl=4)
     save_path = args.save_path
+    split_file = args.split_file or os.path.join(save_path, io.SPLIT_FILE)
+    stats_file = args.stats_file or os.path.join(save_path, 'intensity_stats.json')
+    if args.num_shards > 1:
+        save_path = os.path.join(save_path, shard_name(args.shard_index, args.num_shards))
     save_format = args.format
     print('\n')
 
     if save_format not in ['tfrecord', 'npy', 'h5']:
         raise ValueError('Format has to be in '.format(['tfrecord', 'npy', 'h5']))
+    if args.patch_size is not None and args.patches_per_case < 1:
+        raise ValueError('--patches_per_case has to be at least 1')
+    if args.patch_depth and (save_format == 'tfrecord' or args.slice_policy == 'tumor'):
+        raise ValueError('3D patches are written to h5 or npy and need contiguous slices (brain or all policy)')
+    if args.slab_depth and (save_format == 'tfrecord' or args.patch_size is not None):
+        raise ValueError('Volumetric blocks are written to h5 or npy, and cannot be combined with patches')
+    if args.normalization != 'none' and args.h5_normalization not in (None, 'none'):
+        raise ValueError('--h5_normalization would replace the dataset normalization, use one or the other')
+    if save_format == 'tfrecord':
+        # tfrecord slices are only scaled to [0, 255] without dataset normalization
+        check_image_dtype(args.image_dtype, rescale=args.normalization == 'none')
+    if args.h5_normalization is None:
+        # Slices normalized with dataset statistics are written unchanged, as tfrecord slices are not rescaled
+        args.h5_normalization = 'none' if args.normalization != 'none' else 'l2'
         
-    """ ORGANIZE BRATS DATA """
+    """ SPLIT BRATS DATA """
     
-    io.organize_dataset(data_path, split_names)
+    split = None
+    split_names = ['training', 'testing']
+    if os.path.isdir(os.path.join(data_path, 'training')):
+        print('Using the training and testing folders of a dataset reorganized by a previous version.')
+    else:
+        if os.path.isfile(split_file):
+            split = io.load_split(split_file)
+            if split['ratios'] != args.split_ratios or split['seed'] != args.split_seed:
+                raise ValueError('{} was created with other ratios or seed, remove it or '
+                                 'pass another --split_file'.format(split_file))
+        else:
+            split = io.create_split(data_path, args.split_ratios, args.split_seed)
+            os.makedirs(os.path.dirname(os.path.abspath(split_file)), exist_ok=True)
+            io.save_split(split, split_file)
+        split_names = [name for name, ratio in zip(io.SPLIT_NAMES, split['ratios']) if ratio > 0]
     
     """ PERFORM PIPELINE """
     
-    tfrecorder = TrainingTFRecorder()
-    brats_pipeline = BraTSPipeline(data_path)
-    brats_pipeline.add_operation(resize)
+    cache = None
+    if args.cache_dir is not None:
+        cache = VolumeCache(args.cache_dir, None if args.cache_size_gb is None else int(args.cache_size_gb * 2 ** 30))
+    brats_pipeline = BraTSPipeline(data_path, cache=cache, slice_policy=args.slice_policy,
+                                   background_ratio=args.background_ratio, split=split, slab_depth=args.slab_depth,
+                                   slab_stride=args.slab_stride, slab_pad=args.slab_pad,
+                                   pool=get_pool() if args.buffer_pool else None)
+    if args.patch_size is None:
+        brats_pipeline.add_operation(resize)
+    else:
+        brats_pipeline.add_operation(partial(extract_patches, size=args.patch_size, n_patches=args.patches_per_case,
+                                             rates=tuple(args.patch_rates), depth=args.patch_depth, seed=0))
+    if args.normalization != 'none':
+        if os.path.isfile(stats_file):
+            stats = IntensityStats.load(stats_file)
+        else:
+            print('Computing intensity statistics of the training cases')
+            stats = compute_statistics(brats_pipeline.cases('training'), workers=args.workers, cache=cache)
+            os.makedirs(os.path.dirname(os.path.abspath(stats_file)), exist_ok=True)
+            stats.save(stats_file)
+        brats_pipeline.add_operation(partial(affine_normalize, **stats.normalization(args.normalization,
+                                                                                    args.percentiles)))
     # brats_pipeline.add_operation(normalize)
     # brats_pipeline.add_operation(augment)
     
-    n_cases = [len(glob(os.path.join(data_path, '{}/*'.format(name)))) for name in split_names]
+    config = {
+        'pipeline': brats_pipeline.config(),
+        'output': {k: v for k, v in sorted(vars(args).items()) if k not in EXECUTION_ARGS}
+    }
+    split_cases = [brats_pipeline.cases(name) for name in split_names]
+    shard_cases = [partition(cases, args.num_shards, args.shard_index) for cases in split_cases]
     
-    print('Number of cases : {}'.format(n_cases))
+    print('Number of cases : {}'.format([len(cases) for cases in shard_cases]))
     
-    for i, j in zip(split_names, n_cases):
-        os.makedirs(os.path.join(save_path, i), exist_ok = True) 
-        
-        if save_format == 'h5':
-            file_path = os.path.join(save_path, i, 'h5_dataset.h5')
-            h5_store = HDF5Store(file_path, ['X', 'Y'], shapes=[(4, 128, 128), (5, 128, 128)], dtype=[np.float32, np.uint8])
-        
-        with tqdm(total=j, desc = 'Applying pipeline to {} data :'.format(i)) as pbar:
+    for i, all_cases, cases in zip(split_names, split_cases, shard_cases):
+        split_path = os.path.join(save_path, i)
+        os.makedirs(split_path, exist_ok = True) 
+
+        manifest = RunManifest(os.path.join(split_path, RunManifest.name), config)
+        writer = None
+        if manifest.resumable(cases):
+            try:
+                writer = create_writer(args, split_path, i, manifest.state)
+            except OSError:
+                print('Could not resume writing {} data, it will be rebuilt.'.format(i))
+        if writer is None:
+            writer = create_writer(args, split_path, i)
+            if not writer.per_case:
+                manifest.reset()
 
-            for idx, (x, y) in enumerate(brats_pipeline.process(i)):
-                if save_format == 'tfrecord':
-                    file_path = os.path.join(save_path, i, '{}_case_{}.tfrecord'.format(i, idx))
-                    x = np.moveaxis(x, 1, 3)
-                    tfrecorder.save_tf_record(x, y, file_path)
+        index = {case: idx for idx, case in enumerate(all_cases)}
+        pending = [case for case in cases if not manifest.is_current(case)]
+        dedup = None
+        if args.dedup != 'none':
+            recorded = [os.path.basename(case) for case in set(cases) - set(pending)]
+            dedup = SliceDeduplicator(os.path.join(split_path, SliceDeduplicator.name), args.dedup,
+                                      args.dedup_threshold, cases=recorded)
+        profiler = None
+        if args.profile or args.profile_memory or args.cprofile:
+            profiler = PipelineProfiler(memory=args.profile_memory, profile=args.cprofile)
+        
+        with tqdm(total=len(cases), initial=len(cases) - len(pending),
+                  desc = 'Applying pipeline to {} data :'.format(i)) as pbar:
 
-                elif save_format == 'npy':
-                    os.makedirs(os.path.join(save_path, i, 'x'), exist_ok=True)
-                    os.makedirs(os.path.join(save_path, i, 'y'), exist_ok=True)
-                    np.save(os.path.join(save_path, i, 'x', '{}_case_X_{}.npy'.format(i, idx)), x)
-                    np.save(os.path.join(save_path, i, 'y', '{}_case_Y_{}.npy'.format(i, idx)), y)
+            outputs = zip(pending, brats_pipeline.process(i, workers=args.workers, cases=pending, profiler=profiler,
+                                                               staged=args.staged, queue_size=args.queue_size))
+            for case, (x, y) in outputs:
+                if dedup is not None:
+                    x, y = dedup.filter(case, x, y)
+                output = writer.write(index[case], case, x, y)
+                manifest.record(case, output, len(x), writer.checkpoint())
+                pbar.update()
 
-                elif save_format == 'h5':
-                    for data, target in zip(x, y):
-                        data *= 255.0 / data.max()
-                        target = to_categorical(target, 5)
-                        target = np.moveaxis(target, 2, 0)
-                        data = knorm(data, axis = 0)
-                        h5_store.append('X', data, data.shape)
-                        h5_store.append('Y', target, target.shape)
-                pbar.update()
\ No newline at end of file
+        writer.close()
+        manifest.save()
+        if dedup is not None and dedup.dropped:
+            print('{} duplicate slices dropped from {} data'.format(dedup.dropped, i))
+        if profiler is not None:
+            profiler.save(os.path.join(split_path, 'profile.json'), os.path.join(split_path, 'profile'))
@@ -0,0 +1,30 @@
+import os, argparse
+from pipeline.manifest import RunManifest
+from pipeline.sharding import find_shards, merge_split
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Combine the outputs of make_training_data.py run with --num_shards')
+    parser.add_argument(
+        '--save_path',
+        help='Path given as --save_path to every shard',
+        required=True
+    )
+    parser.add_argument(
+        '--splits',
+        help='Splits to merge, all the splits of the shards by default',
+        nargs='*',
+        default=None
+    )
+    args = parser.parse_args()
+
+    shards = find_shards(args.save_path)
+    print('Merging {} shards'.format(len(shards)))
+    splits = args.splits
+    if splits is None and shards:
+        first = os.path.join(args.save_path, shards[0])
+        splits = sorted(name for name in os.listdir(first) if os.path.isfile(os.path.join(first, name, RunManifest.name)))
+    for split in splits or []:
+        manifest = merge_split(args.save_path, split, shards)
+        print('{} : {} cases, {} slices'.format(split, len(manifest['cases']),
+                                                sum(entry['slices'] for entry in manifest['cases'].values())))
@@ -1,24 +1,241 @@
-import tensorlayer as tl
+import zlib
 import numpy as np
 
-def rotation(image_list):
-    image_list = tl.prepro.rotation_multi(image_list, rg=130, is_random=False, fill_mode='nearest')
-    return image_list
+def _translation(offsets : np.ndarray) -> np.ndarray:
+    matrices = np.tile(np.eye(3), (len(offsets), 1, 1))
+    matrices[:, :2, 2] = offsets
+    return matrices
 
-def shift(image_list):
-    image_list = tl.prepro.shift_multi(image_list, wrg=0.10, hrg=0.10, is_random=True, fill_mode='constant')
-    return image_list
+def _linear(linear : np.ndarray, shape : tuple) -> np.ndarray:
+    """Homogeneous matrices applying linear transforms around the center of the slices."""
+    center = (np.array(shape, dtype=float) - 1) / 2
+    matrices = np.tile(np.eye(3), (len(linear), 1, 1))
+    matrices[:, :2, :2] = linear
+    matrices[:, :2, 2] = center - linear @ center
+    return matrices
 
-def elastic_transform(image_list):
-    image_list = tl.prepro.elastic_transform_multi(image_list,alpha=720, sigma=24, is_random=True)
-    return image_list
 
-def shear(image_list):
-    image_list = tl.prepro.shear_multi(image_list, 0.05,is_random=True, fill_mode='constant')
-    return image_list
+class Augmentation(object):
+    """
+    Batched augmentation of slices and their ground truth.
+    An augmentation draws one (3, 3) affine matrix per slice, mapping output pixel
+    coordinates (row, col, 1) to input coordinates, and optionally a displacement
+    field added to these coordinates. All slices and sequences of a batch are then
+    resampled with a single coordinate map.
+    """
+    def matrices(self, n : int, shape : tuple, rng) -> np.ndarray:
+        """Draw the affine matrices of a batch
 
-def flip(image_list):
-    image_list = tl.prepro.flip_axis_multi(image_list,axis=1, is_random=True)
-    return image_list
+        Parameters
+        ----------
+        n : int
+            Number of slices
+        shape : tuple
+            Shape (width, height) of the slices
+        rng : np.random.Generator
+            Random generator
 
-aug_operations = [rotation, flip, shear, shift, elastic_transform]
\ No newline at end of file
+        Return
+        ----------
+        matrices : np.ndarray
+            Matrices of shape (n, 3, 3)
+        """
+        return np.tile(np.eye(3), (n, 1, 1))
+
+    def displacement(self, n : int, shape : tuple, rng) -> np.ndarray:
+        """Draw the displacement fields of a batch
+
+        Parameters
+        ----------
+        n : int
+            Number of slices
+        shape : tuple
+            Shape (width, height) of the slices
+        rng : np.random.Generator
+            Random generator
+
+        Return
+        ----------
+        displacement : np.ndarray
+            Displacement of shape (n, 2, width, height), None for affine only augmentations
+        """
+        return None
+
+    def coordinates(self, n : int, shape : tuple, rng) -> np.ndarray:
+        """Input coordinates of every output pixel of a batch
+
+        Return
+        ----------
+        coordinates : np.ndarray
+            Coordinates of shape (2, n, width, height)
+        """
+        matrices = self.matrices(n, shape, rng)
+        grid = np.indices(shape, dtype=float)
+        coordinates = np.einsum('nij,jwh->inwh', matrices[:, :2, :2], grid) + matrices[:, :2, 2].T[..., None, None]
+        displacement = self.displacement(n, shape, rng)
+        if displacement is not None:
+            coordinates += np.moveaxis(displacement, 1, 0)
+        return coordinates
+
+    def __call__(self, x : np.ndarray, y : np.ndarray, rng = None, out : tuple = None, mode : str = 'constant') -> tuple:
+        """Augment a batch of slices. Sequences are resampled with linear
+        interpolation and the ground truth with nearest neighbour.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            MRI array of shape (number_of_slices, 4, width, height)
+        y : np.ndarray
+            Ground truth array of shape (number_of_slices, width, height), or one-hot
+            encoded of shape (number_of_slices, classes, width, height)
+        rng : np.random.Generator
+            Random generator. Default to None (fresh generator)
+        out : tuple
+            Arrays in which to write the augmented x and y. Default to None
+        mode : str
+            How points outside the slices are filled, see scipy.ndimage.map_coordinates.
+            Default to 'constant'
+
+        Return
+        ----------
+        augmented_data : tuple
+            Augmented x and y
+        """
+        from scipy import ndimage
+        rng = rng if rng is not None else np.random.default_rng()
+        n = len(x)
+        rows, cols = self.coordinates(n, x.shape[-2:], rng)
+        batch = np.broadcast_to(np.arange(n, dtype=float)[:, None, None], rows.shape)
+        coordinates = np.stack([batch, rows, cols])
+        x_out, y_out = out if out is not None else (np.empty_like(x), np.empty_like(y))
+        for c in range(x.shape[1]):
+            ndimage.map_coordinates(x[:, c], coordinates, output=x_out[:, c], order=1, mode=mode)
+        if y.ndim == x.ndim:
+            # One-hot ground truth, points outside the slices are background (class 0)
+            for c in range(y.shape[1]):
+                ndimage.map_coordinates(y[:, c], coordinates, output=y_out[:, c], order=0, mode=mode, cval=c == 0)
+        else:
+            ndimage.map_coordinates(y, coordinates, output=y_out, order=0, mode=mode)
+        return (x_out, y_out)
+
+
+class Rotation(Augmentation):
+    """Rotation of `degrees`, or of a random angle in [-degrees, degrees] if `random` is set."""
+    def __init__(self, degrees : float = 130, random : bool = False):
+        self.degrees = degrees
+        self.random = random
+
+    def matrices(self, n, shape, rng):
+        angles = rng.uniform(-self.degrees, self.degrees, n) if self.random else np.full(n, self.degrees)
+        angles = np.deg2rad(angles)
+        cos, sin = np.cos(angles), np.sin(angles)
+        return _linear(np.stack([np.stack([cos, -sin], -1), np.stack([sin, cos], -1)], 1), shape)
+
+
+class Flip(Augmentation):
+    """Mirror along `axis` (0 for rows, 1 for columns), for half of the slices if `random` is set."""
+    def __init__(self, axis : int = 1, random : bool = True):
+        self.axis = axis
+        self.random = random
+
+    def matrices(self, n, shape, rng):
+        flip = rng.random(n) < 0.5 if self.random else np.ones(n, dtype=bool)
+        linear = np.tile(np.eye(2), (n, 1, 1))
+        linear[flip, self.axis, self.axis] = -1
+        return _linear(linear, shape)
+
+
+class Shear(Augmentation):
+    """Shear of a random angle in [-intensity, intensity] radians."""
+    def __init__(self, intensity : float = 0.05):
+        self.intensity = intensity
+
+    def matrices(self, n, shape, rng):
+        shear = rng.uniform(-self.intensity, self.intensity, n)
+        linear = np.tile(np.eye(2), (n, 1, 1))
+        linear[:, 0, 1] = -np.sin(shear)
+        linear[:, 1, 1] = np.cos(shear)
+        return _linear(linear, shape)
+
+
+class Shift(Augmentation):
+    """Translation of a random fraction in [-hrg, hrg] of the width and [-wrg, wrg] of the height."""
+    def __init__(self, wrg : float = 0.1, hrg : float = 0.1):
+        self.wrg = wrg
+        self.hrg = hrg
+
+    def matrices(self, n, shape, rng):
+        ranges = np.array([self.hrg * shape[0], self.wrg * shape[1]])
+        return _translation(rng.uniform(-1, 1, (n, 2)) * ranges)
+
+
+class ElasticTransform(Augmentation):
+    """Elastic deformation with a random displacement field smoothed by a gaussian
+    of standard deviation `sigma` and scaled by `alpha`."""
+    def __init__(self, alpha : float = 720, sigma : float = 24):
+        self.alpha = alpha
+        self.sigma = sigma
+
+    def displacement(self, n, shape, rng):
+        from scipy import ndimage
+        field = rng.uniform(-1, 1, (n, 2) + tuple(shape))
+        return ndimage.gaussian_filter(field, sigma=(0, 0, self.sigma, self.sigma), mode='constant') * self.alpha
+
+
+class Compose(Augmentation):
+    """Chain augmentations into a single resampling. Affine matrices are multiplied
+    and displacement fields added."""
+    def __init__(self, *augmentations):
+        self.augmentations = augmentations
+
+    def matrices(self, n, shape, rng):
+        matrices = np.tile(np.eye(3), (n, 1, 1))
+        for augmentation in self.augmentations:
+            matrices = matrices @ augmentation.matrices(n, shape, rng)
+        return matrices
+
+    def displacement(self, n, shape, rng):
+        fields = [augmentation.displacement(n, shape, rng) for augmentation in self.augmentations]
+        fields = [field for field in fields if field is not None]
+        return sum(fields) if fields else None
+
+
+class RandomAugmentation(Augmentation):
+    """Augmentation drawn per slice, to augment batches while reading a dataset
+    instead of storing augmented copies. Each slice is augmented with probability
+    `ratio` by one of the augmentations, chosen uniformly, and left unchanged otherwise.
+    All slices of a batch are still resampled at once."""
+    def __init__(self, augmentations : list = None, ratio : float = 0.5):
+        self.augmentations = augmentations if augmentations is not None else aug_operations
+        self.ratio = ratio
+
+    def coordinates(self, n, shape, rng):
+        coordinates = np.indices((n, ) + tuple(shape), dtype=float)[1:]
+        choice = np.where(rng.random(n) < self.ratio, rng.integers(len(self.augmentations), size=n), -1)
+        for i, augmentation in enumerate(self.augmentations):
+            selected = np.flatnonzero(choice == i)
+            if len(selected):
+                coordinates[:, selected] = augmentation.coordinates(len(selected), shape, rng)
+        return coordinates
+
+
+def case_rng(seed : int, y : np.ndarray):
+    """Random generator of a case, derived from a seed and the content of its ground truth
+    so results do not depend on the order in which cases are processed.
+
+    Parameters
+    ----------
+    seed : int
+        Seed of the run, None for a non reproducible generator
+    y : np.ndarray
+        Ground truth of the case
+
+    Return
+    ----------
+    rng : np.random.Generator
+    """
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, zlib.crc32(np.ascontiguousarray(y))])
+
+aug_operations = [Rotation(130), Flip(), Shear(0.05), Shift(0.10, 0.10), ElasticTransform(720, 24)]
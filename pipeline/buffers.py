@@ -0,0 +1,122 @@
+import threading
+import numpy as np
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def get_pool(name : str = 'default'):
+    """Buffer pool of the current process with a given name, created on first use.
+    Pools sent to worker processes are replaced by the pool of the same name of
+    the worker, so every worker reuses its own buffers from one case to the next.
+
+    Parameters
+    ----------
+    name : str
+        Name of the pool. Default to 'default'
+
+    Return
+    ----------
+    pool : BufferPool
+    """
+    with _POOLS_LOCK:
+        if name not in _POOLS:
+            _POOLS[name] = BufferPool(name)
+        return _POOLS[name]
+
+
+class BufferPool(object):
+    """
+    Pool of reusable preallocated arrays, to avoid allocating multi-hundred-MB arrays
+    for every case. Buffers are flat arrays of a given type: `acquire` returns a view
+    of the smallest free buffer large enough, replacing a free buffer by a larger one
+    when none is, so buffers end up sized to the largest case. `release` gives back the
+    buffer an array is a view of. Pipeline operations accepting a `pool` argument
+    allocate their outputs from it and release their inputs.
+    ...
+
+    Attributes
+    ----------
+    name : str
+        Name of the pool, see get_pool. Default to None (pool of the current process only)
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self._free = {}
+        self._used = {}
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        if self.name is None:
+            return (BufferPool, ())
+        return (get_pool, (self.name, ))
+
+    def __repr__(self):
+        return 'BufferPool({!r})'.format(self.name)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the pool, free and used buffers"""
+        with self._lock:
+            return sum(b.nbytes for buffers in self._free.values() for b in buffers) + \
+                sum(b.nbytes for b in self._used.values())
+
+    def acquire(self, shape : tuple, dtype = np.float32) -> np.ndarray:
+        """Get an uninitialized array from the pool
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the array
+        dtype : np.dtype
+            Type of the array. Default to np.float32
+
+        Return
+        ----------
+        array : np.ndarray
+            C-contiguous view of a pooled buffer, valid until it is released
+        """
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        with self._lock:
+            free = self._free.setdefault(dtype, [])
+            fitting = [b for b in free if b.size >= size]
+            if fitting:
+                buffer = min(fitting, key=len)
+                free.remove(buffer)
+            else:
+                if free:
+                    free.remove(max(free, key=len))
+                buffer = np.empty(size, dtype=dtype)
+            self._used[id(buffer)] = buffer
+        return buffer[:size].reshape(shape)
+
+    def release(self, *arrays):
+        """Give back the buffers of arrays acquired from the pool, or views of them.
+        Arrays that do not come from the pool are ignored.
+
+        Parameters
+        ----------
+        *arrays : np.ndarray
+            Arrays to release
+        """
+        with self._lock:
+            for array in arrays:
+                while isinstance(array, np.ndarray):
+                    buffer = self._used.get(id(array))
+                    if buffer is array:
+                        del self._used[id(array)]
+                        self._free[array.dtype].append(array)
+                        break
+                    array = array.base
+
+    def release_all(self):
+        """Give back every buffer in use"""
+        with self._lock:
+            for buffer in self._used.values():
+                self._free[buffer.dtype].append(buffer)
+            self._used = {}
+
+    def clear(self):
+        """Free the memory of the unused buffers"""
+        with self._lock:
+            self._free = {}
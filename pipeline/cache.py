@@ -0,0 +1,104 @@
+import os, hashlib
+import numpy as np
+
+class VolumeCache(object):
+    """
+    On-disk cache of decoded MRI volumes.
+    Volumes are stored as raw .npy files keyed by the path, modification time and
+    size of their source file, and read back memory-mapped. When the cache grows
+    beyond `max_bytes`, the least recently used volumes are evicted.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Directory of the cache
+    max_bytes : int
+        Maximum size of the cache in bytes. Default to None (unbounded)
+    """
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, file_path):
+        """Cache key of a source file, changed whenever the file is modified
+
+        Parameters
+        ----------
+        file_path : str
+            Path of the source file
+
+        Return
+        ----------
+        key : str
+        """
+        stat = os.stat(file_path)
+        identity = '{}|{}|{}'.format(os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def get(self, file_path):
+        """Read a cached volume
+
+        Parameters
+        ----------
+        file_path : str
+            Path of the source file
+
+        Return
+        ----------
+        volume : np.memmap
+            Cached volume, None if the file is not in the cache
+        """
+        entry = os.path.join(self.path, self.key(file_path) + '.npy')
+        try:
+            volume = np.load(entry, mmap_mode='r')
+            os.utime(entry)
+        except (FileNotFoundError, ValueError):
+            return None
+        return volume
+
+    def put(self, file_path, volume):
+        """Add a decoded volume to the cache and evict old entries if needed
+
+        Parameters
+        ----------
+        file_path : str
+            Path of the source file
+        volume : np.array
+            Decoded volume
+        """
+        key = self.key(file_path)
+        tmp = os.path.join(self.path, '.{}.{}.tmp'.format(key, os.getpid()))
+        with open(tmp, 'wb') as f:
+            np.save(f, volume)
+        os.replace(tmp, os.path.join(self.path, key + '.npy'))
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes):
+        """Delete least recently used volumes until the cache fits in max_bytes
+
+        Parameters
+        ----------
+        max_bytes : int
+            Size to fit in
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,386 @@
+import os, json, zlib, lzma
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+INDEX_SUFFIX = '.json'
+TAIL_SUFFIX = '.tail.npz'
+
+
+class Codec(object):
+    """
+    Compression of byte strings. The compressors of the standard library and of the
+    optional blosc, zstandard and lz4 packages release the GIL, so chunks can be
+    compressed in parallel by threads.
+    ...
+
+    Attributes
+    ----------
+    name : str
+        Name of the codec, see CODECS
+    level : int
+        Compression level. Default to None (default level of the codec)
+    """
+    def __init__(self, name, level=None):
+        if name not in CODECS:
+            raise ValueError('codec has to be in {}'.format(list(CODECS)))
+        self.name = name
+        self.level = level
+        self._compress, self._decompress = CODECS[name](level)
+
+    def compress(self, data : bytes) -> bytes:
+        return self._compress(data)
+
+    def decompress(self, data : bytes) -> bytes:
+        return self._decompress(data)
+
+
+def _zlib(level):
+    return (lambda data: zlib.compress(data, 6 if level is None else level)), zlib.decompress
+
+def _lzma(level):
+    return (lambda data: lzma.compress(data, preset=level)), lzma.decompress
+
+def _zstd(level):
+    import zstandard
+    compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+    return compressor.compress, lambda data: zstandard.ZstdDecompressor().decompress(data)
+
+def _lz4(level):
+    import lz4.frame
+    return (lambda data: lz4.frame.compress(data, compression_level=level or 0)), lz4.frame.decompress
+
+def _blosc(level):
+    import blosc
+    # Bytes are shuffled beforehand, see shuffle_bytes
+    return (lambda data: blosc.compress(data, typesize=1, clevel=5 if level is None else level,
+                                        shuffle=blosc.NOSHUFFLE, cname='lz4')), blosc.decompress
+
+def _none(level):
+    return bytes, bytes
+
+CODECS = {
+    'zlib': _zlib,
+    'lzma': _lzma,
+    'zstd': _zstd,
+    'lz4': _lz4,
+    'blosc': _blosc,
+    'none': _none
+}
+
+def available_codecs() -> list:
+    """Names of the codecs whose packages are installed"""
+    available = []
+    for name in CODECS:
+        try:
+            Codec(name)
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+def default_codec() -> str:
+    """Fastest installed codec, falling back to zlib"""
+    available = available_codecs()
+    return next(name for name in ['blosc', 'lz4', 'zstd', 'zlib'] if name in available)
+
+def shuffle_bytes(data : np.array) -> bytes:
+    """Byte-shuffle an array: the first byte of every item, then the second byte, ...
+    Bytes of neighbouring floats that change slowly (sign, exponent) are grouped,
+    which makes them much more compressible. Same layout as the HDF5 shuffle filter.
+
+    Parameters
+    ----------
+    data : np.array
+        Contiguous array
+
+    Return
+    ----------
+    data : bytes
+    """
+    if data.itemsize == 1:
+        return data.tobytes()
+    return data.view(np.uint8).reshape(-1, data.itemsize).T.tobytes()
+
+def unshuffle_bytes(data : bytes, dtype) -> np.array:
+    """Inverse of shuffle_bytes
+
+    Parameters
+    ----------
+    data : bytes
+        Shuffled bytes
+    dtype : np.dtype
+        Type of the items
+
+    Return
+    ----------
+    data : np.array
+        Flat array of the items
+    """
+    dtype = np.dtype(dtype)
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if dtype.itemsize == 1:
+        return raw.view(dtype)
+    return np.ascontiguousarray(raw.reshape(dtype.itemsize, -1).T).view(dtype).ravel()
+
+
+class ChunkedWriter(object):
+    """
+    Append-only writer of an array as a sequence of compressed chunks of `chunk_len`
+    rows. Full chunks are compressed by a thread pool while the next rows are appended
+    and written in order to `path`, and the offset, size and number of rows of every
+    chunk are recorded in the index file `path.json`, read by ChunkedArray. Only the
+    last chunk can be shorter: rows of a partial chunk stay buffered across checkpoints,
+    saved uncompressed to `path.tail.npz`, and are compressed when the chunk is full or
+    the writer is closed.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Path of the data file
+    shape : tuple
+        Shape of a single row
+    dtype : np.dtype
+        Type of the array
+    codec : str
+        Name of the codec, see CODECS. Default to 'zlib'
+    level : int
+        Compression level. Default to None
+    shuffle : bool
+        Whether to byte-shuffle chunks before compressing them. Default to True
+    chunk_len : int
+        Number of rows per chunk. Default to 16
+    workers : int
+        Number of compression threads, 0 to compress in the current thread. Default to 0
+    state : dict
+        State returned by `checkpoint`. The existing file is reopened, chunks written
+        after the checkpoint are dropped and the buffered rows restored. Default to None
+        (the file is truncated)
+    """
+    def __init__(self, path, shape, dtype, codec='zlib', level=None, shuffle=True, chunk_len=16,
+                 workers=0, state=None):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.codec = Codec(codec, level)
+        self.shuffle = shuffle
+        self.chunk_len = chunk_len
+        self.chunks = []
+        self.rows = 0
+        self._buffer = np.empty((chunk_len, ) + self.shape, dtype=self.dtype)
+        self._n_buffered = 0
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self._max_pending = 2 * max(workers, 1)
+        if state is not None:
+            with open(path + INDEX_SUFFIX, 'r') as f:
+                self.chunks = json.load(f)['chunks'][:state['chunks']]
+            self._restore_tail(state['chunks'], state.get('tail', 0))
+            self.rows = sum(chunk[2] for chunk in self.chunks) + self._n_buffered
+        self._file = open(path, 'wb' if state is None else 'r+b')
+        self._file.truncate(self._end())
+        self._file.seek(self._end())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _restore_tail(self, n_chunks, n_rows):
+        if not n_rows:
+            return
+        try:
+            with np.load(self.path + TAIL_SUFFIX) as tail:
+                chunks, rows = int(tail['chunks']), tail['rows']
+        except FileNotFoundError:
+            chunks, rows = None, None
+        if chunks != n_chunks or len(rows) < n_rows:
+            # A later checkpoint already compressed these rows into the next chunk
+            rows = ChunkedArray(self.path)._decode(n_chunks)
+        self._buffer[:n_rows] = rows[:n_rows]
+        self._n_buffered = n_rows
+
+    def _end(self):
+        return self.chunks[-1][0] + self.chunks[-1][1] if self.chunks else 0
+
+    def _encode(self, rows):
+        data = shuffle_bytes(rows) if self.shuffle else rows.tobytes()
+        return self.codec.compress(data), len(rows)
+
+    def _submit(self, rows):
+        if self._executor is None:
+            self._store(*self._encode(rows))
+            return
+        self._pending.append(self._executor.submit(self._encode, rows))
+        while len(self._pending) >= self._max_pending:
+            self._store(*self._pending.popleft().result())
+
+    def _store(self, data, n):
+        self.chunks.append([self._end(), len(data), n])
+        self._file.write(data)
+
+    def append(self, values : np.array):
+        """Append rows, full chunks being compressed in the background
+
+        Parameters
+        ----------
+        values : np.array
+            Rows of shape (number_of_rows, ) + shape
+        """
+        values = np.asarray(values, dtype=self.dtype)
+        self.rows += len(values)
+        n = self._n_buffered
+        if n == 0 and len(values) >= self.chunk_len:
+            full = len(values) - len(values) % self.chunk_len
+            for start in range(0, full, self.chunk_len):
+                self._submit(values[start:start + self.chunk_len].copy())
+            values = values[full:]
+        while len(values):
+            k = min(self.chunk_len - n, len(values))
+            self._buffer[n:n + k] = values[:k]
+            values, n = values[k:], n + k
+            if n == self.chunk_len:
+                self._submit(self._buffer.copy())
+                n = 0
+        self._n_buffered = n
+
+    def _drain(self):
+        while self._pending:
+            self._store(*self._pending.popleft().result())
+        self._file.flush()
+
+    def _write_index(self):
+        tmp = self.path + INDEX_SUFFIX + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'shape': [self.rows] + list(self.shape), 'dtype': self.dtype.str,
+                       'codec': self.codec.name, 'shuffle': self.shuffle, 'chunk_len': self.chunk_len,
+                       'chunks': self.chunks}, f)
+        os.replace(tmp, self.path + INDEX_SUFFIX)
+
+    def flush(self):
+        """Compress and write the buffered rows, as a last partial chunk, and the index"""
+        if self._n_buffered:
+            self._submit(self._buffer[:self._n_buffered].copy())
+            self._n_buffered = 0
+        self._drain()
+        self._write_index()
+
+    def checkpoint(self) -> dict:
+        """Write the full chunks appended so far, and save the rows of the partial
+        chunk uncompressed so the chunk layout does not depend on checkpoints
+
+        Return
+        ----------
+        state : dict
+            State from which writing can be resumed
+        """
+        self._drain()
+        if self._n_buffered:
+            tmp = self.path + '.tmp.npz'
+            np.savez(tmp, chunks=len(self.chunks), rows=self._buffer[:self._n_buffered])
+            os.replace(tmp, self.path + TAIL_SUFFIX)
+        self._write_index()
+        return {'chunks': len(self.chunks), 'tail': self._n_buffered}
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._file = None
+        if os.path.exists(self.path + TAIL_SUFFIX):
+            os.remove(self.path + TAIL_SUFFIX)
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+class ChunkedArray(object):
+    """
+    Reader of an array written by ChunkedWriter. Rows are read by decompressing the
+    chunks holding them, the last decompressed chunk being kept for sequential reads,
+    and large reads can decompress chunks in parallel.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Path of the data file
+    workers : int
+        Number of threads decompressing the chunks of a read. Default to 0
+    """
+    def __init__(self, path, workers=0):
+        self.path = path
+        self.workers = workers
+        with open(path + INDEX_SUFFIX, 'r') as f:
+            index = json.load(f)
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.codec = Codec(index['codec'])
+        self.shuffle = index['shuffle']
+        self.chunks = np.array(index['chunks'], dtype=np.int64).reshape(-1, 3)
+        self.starts = np.concatenate([[0], np.cumsum(self.chunks[:, 2])])
+        self._cached = (None, None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _chunk(self, c):
+        if self._cached[0] != c:
+            self._cached = (c, self._decode(c))
+        return self._cached[1]
+
+    def _decode(self, c):
+        offset, size, n = self.chunks[c]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = self.codec.decompress(f.read(size))
+        rows = unshuffle_bytes(data, self.dtype) if self.shuffle else np.frombuffer(data, dtype=self.dtype)
+        return rows.reshape((n, ) + self.shape[1:])
+
+    def read(self, start : int = 0, stop : int = None) -> np.array:
+        """Read consecutive rows
+
+        Parameters
+        ----------
+        start : int
+            First row. Default to 0
+        stop : int
+            End of the rows. Default to None (last row)
+
+        Return
+        ----------
+        rows : np.array
+        """
+        stop = len(self) if stop is None else stop
+        out = np.empty((max(stop - start, 0), ) + self.shape[1:], dtype=self.dtype)
+        if start >= stop:
+            return out
+        first = int(np.searchsorted(self.starts, start, side='right')) - 1
+        last = int(np.searchsorted(self.starts, stop, side='left'))
+        chunks = range(first, last)
+        if self.workers > 0 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                decoded = list(executor.map(self._decode, chunks))
+        else:
+            decoded = [self._chunk(c) for c in chunks]
+        for c, rows in zip(chunks, decoded):
+            low, high = max(start, self.starts[c]), min(stop, self.starts[c + 1])
+            out[low - start:high - start] = rows[low - self.starts[c]:high - self.starts[c]]
+        return out
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            return self.read(start, max(stop, start))
+        if isinstance(i, (int, np.integer)):
+            i = i + len(self) if i < 0 else i
+            if not 0 <= i < len(self):
+                raise IndexError('index {} is out of bounds for {} rows'.format(i, len(self)))
+            c = int(np.searchsorted(self.starts, i, side='right')) - 1
+            return self._chunk(c)[i - self.starts[c]]
+        ids = np.asarray(i)
+        return np.stack([self[int(k)] for k in ids]) if len(ids) else np.empty((0, ) + self.shape[1:], self.dtype)
@@ -0,0 +1,202 @@
+import os, json, hashlib
+import numpy as np
+
+DEDUP_MODES = ['drop', 'flag']
+
+def average_hash(images : np.array, size : int = 8) -> np.array:
+    """64-bit average hash of every image of a batch: the image is reduced to size x size
+    block means and every bit tells whether a block is brighter than the mean of the image.
+    Near-identical images have hashes differing by a few bits.
+
+    Parameters
+    ----------
+    images : np.array
+        Array of shape (N, ..., width, height), leading axes after the first one
+        (modalities, depth) are averaged
+    size : int
+        Number of blocks along each side, size * size has to be 64. Default to 8
+
+    Return
+    ----------
+    hashes : np.array
+        uint64 array of shape (N, )
+    """
+    n, h, w = images.shape[0], images.shape[-2], images.shape[-1]
+    images = images.reshape(n, -1, h, w).mean(axis=1, dtype=np.float64)
+    rows, cols = np.arange(size) * h // size, np.arange(size) * w // size
+    blocks = np.add.reduceat(np.add.reduceat(images, rows, axis=1), cols, axis=2)
+    blocks /= np.outer(np.diff(np.append(rows, h)), np.diff(np.append(cols, w)))
+    bits = blocks > blocks.mean(axis=(1, 2), keepdims=True)
+    return np.packbits(bits.reshape(n, -1), axis=1).view('>u8').ravel().astype(np.uint64)
+
+def label_hash(y : np.array, size : int = 8) -> np.array:
+    """64-bit hash of the tumor location of every ground truth slice of a batch,
+    each bit telling whether a block of the size x size grid contains tumor.
+
+    Parameters
+    ----------
+    y : np.array
+        Ground truth array of shape (N, ..., width, height)
+    size : int
+        Number of blocks along each side, size * size has to be 64. Default to 8
+
+    Return
+    ----------
+    hashes : np.array
+        uint64 array of shape (N, )
+    """
+    n, h, w = y.shape[0], y.shape[-2], y.shape[-1]
+    tumor = (y > 0).reshape(n, -1, h, w).any(axis=1)
+    rows, cols = np.arange(size) * h // size, np.arange(size) * w // size
+    blocks = np.logical_or.reduceat(np.logical_or.reduceat(tumor, rows, axis=1), cols, axis=2)
+    return np.packbits(blocks.reshape(n, -1), axis=1).view('>u8').ravel().astype(np.uint64)
+
+def slice_digests(x : np.array, y : np.array) -> list:
+    """Digest of the exact content of every slice of a batch
+
+    Parameters
+    ----------
+    x : np.array
+        MRI array of shape (N, ...)
+    y : np.array
+        Ground truth array of shape (N, ...)
+
+    Return
+    ----------
+    digests : list
+        Hexadecimal digests
+    """
+    return [hashlib.blake2b(x[i].tobytes() + y[i].tobytes(), digest_size=16).hexdigest() for i in range(len(x))]
+
+
+class SliceDeduplicator(object):
+    """
+    Detection of the duplicate slices of a split, processed case after case.
+    Every slice is fingerprinted with an average hash of its modalities, a hash of
+    its tumor location and a digest of its content. A slice is a duplicate of an
+    already kept slice when their digests are equal or, with a threshold, when their
+    tumor hashes are equal and their average hashes differ by at most `threshold` bits.
+    Candidates are looked up with locality sensitive hashing: the average hash is cut
+    in threshold + 1 bands, and two hashes within the threshold share at least one band.
+
+    Duplicates are dropped from the output or only flagged, and the mapping is appended
+    to an index file with one JSON line per case:
+    {"case": name, "slices": number of slices produced by the pipeline,
+     "written": slices written, in order, "duplicates": [{"slice", "of": [case, slice], "distance"}],
+     "fingerprints": [[slice, average hash, tumor hash, digest], ...] of the kept slices}
+    Slices are numbered in the output of the pipeline for their case, before any is dropped.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Path of the index file
+    mode : str
+        'drop' to remove duplicates from the output, 'flag' to only record them. Default to 'drop'
+    threshold : int
+        Maximum number of different bits of the average hashes of near duplicates.
+        Default to None (exact duplicates only)
+    cases : list
+        Names of the cases to keep from an existing index, the other ones are discarded.
+        Default to None (the index is rebuilt)
+    """
+    name = 'dedup_index.jsonl'
+
+    def __init__(self, path, mode='drop', threshold=None, cases=None):
+        if mode not in DEDUP_MODES:
+            raise ValueError('mode has to be in {}'.format(DEDUP_MODES))
+        if threshold is not None and not 0 <= threshold < 64:
+            raise ValueError('threshold has to be in [0, 64)')
+        self.path = path
+        self.mode = mode
+        self.threshold = threshold
+        self.dropped = 0
+        self._kept = []
+        self._digests = {}
+        n_bands = 0 if threshold is None else threshold + 1
+        bounds = [64 * i // max(n_bands, 1) for i in range(n_bands + 1)]
+        self._bands = [(low, (1 << (high - low)) - 1) for low, high in zip(bounds[:-1], bounds[1:])]
+        self._buckets = [{} for _ in self._bands]
+        entries = []
+        if cases is not None and os.path.isfile(path):
+            entries = self._read(path, set(cases))
+        with open(path + '.tmp', 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+                self._restore(entry)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _read(path, cases):
+        entries = {}
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry['case'] in cases:
+                        entries[entry['case']] = entry
+        return list(entries.values())
+
+    def _restore(self, entry):
+        for slice_id, image, tumor, digest in entry['fingerprints']:
+            self._keep((entry['case'], slice_id), int(image, 16), int(tumor, 16), digest)
+        self.dropped += len(entry['duplicates']) if self.mode == 'drop' else 0
+
+    def _keep(self, ref, image, tumor, digest):
+        self._kept.append((ref, image, tumor))
+        self._digests.setdefault(digest, len(self._kept) - 1)
+        for bucket, (shift, mask) in zip(self._buckets, self._bands):
+            bucket.setdefault(((image >> shift) & mask, tumor), []).append(len(self._kept) - 1)
+
+    def _match(self, image, tumor, digest):
+        if digest in self._digests:
+            return self._digests[digest], 0
+        best, distance = None, self.threshold
+        candidates = set()
+        for bucket, (shift, mask) in zip(self._buckets, self._bands):
+            candidates.update(bucket.get(((image >> shift) & mask, tumor), []))
+        for k in sorted(candidates):
+            d = bin(self._kept[k][1] ^ image).count('1')
+            if d < distance or best is None and d == distance:
+                best, distance = k, d
+        return best, distance
+
+    def filter(self, case : str, x : np.array, y : np.array) -> tuple:
+        """Find the duplicates of the slices of a case, among the slices kept so far and
+        the previous slices of the case, and append the case to the index
+
+        Parameters
+        ----------
+        case : str
+            Path of the case
+        x : np.array
+            MRI array of shape (number_of_slices, ...)
+        y : np.array
+            Ground truth array of shape (number_of_slices, ...)
+
+        Return
+        ----------
+        data : tuple
+            MRI array and ground truth without the duplicates in 'drop' mode, unchanged in 'flag' mode
+        """
+        name = os.path.basename(os.path.normpath(case))
+        images, tumors, digests = average_hash(x), label_hash(y), slice_digests(x, y)
+        keep = np.ones(len(x), dtype=bool)
+        duplicates, fingerprints = [], []
+        for i, (image, tumor, digest) in enumerate(zip(images.tolist(), tumors.tolist(), digests)):
+            k, distance = self._match(image, tumor, digest)
+            if k is None:
+                self._keep((name, i), image, tumor, digest)
+                fingerprints.append([i, '{:016x}'.format(image), '{:016x}'.format(tumor), digest])
+            else:
+                keep[i] = False
+                duplicates.append({'slice': i, 'of': list(self._kept[k][0]), 'distance': distance})
+        if self.mode == 'drop':
+            self.dropped += len(duplicates)
+            x, y = x[keep], y[keep]
+        written = np.flatnonzero(keep) if self.mode == 'drop' else np.arange(len(keep))
+        entry = {'case': name, 'slices': len(keep), 'written': written.tolist(),
+                 'duplicates': duplicates, 'fingerprints': fingerprints}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        return x, y
@@ -1,27 +1,218 @@
+import zlib
 import numpy as np
 import h5py
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .chunked import shuffle_bytes
 
 class HDF5Store(object):
-    def __init__(self, datapath, datasets, shapes, dtype, compression="gzip", chunk_len=1):
+    """
+    Append-only writer for HDF5 datasets sharing the same number of rows.
+    The file is kept open until `close` is called (or the `with` block exits),
+    rows are buffered in memory and written to disk in bulk.
+    With gzip compression and `workers`, chunks of rows are compressed by a thread
+    pool and written as is with write_direct_chunk, instead of being compressed by
+    HDF5 on the writing thread. The file is unchanged for readers.
+    ...
+
+    Attributes
+    ----------
+    datapath : str
+        Path of the HDF5 file
+    datasets : list
+        Names of the datasets
+    shapes : list
+        Shape of a single row of each dataset
+    dtype : list
+        Type of each dataset
+    compression : str
+        'gzip', 'lzf' or None/'none'. Default to 'gzip'
+    compression_opts : int
+        Compression level for gzip, in [0, 9]. Default to None (h5py default)
+    chunk_len : int
+        Number of rows per chunk, used when `chunks` is not given. Default to 1
+    chunks : list
+        Chunk shape of each dataset. Default to None
+    buffer_len : int
+        Number of rows buffered in memory before being written. Default to 256
+    state : dict
+        State returned by `checkpoint`. The existing file is reopened and rows written
+        after the checkpoint are dropped. Default to None (the file is truncated)
+    shuffle : bool
+        Whether to apply the HDF5 byte-shuffle filter before compression. Default to False
+    workers : int
+        Number of threads compressing gzip chunks, 0 to let HDF5 compress them. Default to 0
+    """
+    def __init__(self, datapath, datasets, shapes, dtype, compression="gzip", chunk_len=1,
+                 compression_opts=None, chunks=None, buffer_len=256, state=None, shuffle=False, workers=0):
         self.datapath = datapath
         self.datasets = datasets
         self.shapes = shapes
-        self.i = {datasets[0]: 0, datasets[1]: 0}
-        
-        with h5py.File(self.datapath, mode='w') as h5f:
-            for idx, i in enumerate(datasets):
-                self.dset = h5f.create_dataset(
+        self.i = {name: 0 for name in datasets}
+
+        if compression == 'none':
+            compression = None
+        if chunks is None:
+            chunks = [(chunk_len, ) + shape for shape in shapes]
+        self._executor = None
+        if workers > 0 and compression == 'gzip':
+            # Direct chunk writes need chunks spanning whole rows, and buffers holding whole chunks
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+            self._level = 4 if compression_opts is None else compression_opts
+            self._chunk_len = {name: chunk[0] for name, chunk in zip(datasets, chunks)}
+            if any(tuple(chunk[1:]) != tuple(shape) for chunk, shape in zip(chunks, shapes)):
+                raise ValueError('Parallel compression needs chunks spanning whole rows')
+
+        self._h5f = h5py.File(self.datapath, mode='w' if state is None else 'r+')
+        self._buffers, self._n_buffered = {}, {}
+        for idx, i in enumerate(datasets):
+            if state is None:
+                self.dset = self._h5f.create_dataset(
                     i,
                     shape=(0, ) + shapes[idx],
                     maxshape=(None, ) + shapes[idx],
                     dtype=dtype[idx],
                     compression=compression,
-                    chunks=(chunk_len, ) + shapes[idx])
-    
-    def append(self, dataset, values, shape):
-        with h5py.File(self.datapath, mode='a') as h5f:
-            dset = h5f[dataset]
-            dset.resize((self.i[dataset] + 1, ) + shape)
-            dset[self.i[dataset]] = [values]
-            self.i[dataset] += 1
-            h5f.flush()
\ No newline at end of file
+                    compression_opts=compression_opts,
+                    shuffle=shuffle,
+                    chunks=chunks[idx])
+            else:
+                self.dset = self._h5f[i]
+                self.dset.resize(state['rows'][i], axis=0)
+                self.i[i] = state['rows'][i]
+            length = buffer_len if self._executor is None else -(-buffer_len // chunks[idx][0]) * chunks[idx][0]
+            self._buffers[i] = np.empty((length, ) + shapes[idx], dtype=dtype[idx])
+            self._n_buffered[i] = 0
+            if self._executor is not None and state is not None:
+                # Reload the rows of the last partial chunk, which is rewritten when completed
+                n = self.i[i] % self._chunk_len[i]
+                self._buffers[i][:n] = self.dset[self.i[i] - n:self.i[i]]
+                self._n_buffered[i] = n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, dataset, values, shape=None):
+        """Append a single row to a dataset.
+
+        Parameters
+        ----------
+        dataset : str
+            Name of the dataset
+        values : np.array
+            Row to append
+        shape : tuple
+            Unused, kept for backward compatibility
+        """
+        self.append_batch(dataset, np.asarray(values)[np.newaxis])
+
+    def append_batch(self, dataset, values):
+        """Append several rows to a dataset.
+        Batches larger than the buffer are written directly.
+
+        Parameters
+        ----------
+        dataset : str
+            Name of the dataset
+        values : np.array
+            Rows to append, of shape (number_of_rows, ) + row shape
+        """
+        if self._executor is not None:
+            self._append_chunked(dataset, values)
+            return
+        buffer, n = self._buffers[dataset], self._n_buffered[dataset]
+        if n + len(values) > len(buffer):
+            self._flush(dataset)
+            n = 0
+        if len(values) >= len(buffer):
+            self._write(dataset, values)
+        else:
+            buffer[n:n + len(values)] = values
+            self._n_buffered[dataset] = n + len(values)
+        self.i[dataset] += len(values)
+
+    def flush(self):
+        """Write all buffered rows and flush the file."""
+        for dataset in self.datasets:
+            self._flush(dataset)
+        self._h5f.flush()
+
+    def checkpoint(self):
+        """Write buffered rows to disk.
+
+        Return
+        ----------
+        state : dict
+            State from which writing can be resumed
+        """
+        self.flush()
+        return {'rows': dict(self.i)}
+
+    def close(self):
+        """Write all buffered rows, trim the datasets to their final size and close the file."""
+        if not self._h5f:
+            return
+        for dataset in self.datasets:
+            self._flush(dataset)
+            self._h5f[dataset].resize(self.i[dataset], axis=0)
+        self._h5f.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _append_chunked(self, dataset, values):
+        buffer = self._buffers[dataset]
+        while len(values):
+            n = self._n_buffered[dataset]
+            k = min(len(buffer) - n, len(values))
+            buffer[n:n + k] = values[:k]
+            self._n_buffered[dataset] = n + k
+            self.i[dataset] += k
+            values = values[k:]
+            if n + k == len(buffer):
+                self._flush(dataset)
+
+    def _flush_chunked(self, dataset):
+        """Compress the buffered rows in parallel and write them as whole chunks. The rows
+        of a last partial chunk are written padded and kept in the buffer."""
+        n, chunk_len = self._n_buffered[dataset], self._chunk_len[dataset]
+        if n == 0:
+            return
+        buffer, dset = self._buffers[dataset], self._h5f[dataset]
+        start = self.i[dataset] - n
+        if self.i[dataset] > dset.shape[0]:
+            dset.resize(max(self.i[dataset], 2 * dset.shape[0]), axis=0)
+        shuffle = dset.shuffle
+        offsets = range(0, n, chunk_len)
+        chunks = self._executor.map(lambda k: self._encode(buffer[k:k + chunk_len], chunk_len, shuffle), offsets)
+        for k, data in zip(offsets, chunks):
+            dset.id.write_direct_chunk((start + k, ) + (0, ) * (dset.ndim - 1), data)
+        partial = n % chunk_len
+        buffer[:partial] = buffer[n - partial:n]
+        self._n_buffered[dataset] = partial
+
+    def _encode(self, rows, chunk_len, shuffle):
+        if len(rows) < chunk_len:
+            padded = np.zeros((chunk_len, ) + rows.shape[1:], dtype=rows.dtype)
+            padded[:len(rows)] = rows
+            rows = padded
+        return zlib.compress(shuffle_bytes(rows) if shuffle else rows.tobytes(), self._level)
+
+    def _flush(self, dataset):
+        if self._executor is not None:
+            self._flush_chunked(dataset)
+            return
+        n = self._n_buffered[dataset]
+        if n:
+            self._write(dataset, self._buffers[dataset][:n])
+            self._n_buffered[dataset] = 0
+
+    def _write(self, dataset, values):
+        dset = self._h5f[dataset]
+        start = self.i[dataset] - self._n_buffered[dataset]
+        stop = start + len(values)
+        if stop > dset.shape[0]:
+            dset.resize(max(stop, 2 * dset.shape[0]), axis=0)
+        dset[start:stop] = values
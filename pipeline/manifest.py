@@ -0,0 +1,157 @@
+import os, json, hashlib
+from functools import partial
+from glob import glob
+
+def describe(obj):
+    """JSON description of a pipeline operation or of its parameters,
+    stable across runs so it can be hashed.
+
+    Parameters
+    ----------
+    obj : object
+        Function, functools.partial, object or value to describe
+
+    Return
+    ----------
+    description : object
+        JSON serializable description
+    """
+    if isinstance(obj, partial):
+        return {'function': describe(obj.func),
+                'args': [describe(a) for a in obj.args],
+                'keywords': {k: describe(v) for k, v in sorted(obj.keywords.items())}}
+    if isinstance(obj, (list, tuple)):
+        return [describe(o) for o in obj]
+    if isinstance(obj, dict):
+        return {str(k): describe(v) for k, v in sorted(obj.items())}
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if callable(obj) and hasattr(obj, '__qualname__'):
+        return '{}.{}'.format(obj.__module__, obj.__qualname__)
+    if hasattr(obj, '__dict__'):
+        return {'class': describe(type(obj)), 'attributes': describe(vars(obj))}
+    return repr(obj)
+
+def config_hash(config : dict) -> str:
+    """Hash of a configuration
+
+    Parameters
+    ----------
+    config : dict
+        Configuration, see describe
+
+    Return
+    ----------
+    hash : str
+    """
+    return hashlib.sha1(json.dumps(describe(config), sort_keys=True).encode()).hexdigest()
+
+
+class RunManifest(object):
+    """
+    Record of the cases written by a run of the pipeline on one split.
+    For every case, the manifest stores the size and modification time of its
+    source files, where its output was written and its number of slices. Writers
+    that keep the whole split in one file also store the state from which they can
+    resume. The manifest is rewritten after every case so an interrupted run can be
+    resumed, and it is discarded when the configuration of the run changes.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Path of the manifest file
+    config : dict
+        Configuration of the run (pipeline operations, output format, ...)
+    """
+    name = 'run_manifest.json'
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = describe(config)
+        self.config_hash = config_hash(config)
+        self.cases = {}
+        self.state = None
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                manifest = json.load(f)
+            if manifest['config_hash'] == self.config_hash:
+                self.cases = manifest['cases']
+                self.state = manifest['state']
+
+    @staticmethod
+    def sources(case : str) -> list:
+        """Size and modification time of the source files of a case
+
+        Parameters
+        ----------
+        case : str
+            Path of the case
+
+        Return
+        ----------
+        sources : list
+        """
+        sources = []
+        for path in sorted(glob(os.path.join(case, '**/*.mha*'))):
+            stat = os.stat(path)
+            sources.append({'path': os.path.relpath(path, case), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size})
+        return sources
+
+    def is_current(self, case : str) -> bool:
+        """Whether a case was written with the same configuration and unchanged sources
+
+        Parameters
+        ----------
+        case : str
+            Path of the case
+        """
+        entry = self.cases.get(os.path.basename(case))
+        return entry is not None and entry['sources'] == self.sources(case)
+
+    def resumable(self, cases : list) -> bool:
+        """Whether a writer keeping the whole split in one container can resume from
+        the recorded state, i.e. all recorded cases still exist and are current
+
+        Parameters
+        ----------
+        cases : list
+            Paths of the cases of the split
+        """
+        names = {os.path.basename(case): case for case in cases}
+        return self.state is not None and all(
+            name in names and self.is_current(names[name]) for name in self.cases)
+
+    def record(self, case : str, output, slices : int, state : dict = None):
+        """Record a case once its output is on disk and save the manifest
+
+        Parameters
+        ----------
+        case : str
+            Path of the case
+        output : object
+            Location of the output of the case
+        slices : int
+            Number of slices written
+        state : dict
+            Writer state to resume from after this case. Default to None
+        """
+        self.cases[os.path.basename(case)] = {
+            'sources': self.sources(case),
+            'output': output,
+            'slices': slices
+        }
+        self.state = state
+        self.save()
+
+    def reset(self):
+        """Forget all recorded cases"""
+        self.cases = {}
+        self.state = None
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'config_hash': self.config_hash, 'config': self.config,
+                       'cases': self.cases, 'state': self.state}, f, indent=2)
+        os.replace(tmp, self.path)
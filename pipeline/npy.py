@@ -0,0 +1,293 @@
+import os, json, struct
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .chunked import ChunkedWriter, ChunkedArray
+
+HEADER_SIZE = 128
+
+def _write_header(f, dtype, shape):
+    """Write a version 1.0 .npy header padded to a fixed size,
+    so it can be rewritten in place once the final shape is known.
+    """
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    magic = np.lib.format.magic(1, 0)
+    header_len = HEADER_SIZE - len(magic) - 2
+    if len(header) + 1 > header_len:
+        raise ValueError('Shape {} does not fit in the .npy header'.format(shape))
+    f.seek(0)
+    f.write(magic + struct.pack('<H', header_len) + (header.ljust(header_len - 1) + '\n').encode('latin1'))
+
+def _chunked_state(state):
+    # States recorded before the partial chunks were kept only hold the number of chunks
+    return state if isinstance(state, dict) else {'chunks': state}
+
+
+class NPYStore(object):
+    """
+    Writer of a consolidated dataset made of one contiguous .npy file per dataset.
+    Cases are appended one after the other and an index maps every global slice
+    id to its (case, slice) pair. Files can be read with np.load(mmap_mode='r').
+    With a compression codec, every dataset is instead written as compressed chunks
+    to a `.chunks` file (see ChunkedWriter), read with ChunkedArray.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Directory in which the dataset is written
+    datasets : list
+        Names of the datasets, also used as file names
+    shapes : list
+        Shape of a single slice of each dataset
+    dtype : list
+        Type of each dataset
+    capacity : int
+        Expected number of slices. Files are pre-allocated to this size and trimmed
+        on close. Default to None
+    state : dict
+        State returned by `checkpoint`. The existing files are reopened and slices written
+        after the checkpoint are dropped. Default to None (the files are truncated)
+    compression : str
+        Codec of the chunks, see pipeline.chunked.CODECS. Default to None (plain .npy files)
+    compression_opts : int
+        Compression level. Default to None
+    chunk_len : int
+        Number of slices per compressed chunk. Default to 16
+    workers : int
+        Number of compression threads. Default to 0
+    """
+    index_name = 'index.npy'
+    cases_name = 'cases.json'
+    shards_name = 'npy_shards.json'
+
+    def __init__(self, path, datasets, shapes, dtype, capacity=None, state=None, compression=None,
+                 compression_opts=None, chunk_len=16, workers=0):
+        self.path = path
+        self.datasets = datasets
+        self.shapes = shapes
+        self.dtype = [np.dtype(d) for d in dtype]
+        self.cases = []
+        self.i = 0
+        self._index = []
+        self._files = []
+        self._chunked = []
+        if state is not None:
+            for case, n in zip(state['cases'], state['slices']):
+                self._add_index(case, n)
+        if compression not in (None, 'none'):
+            for k, (name, shape, d) in enumerate(zip(datasets, shapes, self.dtype)):
+                self._chunked.append(ChunkedWriter(
+                    os.path.join(path, '{}.chunks'.format(name)), shape, d, codec=compression,
+                    level=compression_opts, chunk_len=chunk_len, workers=workers,
+                    state=None if state is None else _chunked_state(state['chunks'][k])))
+            return
+        for name, shape, d in zip(datasets, shapes, self.dtype):
+            f = open(os.path.join(path, '{}.npy'.format(name)), 'wb' if state is None else 'r+b')
+            _write_header(f, d, (0, ) + shape)
+            f.seek(HEADER_SIZE + self.i * int(np.prod(shape)) * d.itemsize)
+            f.truncate()
+            if capacity and capacity > self.i:
+                f.truncate(HEADER_SIZE + capacity * int(np.prod(shape)) * d.itemsize)
+            self._files.append(f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append_case(self, case, values):
+        """Append all slices of a case.
+
+        Parameters
+        ----------
+        case : str
+            Name of the case
+        values : list
+            One array per dataset, of shape (number_of_slices, ) + slice shape
+        """
+        for f, v, d in zip(self._files, values, self.dtype):
+            np.ascontiguousarray(v, dtype=d).tofile(f)
+        for writer, v in zip(self._chunked, values):
+            writer.append(v)
+        self._add_index(case, len(values[0]))
+
+    def checkpoint(self):
+        """Write buffered slices to disk.
+
+        Return
+        ----------
+        state : dict
+            State from which writing can be resumed
+        """
+        for f in self._files:
+            f.flush()
+        state = {'cases': list(self.cases), 'slices': [len(index) for index in self._index]}
+        if self._chunked:
+            state['chunks'] = [writer.checkpoint() for writer in self._chunked]
+        return state
+
+    def _add_index(self, case, n):
+        self._index.append(np.stack([np.full(n, len(self.cases)), np.arange(n)], axis=1).astype(np.int32))
+        self.cases.append(case)
+        self.i += n
+
+    def close(self):
+        """Write the final shapes in the headers, trim the files and write the index."""
+        if not self._files and not self._chunked:
+            return
+        for f, shape, d in zip(self._files, self.shapes, self.dtype):
+            _write_header(f, d, (self.i, ) + shape)
+            f.truncate(HEADER_SIZE + self.i * int(np.prod(shape)) * d.itemsize)
+            f.close()
+        for writer in self._chunked:
+            writer.close()
+        self._files, self._chunked = [], []
+        index = np.concatenate(self._index) if self._index else np.zeros((0, 2), dtype=np.int32)
+        np.save(os.path.join(self.path, self.index_name), index)
+        with open(os.path.join(self.path, self.cases_name), 'w') as f:
+            json.dump(self.cases, f, indent=2)
+
+
+class NPYDataset(object):
+    """
+    Random access reader of a dataset written by NPYStore.
+    Arrays are memory-mapped, or read by chunks when compressed (see ChunkedArray),
+    so indexing a slice does not load the dataset in memory.
+    The dataset can also be the merge of several shards (see sharding.merge_npy),
+    whose arrays are read from the shard directories.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Directory of the dataset
+    datasets : list
+        Names of the datasets to read. Default to ['x', 'y']
+    """
+    def __init__(self, path, datasets=['x', 'y']):
+        self.path = path
+        self.shards = [path]
+        self.offsets = np.zeros(1, dtype=np.int64)
+        if os.path.isfile(os.path.join(path, NPYStore.shards_name)):
+            with open(os.path.join(path, NPYStore.shards_name), 'r') as f:
+                shards = json.load(f)
+            self.shards = [os.path.join(path, shard) for shard in shards['shards']]
+            self.offsets = np.cumsum([0] + shards['rows'][:-1])
+        self.shard_arrays = [[self._open(shard, name) for name in datasets] for shard in self.shards]
+        self.arrays = self.shard_arrays[0] if len(self.shards) == 1 else None
+        self.index = np.load(os.path.join(path, NPYStore.index_name))
+        with open(os.path.join(path, NPYStore.cases_name), 'r') as f:
+            self.cases = json.load(f)
+
+    @staticmethod
+    def _open(path, name):
+        chunked = os.path.join(path, '{}.chunks'.format(name))
+        if os.path.isfile(chunked):
+            return ChunkedArray(chunked)
+        return np.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if self.arrays is not None:
+            return tuple(a[i] for a in self.arrays)
+        if i < 0:
+            i += len(self)
+        shard = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return tuple(a[i - self.offsets[shard]] for a in self.shard_arrays[shard])
+
+    def case_slices(self, case):
+        """Global slice ids of a case.
+
+        Parameters
+        ----------
+        case : int
+            Position of the case in `cases`
+
+        Return
+        ----------
+        ids : slice
+        """
+        start, stop = np.searchsorted(self.index[:, 0], [case, case + 1])
+        return slice(int(start), int(stop))
+
+    def batch(self, ids, augmentation=None, rng=None) -> tuple:
+        """Read slices into contiguous arrays, augmented if an augmentation is given
+
+        Parameters
+        ----------
+        ids : np.array
+            Global slice ids
+        augmentation : pipeline.augmentations.Augmentation
+            Batched augmentation, e.g. RandomAugmentation. Default to None
+        rng : np.random.Generator
+            Random generator of the augmentation. Default to None
+
+        Return
+        ----------
+        batch : tuple
+            One array of shape (len(ids), ...) per dataset
+        """
+        ids = np.asarray(ids)
+        if self.arrays is not None:
+            order = np.argsort(ids)
+            arrays = [np.empty((len(ids), ) + a.shape[1:], dtype=a.dtype) for a in self.arrays]
+            for a, out in zip(self.arrays, arrays):
+                out[order] = a[ids[order]]
+        else:
+            arrays = [np.stack(values) for values in zip(*(self[int(i)] for i in ids))]
+        if augmentation is not None:
+            arrays[:2] = augmentation(arrays[0], arrays[1], rng)
+        return tuple(arrays)
+
+    def batches(self, batch_size : int, shuffle : bool = True, augmentation = None, seed : int = None,
+                epoch : int = 0, drop_remainder : bool = True, workers : int = 0):
+        """Iterate over the dataset by batches, augmenting them on the fly so only the
+        original slices are stored and every epoch sees new random augmentations.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of slices per batch
+        shuffle : bool
+            Whether to shuffle the slices. Default to True
+        augmentation : pipeline.augmentations.Augmentation
+            Batched augmentation of x and y, e.g. RandomAugmentation. Default to None
+        seed : int
+            Seed of the shuffling and augmentations, None for non reproducible batches. Default to None
+        epoch : int
+            Index of the epoch, combined with the seed so epochs differ. Default to 0
+        drop_remainder : bool
+            Whether to drop the last incomplete batch. Default to True
+        workers : int
+            Number of threads reading and augmenting the next batches, 0 to do it
+            in the current thread. Default to 0
+
+        Yield
+        ----------
+        batch : tuple
+            One array of shape (batch_size, ...) per dataset
+        """
+        seeds = np.random.SeedSequence(None if seed is None else [seed, epoch])
+        ids = np.arange(len(self))
+        if shuffle:
+            np.random.default_rng(seeds.spawn(1)[0]).shuffle(ids)
+        stop = len(ids) - len(ids) % batch_size if drop_remainder else len(ids)
+        jobs = [(ids[i:i + batch_size], np.random.default_rng(child))
+                for i, child in zip(range(0, stop, batch_size), seeds.spawn(-(-stop // batch_size)))]
+        if workers == 0:
+            for batch_ids, rng in jobs:
+                yield self.batch(batch_ids, augmentation, rng)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for batch_ids, rng in jobs:
+                pending.append(executor.submit(self.batch, batch_ids, augmentation, rng))
+                if len(pending) > workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
@@ -1,21 +1,280 @@
-import os
-from .processing import get_scans, convert_scans
+import os, queue, inspect, threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from .processing import get_scans, convert_scans, slabs
+from .manifest import describe
+from .profiling import PipelineProfiler
 from glob import glob
 
+def _run_case(operations : list, case : str, profiler : PipelineProfiler = None, pool = None):
+    """Apply the chain of operations to a single case.
+    Module level so it can be pickled and sent to a worker process.
+
+    Parameters
+    ----------
+    operations : list
+        List of pipeline operations
+    case : str
+        Path of the MRI case to process
+    profiler : PipelineProfiler
+        Profiler instrumenting the operations. Default to None
+    pool : BufferPool
+        Buffer pool of the worker. The buffers of the previous case, already sent
+        back to the main process, are released before processing. Default to None
+
+    Return
+    ----------
+    results : list
+        All items produced by the last operation for this case
+    state : dict
+        Measurements of the profiler for this case, None without profiler
+    """
+    source = [case]
+    if pool is not None:
+        pool.release_all()
+    if profiler is not None:
+        operations = profiler.instrument(operations)
+    for ops in operations:
+        source = ops(source)
+    results = list(source)
+    return results, None if profiler is None else profiler.state()
+
+_DONE = object()
+
+class _StageError(object):
+    """Exception raised by a stage, forwarded downstream through the queues"""
+    def __init__(self, error):
+        self.error = error
+
+def _put(out : queue.Queue, item, stop : threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _drain(source : queue.Queue, stop : threading.Event):
+    """Iterate over the items put in a queue by the previous stage"""
+    while not stop.is_set():
+        try:
+            item = source.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        if isinstance(item, _StageError):
+            raise item.error
+        yield item
+
+def _run_stage(ops : callable, source, out : queue.Queue, stop : threading.Event):
+    """Run an operation in its own thread, putting its items in a bounded queue.
+
+    Parameters
+    ----------
+    ops : callable
+        Pipeline operation
+    source : iterable
+        Input of the operation
+    out : queue.Queue
+        Queue read by the next stage
+    stop : threading.Event
+        Set when the consumer stops early
+    """
+    try:
+        for item in ops(source):
+            if not _put(out, item, stop):
+                return
+    except BaseException as e:
+        _put(out, _StageError(e), stop)
+    else:
+        _put(out, _DONE, stop)
+
 class BraTSPipeline(object):
-    
-    def __init__(self, data_path):
-        
+    """
+    Pipeline reading BraTS cases and applying a chain of operations to them.
+    ...
+
+    Attributes
+    ----------
+    data_path : str
+        Path of the dataset, containing one folder per split when no split is given
+    cache : VolumeCache
+        Cache of decoded volumes used by convert_scans. Default to None
+    slice_policy : str
+        Slice selection policy of convert_scans, see processing.select_slices. Default to 'tumor'
+    background_ratio : float
+        Ratio of background slices kept by convert_scans. Default to 0
+    split : dict
+        Split of the cases, see utils.io.create_split. Cases are then read in place
+        from the original layout. Default to None
+    slab_depth : int
+        Volumetric mode: every case is read as a contiguous range of slices (from the first to
+        the last slice selected by the policy) and the pipeline emits blocks of slab_depth
+        consecutive slices of shape (4, slab_depth, width, height), see processing.slabs.
+        Default to None (independent slices)
+    slab_stride : int
+        Slices between the first slices of two blocks. Default to None (slab_depth)
+    slab_pad : bool
+        Pad the last block of a case with empty slices instead of dropping it. Default to False
+    pool : BufferPool
+        Pool of reusable arrays given to the operations accepting a `pool` argument, which
+        then allocate their outputs from it instead of allocating new arrays for every case.
+        Outputs of `process` are then only valid until the next one is requested. Default to None
+    """
+
+    def __init__(self, data_path, cache = None, slice_policy = 'tumor', background_ratio = 0., split = None,
+                 slab_depth = None, slab_stride = None, slab_pad = False, pool = None):
+
         self._data_path = data_path
-        self._operations = [get_scans, convert_scans]
-    
+        self._split = split
+        self._slice_policy = slice_policy
+        self._background_ratio = background_ratio
+        self._operations = [get_scans, partial(convert_scans, cache=cache, policy=slice_policy,
+                                               background_ratio=background_ratio, contiguous=slab_depth is not None)]
+        self.pool = pool
+        self._slabs = None
+        if slab_depth is not None:
+            self._slabs = partial(slabs, depth=slab_depth, stride=slab_stride, pad=slab_pad)
+
     def add_operation(self, ops : callable):
         if callable(ops):
             self._operations.append(ops)
-    
-    def process(self, mode : str):
-        source = glob(os.path.join(self._data_path, '{}/*'.format(mode)))
-        for ops in self._operations:
-            source = ops(source)
-        return source
-        
+
+    @property
+    def operations(self) -> list:
+        """Chain of operations applied to every case. In volumetric mode, the slices are
+        grouped into blocks after all the added operations."""
+        return self._operations + ([self._slabs] if self._slabs is not None else [])
+
+    def _pooled(self, operations : list) -> list:
+        """Give the buffer pool to the operations accepting one. Bound when processing,
+        so the pool is not part of the configuration."""
+        if self.pool is None:
+            return operations
+        return [partial(ops, pool=self.pool) if 'pool' in inspect.signature(ops).parameters else ops
+                for ops in operations]
+
+    def config(self) -> dict:
+        """Configuration of the pipeline, used to detect when outputs have to be rebuilt.
+        The volume cache is left out as it does not change the output.
+
+        Return
+        ----------
+        config : dict
+        """
+        return {
+            'slice_policy': self._slice_policy,
+            'background_ratio': self._background_ratio,
+            'operations': describe(self.operations[2:])
+        }
+
+    def cases(self, mode : str) -> list:
+        """List the cases of a split in a deterministic order.
+
+        Parameters
+        ----------
+        mode : str
+            Name of the split, e.g. 'training' or 'testing'
+
+        Return
+        ----------
+        cases : list
+            Case directories, in the order of the split or sorted
+        """
+        if self._split is not None:
+            return [os.path.join(self._data_path, case) for case in self._split['splits'][mode]]
+        return sorted(glob(os.path.join(self._data_path, '{}/*'.format(mode))))
+
+    def process(self, mode : str, workers : int = 0, max_in_flight : int = None, cases : list = None,
+                profiler : PipelineProfiler = None, staged : bool = False, queue_size : int = 2):
+        """Apply the pipeline to every case of a split.
+
+        Parameters
+        ----------
+        mode : str
+            Name of the split, e.g. 'training' or 'testing'
+        workers : int
+            Number of worker processes. Cases are processed in the current
+            process when set to 0. Default to 0.
+        max_in_flight : int
+            Maximum number of cases submitted to the pool and not yet consumed,
+            which caps the memory held by finished results. Default to 2 * workers.
+        cases : list
+            Cases to process instead of the whole split. Default to None
+        profiler : PipelineProfiler
+            Profiler instrumenting every operation. With workers, the measurements
+            of each case are merged into it as results are consumed. Default to None
+        staged : bool
+            Run every operation in its own thread, connected to the next one by a
+            bounded queue, so reading a case overlaps with processing and writing
+            the previous ones. Only without workers. Default to False
+        queue_size : int
+            Maximum number of items waiting between two stages. Default to 2
+
+        Yield
+        ----------
+        data : tuple
+            Output of the last operation, in case order. With a buffer pool and
+            without workers, arrays are only valid until the next item is requested
+        """
+        source = self.cases(mode) if cases is None else cases
+        if profiler is not None:
+            profiler.start()
+        if workers > 0:
+            if staged:
+                raise ValueError('Staged execution runs in a single process, set workers to 0')
+            return self._process_parallel(source, workers, max_in_flight or 2 * workers, profiler)
+        operations = self._pooled(self.operations)
+        operations = operations if profiler is None else profiler.instrument(operations)
+        if staged:
+            source = self._process_staged(source, operations, queue_size)
+        else:
+            for ops in operations:
+                source = ops(source)
+        return source if self.pool is None else self._released(source)
+
+    def _released(self, source):
+        """Release the arrays of every item once the next one is requested"""
+        for item in source:
+            yield item
+            self.pool.release(*item)
+
+    def _process_staged(self, cases : list, operations : list, queue_size : int):
+        stop = threading.Event()
+        source, threads = cases, []
+        for ops in operations:
+            out = queue.Queue(maxsize=queue_size)
+            threads.append(threading.Thread(target=_run_stage, args=(ops, source, out, stop), daemon=True))
+            source = _drain(out, stop)
+        for thread in threads:
+            thread.start()
+        try:
+            yield from source
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _process_parallel(self, cases : list, workers : int, max_in_flight : int, profiler : PipelineProfiler):
+        pending = deque()
+
+        def results(future):
+            results, state = future.result()
+            if profiler is not None:
+                profiler.merge(state)
+            return results
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            try:
+                for case in cases:
+                    if len(pending) >= max_in_flight:
+                        yield from results(pending.popleft())
+                    pending.append(executor.submit(_run_case, self._pooled(self.operations), case, profiler, self.pool))
+                while pending:
+                    yield from results(pending.popleft())
+            finally:
+                for future in pending:
+                    future.cancel()
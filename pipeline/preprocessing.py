@@ -0,0 +1,82 @@
+import numpy as np
+
+def one_hot(y : np.array, n_classes : int = 5, axis : int = 1, dtype = np.uint8) -> np.array:
+    """One-hot encoding of a whole block of ground truth at once,
+    e.g. (N, H, W) labels to (N, n_classes, H, W)
+
+    Parameters
+    ----------
+    y : np.array
+        Integer labels
+    n_classes : int
+        Number of classes. Labels outside [0, n_classes) are encoded as zeros. Default to 5
+    axis : int
+        Position of the class axis in the output. Default to 1
+    dtype : np.dtype
+        Type of the output. Default to np.uint8
+
+    Return
+    ----------
+    target : np.array
+        One-hot encoded labels
+    """
+    y = np.asarray(y)
+    axis = axis % (y.ndim + 1)
+    classes = np.arange(n_classes).reshape((-1,) + (1,) * (y.ndim - axis))
+    target = np.empty(y.shape[:axis] + (n_classes,) + y.shape[axis:], dtype=np.bool_)
+    np.equal(np.expand_dims(y, axis), classes, out=target)
+    if np.dtype(dtype).itemsize == 1 and np.dtype(dtype).kind in 'ui':
+        return target.view(dtype)
+    return target.astype(dtype)
+
+def l2_normalize(x : np.array, axis : int = 1, out : np.array = None) -> np.array:
+    """Divide x by its L2 norm along an axis, leaving zero vectors unchanged.
+    Same result as tf.keras.utils.normalize, without the temporary array of squares.
+
+    Parameters
+    ----------
+    x : np.array
+        Float array, e.g. MRI slices of shape (N, C, H, W)
+    axis : int
+        Axis along which the norm is computed. Default to 1 (modalities)
+    out : np.array
+        Output array, can be x to normalize in place. Default to None
+
+    Return
+    ----------
+    x : np.array
+        Normalized array
+    """
+    moved = np.moveaxis(x, axis, 0)
+    norm = np.sqrt(np.einsum('i...,i...->...', moved, moved))
+    norm[norm == 0] = 1
+    return np.divide(x, np.expand_dims(norm, axis), out=out)
+
+def minmax_normalize(x : np.array, axis : tuple = (1, 2, 3), out : np.array = None) -> np.array:
+    """Rescale x to [0, 1] with the minimum and maximum over some axes,
+    leaving constant blocks at 0.
+
+    Parameters
+    ----------
+    x : np.array
+        Float array, e.g. MRI slices of shape (N, C, H, W)
+    axis : tuple
+        Axes of the reduction. Default to (1, 2, 3), i.e. per slice
+    out : np.array
+        Output array, can be x to normalize in place. Default to None
+
+    Return
+    ----------
+    x : np.array
+        Normalized array
+    """
+    low = x.min(axis=axis, keepdims=True)
+    scale = x.max(axis=axis, keepdims=True) - low
+    scale[scale == 0] = 1
+    out = np.subtract(x, low, out=out)
+    return np.divide(out, scale, out=out)
+
+NORMALIZATIONS = {
+    'l2': l2_normalize,
+    'minmax': minmax_normalize
+}
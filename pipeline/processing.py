@@ -1,7 +1,7 @@
-import os, cv2
+import os
 import numpy as np
-import SimpleITK as sitk
-from .augmentations import aug_operations
+from numpy.lib.stride_tricks import as_strided
+from .augmentations import aug_operations, case_rng
 from glob import glob
 
 def get_scans(source : list) -> list:
@@ -22,69 +22,424 @@ def get_scans(source : list) -> list:
         scans.sort()
         yield scans
         
-def convert_scans(source : list) -> tuple:
+def read_volumes(scans : list, cache = None):
+    """Yield the decoded volume of each .mha file.
+    Volumes are views on memory owned by SimpleITK or by the cache and are only
+    valid until the next volume is requested, they have to be copied by the caller.
+    
+    Parameters
+    ----------
+    scans : list
+        List of .mha files
+    cache : VolumeCache
+        Cache of decoded volumes consulted before reading a file. Default to None
+        
+    Yield
+    ----------
+    volume : np.array
+        Volume of shape (number_of_slices, width, height)
+    """
+    import SimpleITK as sitk
+    for path in scans:
+        volume = cache.get(path) if cache is not None else None
+        if volume is None:
+            image = sitk.ReadImage(path)
+            volume = sitk.GetArrayViewFromImage(image)
+            if cache is not None:
+                cache.put(path, volume)
+        yield volume
+
+def read_case(scans : list, cache = None, pool = None) -> tuple:
+    """Read the 4 sequences and the ground truth of a case.
+    Sequences are written directly into a pre-allocated float32 array.
+    
+    Parameters
+    ----------
+    scans : list
+        List of .mha files, the ground truth being the last one
+    cache : VolumeCache
+        Cache of decoded volumes consulted before reading a file. Default to None
+    pool : BufferPool
+        Pool from which the arrays are acquired. Default to None
+        
+    Return
+    ----------
+    data : tuple
+        MRI array of shape (number_of_slices, 4, width, height) and 
+        Ground truth array of shape (number_of_slices, width, height)
+    """
+    x = y = None
+    for idx, volume in enumerate(read_volumes(scans, cache)):
+        if idx == len(scans) - 1:
+            y = np.array(volume) if pool is None else pool.acquire(volume.shape, volume.dtype)
+            if pool is not None:
+                y[...] = volume
+        else:
+            if x is None:
+                shape = (volume.shape[0], len(scans) - 1) + volume.shape[1:]
+                x = np.empty(shape, dtype='float32') if pool is None else pool.acquire(shape, 'float32')
+            x[:, idx] = volume
+    return (x, y)
+
+SLICE_POLICIES = ['tumor', 'brain', 'all']
+
+def select_slices(x : np.ndarray, y : np.ndarray, policy : str = 'tumor', background_ratio : float = 0.,
+                  contiguous : bool = False) -> np.ndarray:
+    """Select the slices of a case to keep.
+    
+    Parameters
+    ----------
+    x : np.ndarray
+        MRI array of shape (number_of_slices, 4, width, height)
+    y : np.ndarray
+        Ground truth array of shape (number_of_slices, width, height)
+    policy : str
+        'tumor' keeps slices with a non-zero ground truth, 'brain' slices where any
+        sequence is non-zero and 'all' every slice. Default to 'tumor'
+    background_ratio : float
+        With the 'tumor' policy, number of brain slices without tumor to keep as a
+        ratio of the number of tumor slices. They are evenly spread over the case. Default to 0
+    contiguous : bool
+        Keep every slice from the first to the last selected one, as needed by volumetric
+        blocks. Default to False
+    Return
+    ----------
+    indices : np.ndarray
+        Sorted indices of the selected slices
+    """
+    if policy not in SLICE_POLICIES:
+        raise ValueError('policy has to be in {}'.format(SLICE_POLICIES))
+    if contiguous:
+        indices = select_slices(x, y, policy, background_ratio)
+        return np.arange(indices[0], indices[-1] + 1) if len(indices) else indices
+    if policy == 'all':
+        return np.arange(len(y))
+    if policy == 'brain':
+        return np.flatnonzero(np.any(x, axis=(1, 2, 3)))
+    keep = np.any(y, axis=(1, 2))
+    n_background = int(round(background_ratio * keep.sum()))
+    if n_background:
+        background = np.flatnonzero(np.any(x, axis=(1, 2, 3)) & ~keep)
+        n_background = min(n_background, len(background))
+        keep[background[np.linspace(0, len(background) - 1, n_background).round().astype(int)]] = True
+    return np.flatnonzero(keep)
+
+def convert_scans(source : list, cache = None, policy : str = 'tumor', background_ratio : float = 0.,
+                  contiguous : bool = False, pool = None) -> tuple:
     """Convert MRI data into an np.array
-    by reading .mha files and deleting empty slices.
+    by reading .mha files and deleting slices according to a selection policy.
     
     Parameters
     ----------
     source : list
         List of .mha file to convert to numpy arrays
+    cache : VolumeCache
+        Cache of decoded volumes consulted before reading a file. Default to None
+    policy : str
+        Slice selection policy, see select_slices. Default to 'tumor'
+    background_ratio : float
+        Ratio of background slices to keep, see select_slices. Default to 0
+    contiguous : bool
+        Keep a contiguous range of slices, see select_slices. Default to False
+    pool : BufferPool
+        Pool of the arrays of the cases. The selected slices are then moved to the
+        front of the arrays in place instead of being copied. Default to None
         
     Yield
     ----------
     data : tuple
-        Data tuple containing MRI array of shape (4, number_of_slices, width, height) and 
+        Data tuple containing MRI array of shape (number_of_slices, 4, width, height) and 
         Ground truth array of shape (number_of_slices, width, height)
     """
     for scan in source:
-        dataset = np.array([sitk.GetArrayFromImage(sitk.ReadImage(s)) for s in scan])
-        x = np.squeeze(dataset[:len(dataset)-1])
-        y = dataset[-1]
-        non_zero_indices = list(set(np.nonzero(y)[0]))
-        y = y[list(non_zero_indices)]
-        x = np.array([i[list(non_zero_indices)] for i in x])
-        yield (np.moveaxis(x.astype('float32'), 0, 1), y)
-
-def resize(source : tuple, x_bound : int = 56, y_bound : int = 184) -> tuple:
+        x, y = read_case(scan, cache, pool)
+        indices = select_slices(x, y, policy, background_ratio, contiguous)
+        if len(indices) == len(y):
+            yield (x, y)
+        elif pool is not None:
+            for k, i in enumerate(indices):
+                if k != i:
+                    x[k], y[k] = x[i], y[i]
+            yield (x[:len(indices)], y[:len(indices)])
+        else:
+            yield (x[indices], y[indices])
+
+def resize(source : tuple, x_bound : int = 56, y_bound : int = 184, box : tuple = None, copy : bool = False) -> tuple:
     """Resize slices of dataset X and ground truth Y.
     By default slices are cropped from the bounds 56 and 184 giving slices of dimension 128x128.
+    The crop is a strided view on the input arrays, no data is copied unless `copy` is set.
     
     Parameters
     ----------
     data : tuple
-        Data tuple containing MRI array of shape (4, number_of_slices, width, height) and 
+        Data tuple containing MRI array of shape (number_of_slices, 4, width, height) and 
         Ground truth array of shape (number_of_slices, width, height)
     x_bound : int
         X axis bound. Default to 56
     y_bound : int
         Y axis bound. Default to 184
+    box : tuple
+        Per-axis crop box ((row_start, row_stop), (col_start, col_stop)).
+        Overrides x_bound and y_bound when given. Default to None
+    copy : bool
+        Return C-contiguous copies instead of views. Default to False
     Return
     ----------
     resized_data : tuple
         Resized dataset
     """
-    for data in source:
-        x_resized = []
-        x, y = data
-        for sequence in x:
-            x_resized.append(np.array([slc[x_bound:y_bound, x_bound:y_bound] for slc in sequence]))
-        y_resized = np.array([slc[x_bound:y_bound, x_bound:y_bound] for slc in y])
+    if box is None:
+        box = ((x_bound, y_bound), (x_bound, y_bound))
+    for x, y in source:
+        yield crop(x, y, box, copy)
+
+def crop(x : np.ndarray, y : np.ndarray, box : tuple, copy : bool = False) -> tuple:
+    """Crop the last two axes of X and Y to a box.
+    
+    Parameters
+    ----------
+    x : np.ndarray
+        MRI array of shape (..., width, height)
+    y : np.ndarray
+        Ground truth array of shape (..., width, height)
+    box : tuple
+        Crop box ((row_start, row_stop), (col_start, col_stop))
+    copy : bool
+        Return C-contiguous copies instead of views. Default to False
+    Return
+    ----------
+    cropped_data : tuple
+        Cropped X and Y
+    """
+    (r0, r1), (c0, c1) = box
+    x, y = x[..., r0:r1, c0:c1], y[..., r0:r1, c0:c1]
+    if copy:
+        x, y = np.ascontiguousarray(x), np.ascontiguousarray(y)
+    return (x, y)
+
+def brain_bbox(x : np.ndarray, margin : int = 0) -> tuple:
+    """Compute the bounding box of the non-zero voxels of an MRI array over its last two axes.
+    
+    Parameters
+    ----------
+    x : np.ndarray
+        MRI array of shape (..., width, height)
+    margin : int
+        Number of background pixels kept around the brain. Default to 0
+    Return
+    ----------
+    box : tuple
+        Crop box ((row_start, row_stop), (col_start, col_stop)). The whole
+        slice is returned when the array is empty.
+    """
+    height, width = x.shape[-2:]
+    mask = np.any(x, axis=tuple(range(x.ndim - 2)))
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return ((0, height), (0, width))
+    return ((max(rows[0] - margin, 0), min(rows[-1] + 1 + margin, height)),
+            (max(cols[0] - margin, 0), min(cols[-1] + 1 + margin, width)))
+
+def _center_box(box : tuple, size : tuple, shape : tuple) -> tuple:
+    centered = []
+    for (start, stop), length, bound in zip(box, size, shape):
+        start = min(max((start + stop - length) // 2, 0), max(bound - length, 0))
+        centered.append((start, min(start + length, bound)))
+    return tuple(centered)
+
+def brain_crop(source : tuple, margin : int = 0, size : tuple = None, copy : bool = False) -> tuple:
+    """Crop slices of dataset X and ground truth Y to the bounding box of the brain.
+    The box is computed per case from the non-zero voxels of all sequences.
+    
+    Parameters
+    ----------
+    source : tuple
+        Data tuple containing MRI array of shape (number_of_slices, 4, width, height) and 
+        Ground truth array of shape (number_of_slices, width, height)
+    margin : int
+        Number of background pixels kept around the brain. Default to 0
+    size : tuple
+        Fixed (width, height) of the crop, centered on the brain. Cases then share
+        the same slice shape, as required by the h5 and tfrecord writers. Default to None
+    copy : bool
+        Return C-contiguous copies instead of views. Default to False
+    Yield
+    ----------
+    cropped_data : tuple
+        Cropped dataset
+    """
+    for x, y in source:
+        box = brain_bbox(x, margin)
+        if size is not None:
+            box = _center_box(box, size, x.shape[-2:])
+        yield crop(x, y, box, copy)
 
-        yield (np.array(x_resized), y_resized)
+def label_index(x : np.ndarray, y : np.ndarray, n_labels : int = 5) -> list:
+    """Locations of the voxels of every label of a case, computed once per case
+    to sample patch centers.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        MRI array of shape (number_of_slices, 4, width, height)
+    y : np.ndarray
+        Ground truth array of shape (number_of_slices, width, height)
+    n_labels : int
+        Number of labels. Default to 5
+    Return
+    ----------
+    index : list
+        Flat indices in y of the voxels of each label. Label 0 is restricted to the
+        brain so background patches are not drawn outside the head.
+    """
+    index = [np.flatnonzero((y == 0) & np.any(x, axis=1))]
+    return index + [np.flatnonzero(y == label) for label in range(1, n_labels)]
+
+def _windows(a : np.ndarray, size : int, depth : int = None) -> np.ndarray:
+    """Read-only strided view of all the size x size windows of an array of shape
+    (number_of_slices, ..., width, height), spanning `depth` slices when given.
+    The view is indexed by the first slice, row and column of the window, followed
+    by the axes of a single patch (..., [depth], size, size)."""
+    n, h, w = a.shape[0], a.shape[-2], a.shape[-1]
+    span = (depth, ) if depth else ()
+    shape = (n - (depth or 1) + 1, h - size + 1, w - size + 1) + a.shape[1:-2] + span + (size, size)
+    strides = (a.strides[0], a.strides[-2], a.strides[-1]) + a.strides[1:-2] + \
+        (a.strides[0], ) * len(span) + (a.strides[-2], a.strides[-1])
+    return as_strided(a, shape=shape, strides=strides, writeable=False)
+
+def extract_patches(source : tuple, size : int = 64, n_patches : int = 32, rates : tuple = (0.2, 0.2, 0.2, 0.2, 0.2),
+                    depth : int = None, seed : int = None, pool = None) -> tuple:
+    """Extract fixed-size patches centered on voxels sampled per label.
+    Patch centers are drawn from the voxel locations of each label (see label_index)
+    with the given rates, labels absent from a case sharing its patches among the
+    others. Patches are gathered at once from a strided view of the case.
+
+    Parameters
+    ----------
+    source : tuple
+        Data tuple containing MRI array of shape (number_of_slices, 4, width, height) and
+        Ground truth array of shape (number_of_slices, width, height)
+    size : int
+        Width and height of the patches. Default to 64
+    n_patches : int
+        Number of patches per case. Default to 32
+    rates : tuple
+        Fraction of the patches centered on each label, label 0 being the brain
+        outside the tumor. Default to (0.2, 0.2, 0.2, 0.2, 0.2)
+    depth : int
+        Number of consecutive slices of 3D patches, which requires a slice policy
+        keeping contiguous slices ('brain' or 'all'). Default to None (2D patches)
+    seed : int
+        Seed making the sampling of each case reproducible. Default to None
+    pool : BufferPool
+        Pool from which the patches are acquired, the case being released. Default to None
+
+    Yield
+    ----------
+    patches : tuple
+        MRI patches of shape (n_patches, 4, [depth], size, size) and
+        ground truth patches of shape (n_patches, [depth], size, size)
+    """
+    rates = np.asarray(rates, dtype=float)
+    for x, y in source:
+        rng = case_rng(seed, y)
+        index = label_index(x, y, len(rates))
+        weights = rates * np.array([len(locations) > 0 for locations in index])
+        if n_patches <= 0 or weights.sum() == 0 or len(y) < (depth or 1):
+            centers = np.zeros(0, dtype=int)
+        else:
+            counts = rng.multinomial(n_patches, weights / weights.sum())
+            centers = np.concatenate([locations[rng.integers(len(locations), size=count)]
+                                      for locations, count in zip(index, counts) if count])
+        n, r, c = np.unravel_index(centers, y.shape)
+        n = np.clip(n - (depth or 1) // 2, 0, len(y) - (depth or 1))
+        r = np.clip(r - size // 2, 0, y.shape[1] - size)
+        c = np.clip(c - size // 2, 0, y.shape[2] - size)
+        if pool is None:
+            yield (_windows(x, size, depth)[n, r, c], _windows(y, size, depth)[n, r, c])
+            continue
+        x_windows, y_windows = _windows(x, size, depth), _windows(y, size, depth)
+        x_out = pool.acquire((len(n), ) + x_windows.shape[3:], x.dtype)
+        y_out = pool.acquire((len(n), ) + y_windows.shape[3:], y.dtype)
+        for k in range(len(n)):
+            x_out[k], y_out[k] = x_windows[n[k], r[k], c[k]], y_windows[n[k], r[k], c[k]]
+        pool.release(x, y)
+        yield (x_out, y_out)
 
-def augment(source : tuple, augmentations = aug_operations, augment_ratio=0.1):
+def slabs(source : tuple, depth : int = 16, stride : int = None, pad : bool = False, pool = None) -> tuple:
+    """Group consecutive slices into fixed-depth volumetric blocks. Slices have to be
+    contiguous (see select_slices). Every block is copied to a contiguous array so it
+    is contiguous in the files written from it.
+
+    Parameters
+    ----------
+    source : tuple
+        Data tuple containing MRI array of shape (number_of_slices, 4, width, height) and
+        Ground truth array of shape (number_of_slices, width, height)
+    depth : int
+        Number of slices of a block. Default to 16
+    stride : int
+        Number of slices between the first slices of two blocks. Default to None (depth,
+        blocks do not overlap)
+    pad : bool
+        Pad the end of the case with empty slices so every slice is in a block, otherwise
+        the last slices not filling a block are dropped. Default to False
+    pool : BufferPool
+        Pool from which the blocks are acquired, the case being released. Default to None
+
+    Yield
+    ----------
+    blocks : tuple
+        MRI blocks of shape (number_of_blocks, 4, depth, width, height) and
+        ground truth blocks of shape (number_of_blocks, depth, width, height)
+    """
+    stride = stride or depth
+    for x, y in source:
+        n = len(y)
+        if pad and n > 0:
+            n_blocks = max(-(-(n - depth) // stride), 0) + 1
+        else:
+            n_blocks = max((n - depth) // stride + 1, 0)
+        x_shape = (n_blocks, x.shape[1], depth) + x.shape[2:]
+        y_shape = (n_blocks, depth) + y.shape[1:]
+        if pool is None:
+            x_out, y_out = np.empty(x_shape, dtype=x.dtype), np.empty(y_shape, dtype=y.dtype)
+        else:
+            x_out, y_out = pool.acquire(x_shape, x.dtype), pool.acquire(y_shape, y.dtype)
+        for b in range(n_blocks):
+            rows = slice(b * stride, min(b * stride + depth, n))
+            filled = rows.stop - rows.start
+            x_out[b, :, :filled] = x[rows].swapaxes(0, 1)
+            y_out[b, :filled] = y[rows]
+            x_out[b, :, filled:] = 0
+            y_out[b, filled:] = 0
+        if pool is not None:
+            pool.release(x, y)
+        yield (x_out, y_out)
+
+def augment(source : tuple, augmentations = aug_operations, augment_ratio=0.1, seed : int = None, mode : str = 'constant',
+            pool = None):
     """Apply augmentation operations to a ratio of the MRI data and ground truth.
+    Each operation augments the whole batch of sampled slices at once and writes
+    into an output array allocated once per case.
     
     Parameters
     ----------
     source : tuple
-        Data tuple containing MRI array of shape (4, number_of_slices, width, height) and 
+        Data tuple containing MRI array of shape (number_of_slices, 4, width, height) and 
         Ground truth array of shape (number_of_slices, width, height)
     augmentations : list
-        List of operations to perform
+        List of pipeline.augmentations.Augmentation to perform, each one producing
+        an augmented copy of the sampled slices
     augment_ratio : float, In [0, 1].
-        Ratio of the data to augment. Default to 0.30.
+        Ratio of the data to augment. Default to 0.1.
+    seed : int
+        Seed making the augmentation of each case reproducible. Default to None
+    mode : str
+        How points outside the slices are filled, see scipy.ndimage.map_coordinates.
+        Default to 'constant'
+    pool : BufferPool
+        Pool from which the output arrays are acquired, the input being released. Default to None
         
     Return
     ----------
@@ -93,22 +448,52 @@ def augment(source : tuple, augmentations = aug_operations, augment_ratio=0.1):
     """
     for data in source:
         x, y = data
-        aug_indices = np.random.randint(x.shape[0], size= int(x.shape[0] * augment_ratio))
-        augmented_slices = np.zeros((1, x.shape[1] + 1, x.shape[2], x.shape[3]))
-        for idx, (x_slc, y_slc) in enumerate(zip(x[aug_indices], y[aug_indices])):
-            x_slc, y_slc = x_slc[..., np.newaxis], y_slc[np.newaxis, ..., np.newaxis]
-            for f in augmentations:
-                x_y_augment = np.concatenate([x_slc, y_slc])
-                x_y_augment = np.squeeze(f(x_y_augment))
-                augmented_slices = np.concatenate([augmented_slices, x_y_augment[np.newaxis, ...]])
-        yield (np.concatenate([x, augmented_slices[:,:-1]]).astype('float32'), 
-               np.concatenate([y, augmented_slices[:,-1]]).astype('int8'))
-
-def normalize(source : tuple):
-    for data in source:
-        x, y = data
-        print(x.shape)
-        x *= 255.0 / x.max()
-        y = np.divide(y.astype('uint8'), 4)
-        x = np.moveaxis(x, 1, 3)
-        yield (x.astype('uint8'), y)
\ No newline at end of file
+        rng = case_rng(seed, y)
+        n, n_aug = len(x), int(len(x) * augment_ratio)
+        aug_indices = rng.integers(n, size=n_aug)
+        n_out = n + n_aug * len(augmentations)
+        if pool is None:
+            x_out = np.empty((n_out, ) + x.shape[1:], dtype='float32')
+            y_out = np.empty((n_out, ) + y.shape[1:], dtype='int8')
+        else:
+            x_out, y_out = pool.acquire((n_out, ) + x.shape[1:], 'float32'), pool.acquire((n_out, ) + y.shape[1:], 'int8')
+        x_out[:n], y_out[:n] = x, y
+        x_aug, y_aug = x[aug_indices], y[aug_indices]
+        if pool is not None:
+            pool.release(x, y)
+        for idx, f in enumerate(augmentations):
+            start = n + idx * n_aug
+            f(x_aug, y_aug, rng, out=(x_out[start:start + n_aug], y_out[start:start + n_aug]), mode=mode)
+        yield (x_out, y_out)
+
+def normalize(source : tuple, pool = None):
+    """Scale a case to [0, 255] by its maximum and convert it to channel last uint8,
+    the ground truth being divided by 4. Both are written directly to their outputs,
+    without intermediate copies.
+    
+    Parameters
+    ----------
+    source : tuple
+        Data tuple containing MRI array of shape (number_of_slices, 4, width, height) and 
+        Ground truth array of shape (number_of_slices, width, height)
+    pool : BufferPool
+        Pool from which the output arrays are acquired, the input being released. Default to None
+        
+    Yield
+    ----------
+    data : tuple
+        uint8 MRI array of shape (number_of_slices, width, height, 4) and
+        Ground truth array of shape (number_of_slices, width, height)
+    """
+    for x, y in source:
+        shape = (len(x), ) + x.shape[2:] + x.shape[1:2]
+        if pool is None:
+            x_out, y_out = np.empty(shape, dtype='uint8'), np.empty(y.shape, dtype='float64')
+        else:
+            x_out, y_out = pool.acquire(shape, 'uint8'), pool.acquire(y.shape, 'float64')
+        maximum = x.max() if x.size else 0
+        np.multiply(np.moveaxis(x, 1, 3), 255.0 / maximum if maximum > 0 else 0., out=x_out, casting='unsafe')
+        np.divide(y, 4, out=y_out)
+        if pool is not None:
+            pool.release(x, y)
+        yield (x_out, y_out)
\ No newline at end of file
@@ -0,0 +1,224 @@
+import os, json, time, marshal, cProfile, pstats, threading, tracemalloc
+from functools import partial
+
+def stage_name(ops : callable) -> str:
+    """Name of a pipeline operation"""
+    while isinstance(ops, partial):
+        ops = ops.func
+    return getattr(ops, '__name__', type(ops).__name__)
+
+def nbytes(item) -> int:
+    """Number of bytes of the arrays contained in an item produced by an operation"""
+    if hasattr(item, 'nbytes'):
+        return int(item.nbytes)
+    if isinstance(item, (list, tuple)):
+        return sum(nbytes(i) for i in item)
+    return 0
+
+def _merge_profile(target : dict, source : dict):
+    for func, stats in source.items():
+        target[func] = pstats.add_func_stats(target[func], stats) if func in target else stats
+
+
+class PipelineProfiler(object):
+    """
+    Instrumentation of the operations of a BraTSPipeline.
+    Each operation is wrapped to measure, every time it produces an item, the wall
+    time spent in the operation itself (excluding the upstream operations it pulls
+    from), the number of items consumed and produced, the number of bytes of the
+    produced arrays and optionally the memory it allocated. Operations can also be
+    profiled with one cProfile.Profile each.
+    ...
+
+    Attributes
+    ----------
+    memory : bool
+        Measure memory allocated by each operation with tracemalloc. Default to False
+    profile : bool
+        Profile each operation with cProfile. Default to False
+    hooks : list
+        Callables called with (stage_name, 'enter' or 'exit') around every step of an
+        operation, e.g. to annotate an external sampling profiler. Default to None
+    """
+    def __init__(self, memory=False, profile=False, hooks=None):
+        self.memory = memory
+        self.profile = profile
+        self.hooks = hooks or []
+        self.stages = {}
+        self.profiles = {}
+        self._live = {}
+        self._local = threading.local()
+        self._start = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(stages={}, profiles={}, _live={})
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def _active(self) -> list:
+        """Stages being stepped in the current thread, innermost last"""
+        return self._local.__dict__.setdefault('active', [])
+
+    def start(self):
+        """Start the wall clock of the run, if not started yet"""
+        if self._start is None:
+            self._start = time.perf_counter()
+
+    def instrument(self, operations : list) -> list:
+        """Wrap a chain of operations
+
+        Parameters
+        ----------
+        operations : list
+            Operations of the pipeline
+
+        Return
+        ----------
+        operations : list
+            Instrumented operations
+        """
+        self.start()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        names = []
+        for ops in operations:
+            name = stage_name(ops)
+            if name in names:
+                name = '{}#{}'.format(name, names.count(name) + 1)
+            names.append(name)
+            self.stages.setdefault(name, {'seconds': 0., 'inclusive_seconds': 0., 'items_in': 0,
+                                          'items_out': 0, 'bytes_out': 0, 'memory_bytes': 0})
+        return [partial(self._run, name, ops) for name, ops in zip(names, operations)]
+
+    def _run(self, name, ops, source):
+        stats = self.stages[name]
+        upstream = {'seconds': 0., 'memory': 0}
+        iterator = iter(ops(self._pull(source, stats, upstream)))
+        while True:
+            seconds, memory = upstream['seconds'], upstream['memory']
+            self._enter(name)
+            start, allocated = time.perf_counter(), self._allocated()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed = time.perf_counter() - start
+                stats['inclusive_seconds'] += elapsed
+                stats['seconds'] += elapsed - (upstream['seconds'] - seconds)
+                stats['memory_bytes'] += self._allocated() - allocated - (upstream['memory'] - memory)
+                self._exit(name)
+            stats['items_out'] += 1
+            stats['bytes_out'] += nbytes(item)
+            yield item
+
+    def _pull(self, source, stats, upstream):
+        iterator = iter(source)
+        while True:
+            start, allocated = time.perf_counter(), self._allocated()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                upstream['seconds'] += time.perf_counter() - start
+                upstream['memory'] += self._allocated() - allocated
+            stats['items_in'] += 1
+            yield item
+
+    def _allocated(self):
+        return tracemalloc.get_traced_memory()[0] if self.memory else 0
+
+    def _enter(self, name):
+        for hook in self.hooks:
+            hook(name, 'enter')
+        if self.profile:
+            if self._active:
+                self._live[self._active[-1]].disable()
+            self._live.setdefault(name, cProfile.Profile()).enable()
+        self._active.append(name)
+
+    def _exit(self, name):
+        self._active.pop()
+        if self.profile:
+            self._live[name].disable()
+            if self._active:
+                self._live[self._active[-1]].enable()
+        for hook in self.hooks:
+            hook(name, 'exit')
+
+    def state(self) -> dict:
+        """Measurements collected so far, to be merged in another profiler
+
+        Return
+        ----------
+        state : dict
+        """
+        for name, profile in self._live.items():
+            profile.create_stats()
+            _merge_profile(self.profiles.setdefault(name, {}), profile.stats)
+        self._live = {}
+        return {'stages': self.stages, 'profiles': self.profiles}
+
+    def merge(self, state : dict):
+        """Add the measurements of another profiler, e.g. from a worker process
+
+        Parameters
+        ----------
+        state : dict
+            Return value of `state`
+        """
+        self.start()
+        for name, stats in state['stages'].items():
+            if name not in self.stages:
+                self.stages[name] = dict(stats)
+            else:
+                for key, value in stats.items():
+                    self.stages[name][key] += value
+        for name, profile in state['profiles'].items():
+            _merge_profile(self.profiles.setdefault(name, {}), profile)
+
+    def report(self) -> dict:
+        """Per stage report of the run
+
+        Return
+        ----------
+        report : dict
+        """
+        stages = []
+        for name, stats in self.stages.items():
+            stage = dict(stats, name=name)
+            stage['mb_out'] = stats['bytes_out'] / 2 ** 20
+            stage['items_per_s'] = stats['items_out'] / stats['seconds'] if stats['seconds'] > 0 else None
+            if not self.memory:
+                del stage['memory_bytes']
+            stages.append(stage)
+        wall = time.perf_counter() - self._start if self._start is not None else 0.
+        return {'wall_seconds': wall, 'stages': stages}
+
+    def save(self, path : str, profile_dir : str = None):
+        """Write the report as JSON and the cProfile stats of every stage
+
+        Parameters
+        ----------
+        path : str
+            Path of the JSON report
+        profile_dir : str
+            Directory in which to write one .prof file per stage, readable with pstats
+            or snakeviz. Default to None (next to the report)
+        """
+        self.state()
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        if self.profiles:
+            profile_dir = profile_dir or os.path.dirname(path)
+            os.makedirs(profile_dir, exist_ok=True)
+            for name, profile in self.profiles.items():
+                with open(os.path.join(profile_dir, '{}.prof'.format(name.replace('#', '_'))), 'wb') as f:
+                    marshal.dump(profile, f)
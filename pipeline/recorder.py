@@ -1,6 +1,8 @@
+import os, json
 import tensorflow as tf
 import numpy as np
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+from .writers import LABEL_ENCODINGS, IMAGE_DTYPES, check_image_dtype
 
 class TFRecorder(object):
     """
@@ -32,10 +34,69 @@ class TFRecorder(object):
 
 
 class TrainingTFRecorder(TFRecorder):
-    
-    def __init__(self):
+    """
+    Class to write training examples
+    ...
+
+    Attributes
+    ----------
+    label_encoding : str
+        'int64' stores the ground truth as an Int64List, 'uint8' as raw bytes. Default to 'int64'
+    image_dtype : str
+        Type of the stored image bytes, 'float32', 'float16' or 'uint8'. Default to 'float32'
+    rescale : bool
+        Scale every slice to [0, 255] by its maximum before writing it. Disable it for
+        data already normalized by the pipeline. Default to True
+    """
+    label_encodings = LABEL_ENCODINGS
+    image_dtypes = IMAGE_DTYPES
+
+    def __init__(self, label_encoding='int64', image_dtype='float32', rescale=True):
         super().__init__()
+        if label_encoding not in self.label_encodings:
+            raise ValueError('label_encoding has to be in {}'.format(self.label_encodings))
+        check_image_dtype(image_dtype, rescale)
+        self.label_encoding = label_encoding
+        self.image_dtype = np.dtype(image_dtype)
+        self.rescale = rescale
+
+    def schema(self, x_shape, y_shape):
+        """Describe how examples are stored, as recorded in the shard manifest
+
+        Parameters
+        ----------
+        x_shape : tuple
+            Shape of a single MRI slice
+        y_shape : tuple
+            Shape of a single ground truth slice
+
+        Return
+        ----------
+        schema : dict
+        """
+        return {
+            'image': {'dtype': self.image_dtype.name, 'shape': list(x_shape)},
+            'ground_truth': {'encoding': self.label_encoding, 'shape': list(y_shape)}
+        }
     
+    def scale(self, x):
+        """Scale every slice to [0, 255] by its maximum, in place. Empty slices,
+        kept by the 'brain' and 'all' slice policies, are left at 0.
+
+        Parameters
+        ----------
+        x : np.array
+            MRI slices of shape (number_of_slices, width, height, 4)
+
+        Return
+        ----------
+        x : np.array
+            Scaled slices
+        """
+        maximum = x.max(axis=tuple(range(1, x.ndim)), keepdims=True)
+        factor = np.divide(255.0, maximum, out=np.zeros_like(maximum), where=maximum > 0)
+        return np.multiply(x, factor, out=x)
+
     def get_tf_example(self, x, y):
         """Convert data to tf.train.Example
     
@@ -51,10 +112,15 @@ class TrainingTFRecorder(TFRecorder):
         example : tf.train.Example
             Tensorflow example to save as tfrecord
         """
-        y = np.reshape(y, [y.shape[0]*y.shape[1]])
+        if self.image_dtype.kind == 'u':
+            x = np.rint(x)
+        if self.label_encoding == 'uint8':
+            ground_truth = self._bytes_feature(y.astype(np.uint8).tobytes())
+        else:
+            ground_truth = self._int64_feature(np.reshape(y, [y.shape[0]*y.shape[1]]))
         example = tf.train.Example(features=tf.train.Features(feature={
-            'image': self._bytes_feature(x.tobytes()),
-            'ground_truth': self._int64_feature(y)
+            'image': self._bytes_feature(x.astype(self.image_dtype).tobytes()),
+            'ground_truth': ground_truth
         }))
         return example
     
@@ -73,9 +139,176 @@ class TrainingTFRecorder(TFRecorder):
         example : tf.train.Example
             Tensorflow example to save as tfrecord
         """
+        if self.rescale:
+            self.scale(x)
         with tf.io.TFRecordWriter(path) as writer:
             for i in range(len(x)):
-                x[i] *= 255.0 / x[i].max()
                 example = self.get_tf_example(x[i], y[i])
                 writer.write(example.SerializeToString())
-        
\ No newline at end of file
+
+
+class ShardedTFRecordWriter(TrainingTFRecorder):
+    """
+    Class to write training examples into tfrecord shards of similar size.
+    Slices of consecutive cases are packed in the same shard until it reaches
+    `samples_per_shard` examples or `shard_size_mb` MB of serialized data.
+    A manifest listing the shards and their number of samples is written on close.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Directory in which shards are written
+    prefix : str
+        Prefix of the shard file names
+    samples_per_shard : int
+        Maximum number of examples per shard. Default to None
+    shard_size_mb : float
+        Maximum size of a shard in MB, measured on the uncompressed serialized
+        examples. Used when samples_per_shard is None. Default to 128
+    compression : str
+        None, 'GZIP' or 'ZLIB'. Default to None
+    workers : int
+        Number of threads used to serialize examples. Default to 4
+    label_encoding : str
+        See TrainingTFRecorder. Default to 'int64'
+    image_dtype : str
+        See TrainingTFRecorder. Default to 'float32'
+    rescale : bool
+        See TrainingTFRecorder. Default to True
+    state : dict
+        State returned by `checkpoint`. Shards written after the checkpoint are deleted
+        and the last one is rewritten with its checkpointed examples. Default to None
+    """
+    manifest_name = 'shards.json'
+
+    def __init__(self, path, prefix='data', samples_per_shard=None, shard_size_mb=128,
+                 compression=None, workers=4, label_encoding='int64', image_dtype='float32', rescale=True,
+                 state=None):
+        super().__init__(label_encoding, image_dtype, rescale)
+        self.path = path
+        self.prefix = prefix
+        self.samples_per_shard = samples_per_shard
+        self.shard_size = None if samples_per_shard else int(shard_size_mb * 2 ** 20)
+        self.compression = compression or ''
+        self.shards = []
+        self.shapes = None
+        self._writer = None
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._workers = workers
+        if state is not None:
+            self._resume(state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def serialize(self, x, y):
+        """Serialize a batch of slices to tf.train.Example strings
+
+        Parameters
+        ----------
+        x : np.array
+            MRI slices of shape (number_of_slices, width, height, 4)
+        y : np.array
+            Ground truth of shape (number_of_slices, width, height)
+
+        Return
+        ----------
+        records : list
+            Serialized examples
+        """
+        return [self.get_tf_example(x[i], y[i]).SerializeToString() for i in range(len(x))]
+
+    def write(self, x, y):
+        """Scale and write a batch of slices, usually a whole case
+
+        Parameters
+        ----------
+        x : np.array
+            MRI slices of shape (number_of_slices, width, height, 4)
+        y : np.array
+            Ground truth of shape (number_of_slices, width, height)
+        """
+        if self.shapes is None:
+            self.shapes = (x.shape[1:], y.shape[1:])
+        if self.rescale:
+            self.scale(x)
+        bounds = np.linspace(0, len(x), self._workers + 1).astype(int)
+        batches = self._executor.map(self.serialize,
+                                     [x[a:b] for a, b in zip(bounds[:-1], bounds[1:])],
+                                     [y[a:b] for a, b in zip(bounds[:-1], bounds[1:])])
+        for records in batches:
+            for record in records:
+                self._write_record(record)
+
+    def checkpoint(self):
+        """Flush the current shard to disk
+
+        Return
+        ----------
+        state : dict
+            State from which writing can be resumed
+        """
+        if self._writer is not None:
+            self._writer.flush()
+        return {'shards': [dict(shard) for shard in self.shards],
+                'shapes': [list(shape) for shape in self.shapes] if self.shapes else None}
+
+    def _resume(self, state):
+        self.shards = [dict(shard) for shard in state['shards']]
+        self.shapes = tuple(tuple(shape) for shape in state['shapes']) if state['shapes'] else None
+        kept = [shard['file'] for shard in self.shards]
+        for name in os.listdir(self.path):
+            if name.startswith(self.prefix + '-') and name.endswith('.tfrecord') and name not in kept:
+                os.remove(os.path.join(self.path, name))
+        if not self.shards:
+            return
+        # TFRecordWriter cannot append, the last shard is rewritten with its checkpointed examples
+        last = os.path.join(self.path, self.shards[-1]['file'])
+        if not os.path.exists(last + '.resume'):
+            os.replace(last, last + '.resume')
+        records = tf.data.TFRecordDataset(last + '.resume', compression_type=self.compression)
+        options = tf.io.TFRecordOptions(compression_type=self.compression)
+        self._writer = tf.io.TFRecordWriter(last, options)
+        for record in records.take(self.shards[-1]['samples']):
+            self._writer.write(record.numpy())
+        os.remove(last + '.resume')
+
+    def close(self):
+        """Close the current shard and write the manifest"""
+        self._executor.shutdown()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        manifest = {
+            'compression': self.compression or None,
+            'schema': self.schema(*self.shapes) if self.shapes else None,
+            'samples': sum(shard['samples'] for shard in self.shards),
+            'shards': self.shards
+        }
+        with open(os.path.join(self.path, self.manifest_name), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def _write_record(self, record):
+        if self._writer is None or self._shard_full(len(record)):
+            self._next_shard()
+        self._writer.write(record)
+        self.shards[-1]['samples'] += 1
+        self.shards[-1]['bytes'] += len(record)
+
+    def _shard_full(self, n_bytes):
+        shard = self.shards[-1]
+        if self.shard_size is None:
+            return shard['samples'] >= self.samples_per_shard
+        return shard['samples'] > 0 and shard['bytes'] + n_bytes > self.shard_size
+
+    def _next_shard(self):
+        if self._writer is not None:
+            self._writer.close()
+        file_name = '{}-{:05d}.tfrecord'.format(self.prefix, len(self.shards))
+        options = tf.io.TFRecordOptions(compression_type=self.compression)
+        self._writer = tf.io.TFRecordWriter(os.path.join(self.path, file_name), options)
+        self.shards.append({'file': file_name, 'samples': 0, 'bytes': 0})
@@ -0,0 +1,238 @@
+import os, json, hashlib
+import numpy as np
+from glob import glob
+from .manifest import RunManifest
+from .npy import NPYStore
+from .writers import H5SplitWriter
+
+# Manifest of the tfrecord shards, see ShardedTFRecordWriter
+TFRECORD_MANIFEST = 'shards.json'
+MERGED_MANIFEST = 'dataset_manifest.json'
+
+def case_shard(case : str, num_shards : int) -> int:
+    """Shard of a case, from a hash of its name. The assignment of a case does not
+    depend on the other cases, so adding cases to the dataset does not move the
+    existing ones to another shard.
+
+    Parameters
+    ----------
+    case : str
+        Path of the case
+    num_shards : int
+        Number of shards
+
+    Return
+    ----------
+    shard : int
+        Index of the shard in [0, num_shards)
+    """
+    name = os.path.basename(os.path.normpath(case))
+    return int(hashlib.sha1(name.encode()).hexdigest(), 16) % num_shards
+
+def partition(cases : list, num_shards : int, shard_index : int) -> list:
+    """Cases processed by one shard, in their original order
+
+    Parameters
+    ----------
+    cases : list
+        Paths of the cases
+    num_shards : int
+        Number of shards
+    shard_index : int
+        Index of the shard in [0, num_shards)
+
+    Return
+    ----------
+    cases : list
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError('shard_index has to be in [0, {})'.format(num_shards))
+    return [case for case in cases if case_shard(case, num_shards) == shard_index]
+
+def shard_name(shard_index : int, num_shards : int) -> str:
+    """Name of the output directory of a shard"""
+    return 'shard-{:05d}-of-{:05d}'.format(shard_index, num_shards)
+
+def find_shards(save_path : str) -> list:
+    """Output directories of all the shards of a dataset
+
+    Parameters
+    ----------
+    save_path : str
+        Output directory given to every shard
+
+    Return
+    ----------
+    shards : list
+        Sorted shard directory names
+    """
+    shards = sorted(os.path.basename(path) for path in glob(os.path.join(save_path, 'shard-*-of-*')))
+    if shards:
+        num_shards = int(shards[0].split('-')[-1])
+        missing = sorted(set(shard_name(i, num_shards) for i in range(num_shards)) - set(shards))
+        if missing:
+            raise ValueError('Missing shards: {}'.format(missing))
+    return shards
+
+def merge_manifests(save_path : str, shards : list, split : str) -> dict:
+    """Combine the run manifests of the shards of a split. Output files are made
+    relative to the merged split directory and rows of single container formats
+    are offset by the rows of the previous shards.
+
+    Parameters
+    ----------
+    save_path : str
+        Output directory given to every shard
+    shards : list
+        Shard directory names
+    split : str
+        Name of the split
+
+    Return
+    ----------
+    manifest : dict
+    """
+    merged = {'shards': shards, 'config_hash': None, 'cases': {}}
+    offset = 0
+    for shard in shards:
+        with open(os.path.join(save_path, shard, split, RunManifest.name), 'r') as f:
+            manifest = json.load(f)
+        if merged['config_hash'] not in (None, manifest['config_hash']):
+            raise ValueError('Shard {} was written with another configuration'.format(shard))
+        merged['config_hash'] = manifest['config_hash']
+        merged['config'] = manifest['config']
+        prefix = os.path.join('..', shard, split)
+        for case, entry in manifest['cases'].items():
+            merged['cases'][case] = dict(entry, shard=shard, output=_relocate(entry['output'], prefix, offset))
+        offset += sum(entry['slices'] for entry in manifest['cases'].values())
+    return merged
+
+def _relocate(output, prefix, offset):
+    if isinstance(output, str):
+        return os.path.join(prefix, output)
+    if isinstance(output, list):
+        return [_relocate(o, prefix, offset) for o in output]
+    if isinstance(output, dict) and 'rows' in output:
+        return dict(output, rows=[row + offset for row in output['rows']])
+    return output
+
+def merge_h5(sources : list, path : str):
+    """Concatenate the datasets of several h5 files into virtual datasets.
+    No data is copied, the merged file refers to the shard files by relative path.
+
+    Parameters
+    ----------
+    sources : list
+        Paths of the h5 files of the shards
+    path : str
+        Path of the merged file
+    """
+    import h5py
+    files = [h5py.File(source, 'r') for source in sources]
+    try:
+        with h5py.File(path, 'w', libver='latest') as h5f:
+            for name in files[0]:
+                rows = [f[name].shape[0] for f in files]
+                dset = files[0][name]
+                layout = h5py.VirtualLayout(shape=(sum(rows), ) + dset.shape[1:], dtype=dset.dtype)
+                start = 0
+                for source, f, n in zip(sources, files, rows):
+                    if n > 0:
+                        relative = os.path.relpath(source, os.path.dirname(os.path.abspath(path)))
+                        layout[start:start + n] = h5py.VirtualSource(relative, name, shape=f[name].shape)
+                    start += n
+                h5f.create_virtual_dataset(name, layout)
+    finally:
+        for f in files:
+            f.close()
+
+def merge_npy(sources : list, path : str):
+    """Merge the slice indices of consolidated npy datasets. The arrays stay in the
+    shard directories and are listed, with their number of rows, in npy_shards.json,
+    which NPYDataset reads to map global slice ids to a shard.
+
+    Parameters
+    ----------
+    sources : list
+        Directories of the consolidated npy datasets of the shards
+    path : str
+        Directory of the merged dataset
+    """
+    index, cases, rows = [], [], []
+    for source in sources:
+        shard_index = np.load(os.path.join(source, NPYStore.index_name))
+        with open(os.path.join(source, NPYStore.cases_name), 'r') as f:
+            shard_cases = json.load(f)
+        index.append(shard_index + np.array([len(cases), 0], dtype=np.int32))
+        cases += shard_cases
+        rows.append(len(shard_index))
+    np.save(os.path.join(path, NPYStore.index_name), np.concatenate(index).astype(np.int32))
+    with open(os.path.join(path, NPYStore.cases_name), 'w') as f:
+        json.dump(cases, f, indent=2)
+    with open(os.path.join(path, NPYStore.shards_name), 'w') as f:
+        json.dump({'shards': [os.path.relpath(source, path) for source in sources], 'rows': rows}, f, indent=2)
+
+def merge_tfrecord(sources : list, path : str):
+    """Merge the manifests of tfrecord shards, listing the files of every shard
+
+    Parameters
+    ----------
+    sources : list
+        Directories of the tfrecord shards
+    path : str
+        Directory of the merged manifest
+    """
+    merged = None
+    for source in sources:
+        with open(os.path.join(source, TFRECORD_MANIFEST), 'r') as f:
+            manifest = json.load(f)
+        for shard in manifest['shards']:
+            shard['file'] = os.path.relpath(os.path.join(source, shard['file']), path)
+        if merged is None:
+            merged = dict(manifest, samples=0, shards=[])
+        elif manifest['schema'] is not None and merged['schema'] not in (None, manifest['schema']) \
+                or manifest['compression'] != merged['compression']:
+            raise ValueError('{} was written with another schema or compression'.format(source))
+        merged['schema'] = merged['schema'] or manifest['schema']
+        merged['samples'] += manifest['samples']
+        merged['shards'] += manifest['shards']
+    with open(os.path.join(path, TFRECORD_MANIFEST), 'w') as f:
+        json.dump(merged, f, indent=2)
+
+def merge_split(save_path : str, split : str, shards : list = None) -> dict:
+    """Combine the outputs of all the shards of a split into one logical dataset
+    in save_path/split: merged run manifest, and depending on the format a virtual
+    h5 file, a global npy slice index or a tfrecord shard manifest.
+
+    Parameters
+    ----------
+    save_path : str
+        Output directory given to every shard
+    split : str
+        Name of the split
+    shards : list
+        Shard directory names. Default to None (all shards found in save_path)
+
+    Return
+    ----------
+    manifest : dict
+        Merged manifest
+    """
+    shards = find_shards(save_path) if shards is None else shards
+    if not shards:
+        raise ValueError('No shard found in {}'.format(save_path))
+    sources = [os.path.join(save_path, shard, split) for shard in shards]
+    path = os.path.join(save_path, split)
+    os.makedirs(path, exist_ok=True)
+    manifest = merge_manifests(save_path, shards, split)
+    first = sources[0]
+    if os.path.isfile(os.path.join(first, H5SplitWriter.file_name)):
+        merge_h5([os.path.join(source, H5SplitWriter.file_name) for source in sources],
+                 os.path.join(path, H5SplitWriter.file_name))
+    elif os.path.isfile(os.path.join(first, NPYStore.index_name)):
+        merge_npy(sources, path)
+    elif os.path.isfile(os.path.join(first, TFRECORD_MANIFEST)):
+        merge_tfrecord(sources, path)
+    with open(os.path.join(path, MERGED_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
@@ -0,0 +1,253 @@
+import os, json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from .processing import get_scans, read_volumes
+
+NORMALIZATION_METHODS = ['zscore', 'percentile']
+
+class IntensityStats(object):
+    """
+    Streaming intensity statistics of every modality, mergeable across cases.
+    Mean and variance are accumulated with the parallel algorithm of Chan et al.,
+    and percentiles are read from a histogram with fixed bins, so the statistics of
+    cases processed independently can be merged exactly.
+    Only brain voxels (non-zero intensities) are counted.
+    ...
+
+    Attributes
+    ----------
+    channels : int
+        Number of modalities. Default to 4
+    bins : int
+        Number of bins of the histograms. Default to 4096
+    high : float
+        Upper bound of the histograms, higher intensities fall in the last bin. Default to 2 ** 16
+    """
+    def __init__(self, channels=4, bins=4096, high=2 ** 16):
+        self.channels = channels
+        self.bins = bins
+        self.high = float(high)
+        self.count = np.zeros(channels, dtype=np.int64)
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros(channels)
+        self.min = np.full(channels, np.inf)
+        self.max = np.full(channels, -np.inf)
+        self.histogram = np.zeros((channels, bins), dtype=np.int64)
+
+    def update(self, channel : int, values : np.array):
+        """Add the voxels of a volume or slices of one modality
+
+        Parameters
+        ----------
+        channel : int
+            Index of the modality
+        values : np.array
+            Intensities of any shape
+        """
+        values = values[values > 0]
+        if values.size == 0:
+            return
+        mean = values.mean(dtype=np.float64)
+        m2 = np.square(values - mean, dtype=np.float64).sum()
+        self._combine(channel, values.size, mean, m2)
+        self.min[channel] = min(self.min[channel], values.min())
+        self.max[channel] = max(self.max[channel], values.max())
+        bins = np.minimum((values * (self.bins / self.high)).astype(np.int64), self.bins - 1)
+        self.histogram[channel] += np.bincount(bins, minlength=self.bins)
+
+    def _combine(self, channel, n, mean, m2):
+        total = self.count[channel] + n
+        delta = mean - self.mean[channel]
+        self.mean[channel] += delta * n / total
+        self.m2[channel] += m2 + delta ** 2 * self.count[channel] * n / total
+        self.count[channel] = total
+
+    def merge(self, other):
+        """Add the statistics of other cases
+
+        Parameters
+        ----------
+        other : IntensityStats
+            Statistics computed with the same channels and bins
+
+        Return
+        ----------
+        stats : IntensityStats
+            self
+        """
+        if (other.channels, other.bins, other.high) != (self.channels, self.bins, self.high):
+            raise ValueError('Statistics have to share the same channels and bins to be merged')
+        for channel in range(self.channels):
+            if other.count[channel]:
+                self._combine(channel, other.count[channel], other.mean[channel], other.m2[channel])
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.histogram += other.histogram
+        return self
+
+    @property
+    def std(self) -> np.array:
+        return np.sqrt(self.m2 / np.maximum(self.count, 1))
+
+    def percentile(self, q : float) -> np.array:
+        """Percentile of every modality, linearly interpolated inside histogram bins
+
+        Parameters
+        ----------
+        q : float
+            Percentile in [0, 100]
+
+        Return
+        ----------
+        values : np.array
+            One value per modality
+        """
+        width = self.high / self.bins
+        values = np.zeros(self.channels)
+        for channel in range(self.channels):
+            cumulative = np.cumsum(self.histogram[channel])
+            if cumulative[-1] == 0:
+                continue
+            rank = q / 100. * cumulative[-1]
+            b = min(int(np.searchsorted(cumulative, rank, side='left')), self.bins - 1)
+            below = cumulative[b - 1] if b > 0 else 0
+            fraction = (rank - below) / max(self.histogram[channel, b], 1)
+            values[channel] = np.clip((b + fraction) * width, self.min[channel], self.max[channel])
+        return values
+
+    def normalization(self, method : str = 'zscore', percentiles : tuple = (1., 99.)) -> dict:
+        """Coefficients of the affine normalization of every modality, see affine_normalize
+
+        Parameters
+        ----------
+        method : str
+            'zscore' maps the mean to 0 and the standard deviation to 1, 'percentile'
+            maps the low and high percentiles to 0 and 1. Default to 'zscore'
+        percentiles : tuple
+            Low and high percentiles of the 'percentile' method. Default to (1, 99)
+
+        Return
+        ----------
+        coefficients : dict
+            Lists of per modality `scale` and `offset`
+        """
+        if method == 'zscore':
+            low, spread = self.mean, self.std
+        elif method == 'percentile':
+            low = self.percentile(percentiles[0])
+            spread = self.percentile(percentiles[1]) - low
+        else:
+            raise ValueError('method has to be in {}'.format(NORMALIZATION_METHODS))
+        scale = 1. / np.where(spread > 0, spread, 1.)
+        return {'scale': scale.tolist(), 'offset': (-low * scale).tolist()}
+
+    def to_dict(self) -> dict:
+        return {
+            'channels': self.channels, 'bins': self.bins, 'high': self.high,
+            'count': self.count.tolist(), 'mean': self.mean.tolist(), 'std': self.std.tolist(),
+            'm2': self.m2.tolist(), 'min': self.min.tolist(), 'max': self.max.tolist(),
+            'percentiles': {str(q): self.percentile(q).tolist() for q in [0.5, 1, 5, 50, 95, 99, 99.5]},
+            'histogram': self.histogram.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, state : dict):
+        stats = cls(state['channels'], state['bins'], state['high'])
+        for name in ['count', 'mean', 'm2', 'min', 'max', 'histogram']:
+            setattr(stats, name, np.array(state[name], dtype=getattr(stats, name).dtype))
+        return stats
+
+    def save(self, path : str):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path : str):
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+def case_statistics(case : str, cache = None, **kwargs) -> IntensityStats:
+    """Intensity statistics of the 4 sequences of a case
+
+    Parameters
+    ----------
+    case : str
+        Path of the case
+    cache : VolumeCache
+        Cache of decoded volumes. Default to None
+    **kwargs
+        Arguments of IntensityStats
+
+    Return
+    ----------
+    stats : IntensityStats
+    """
+    scans = next(get_scans([case]))[:-1]
+    stats = IntensityStats(channels=len(scans), **kwargs)
+    for channel, volume in enumerate(read_volumes(scans, cache)):
+        stats.update(channel, volume)
+    return stats
+
+def compute_statistics(cases : list, workers : int = 0, cache = None, **kwargs) -> IntensityStats:
+    """Intensity statistics of a set of cases, computed in parallel and merged
+
+    Parameters
+    ----------
+    cases : list
+        Paths of the cases
+    workers : int
+        Number of worker processes, 0 to compute them in the current process. Default to 0
+    cache : VolumeCache
+        Cache of decoded volumes. Default to None
+    **kwargs
+        Arguments of IntensityStats
+
+    Return
+    ----------
+    stats : IntensityStats
+    """
+    stats = IntensityStats(**kwargs)
+    if workers > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for case_stats in executor.map(partial(case_statistics, cache=cache, **kwargs), cases):
+                stats.merge(case_stats)
+    else:
+        for case in cases:
+            stats.merge(case_statistics(case, cache, **kwargs))
+    return stats
+
+def affine_normalize(source : tuple, scale : list, offset : list, clip : tuple = None) -> tuple:
+    """Normalize every modality with a precomputed affine transform, x * scale + offset,
+    computed in place. See IntensityStats.normalization for the coefficients.
+
+    Parameters
+    ----------
+    source : tuple
+        Data tuple containing MRI array of shape (number_of_slices, 4, width, height) and
+        Ground truth array of shape (number_of_slices, width, height), or patches and blocks
+        of shape (number_of_blocks, 4, depth, width, height)
+    scale : list
+        Scale of every modality
+    offset : list
+        Offset of every modality
+    clip : tuple
+        Bounds of the normalized values. Default to None
+
+    Yield
+    ----------
+    data : tuple
+        Normalized MRI array and unchanged ground truth
+    """
+    scale = np.asarray(scale, dtype=np.float32)
+    offset = np.asarray(offset, dtype=np.float32)
+    for x, y in source:
+        # Modalities are the second axis of slices (N, 4, H, W) and blocks (N, 4, D, H, W)
+        shape = (-1, ) + (1, ) * (x.ndim - 2)
+        np.multiply(x, scale.reshape(shape), out=x)
+        np.add(x, offset.reshape(shape), out=x)
+        if clip is not None:
+            np.clip(x, clip[0], clip[1], out=x)
+        yield (x, y)
@@ -0,0 +1,212 @@
+import os, json
+import numpy as np
+from .npy import NPYStore
+from .preprocessing import one_hot, minmax_normalize, NORMALIZATIONS
+
+# Storage of the tfrecord examples, see TrainingTFRecorder. Defined here so they
+# are available without importing TensorFlow.
+LABEL_ENCODINGS = ['int64', 'uint8']
+IMAGE_DTYPES = ['float32', 'float16', 'uint8']
+
+def check_image_dtype(image_dtype : str, rescale : bool):
+    """Check that slices can be stored with a type of tfrecord image bytes.
+    Unsigned types need slices scaled to [0, 255]: normalized values would be
+    rounded and wrap around.
+
+    Parameters
+    ----------
+    image_dtype : str
+        Type of the image bytes, see IMAGE_DTYPES
+    rescale : bool
+        Whether slices are scaled to [0, 255] by their maximum
+    """
+    if image_dtype not in IMAGE_DTYPES:
+        raise ValueError('image_dtype has to be in {}'.format(IMAGE_DTYPES))
+    if not rescale and np.dtype(image_dtype).kind == 'u':
+        raise ValueError('{} images need slices scaled to [0, 255]'.format(image_dtype))
+
+class SplitWriter(object):
+    """
+    Base class of the writers saving the output of the pipeline for one split.
+    Writers with `per_case` set store every case in its own files. The others keep
+    the whole split in a single container and can be resumed from the state
+    returned by `checkpoint`.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Directory of the split
+    split : str
+        Name of the split
+    """
+    per_case = True
+
+    def __init__(self, path, split):
+        self.path = path
+        self.split = split
+
+    def write(self, idx, case, x, y):
+        """Write the output of the pipeline for a case
+
+        Parameters
+        ----------
+        idx : int
+            Position of the case in the split
+        case : str
+            Path of the case
+        x : np.array
+            MRI array of shape (number_of_slices, 4, width, height)
+        y : np.array
+            Ground truth array of shape (number_of_slices, width, height)
+
+        Return
+        ----------
+        output : object
+            Location of the output of the case
+        """
+        raise NotImplementedError
+
+    def checkpoint(self):
+        """Make the cases written so far durable
+
+        Return
+        ----------
+        state : dict
+            State from which writing can be resumed, None for per case writers
+        """
+        return None
+
+    def close(self):
+        pass
+
+
+class TFRecordCaseWriter(SplitWriter):
+    """Write one tfrecord file per case. Files are listed with the schema of their
+    examples in the same manifest as shards, so TrainingRecorder.from_manifest reads
+    them as well. Entries of cases written by a previous run are kept."""
+
+    def __init__(self, path, split, label_encoding='int64', image_dtype='float32', rescale=True):
+        super().__init__(path, split)
+        from .recorder import TrainingTFRecorder, ShardedTFRecordWriter
+        self.recorder = TrainingTFRecorder(label_encoding=label_encoding, image_dtype=image_dtype, rescale=rescale)
+        self.manifest_path = os.path.join(path, ShardedTFRecordWriter.manifest_name)
+        self.schema = None
+        self.files = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            self.schema = manifest['schema']
+            self.files = {self._index(shard['file']): shard for shard in manifest['shards']}
+
+    def _file_name(self, idx):
+        return '{}_case_{}.tfrecord'.format(self.split, idx)
+
+    def _index(self, file_name):
+        return int(file_name[len(self._file_name('')):-len('.tfrecord')])
+
+    def write(self, idx, case, x, y):
+        file_name = self._file_name(idx)
+        x = np.moveaxis(x, 1, 3)
+        schema = self.recorder.schema(x.shape[1:], y.shape[1:])
+        if schema != self.schema:
+            self.schema = schema
+            self.files = {}
+        self.recorder.save_tf_record(x, y, os.path.join(self.path, file_name))
+        self.files[idx] = {'file': file_name, 'samples': len(x),
+                           'bytes': os.path.getsize(os.path.join(self.path, file_name))}
+        return file_name
+
+    def close(self):
+        shards = [shard for _, shard in sorted(self.files.items())
+                  if os.path.isfile(os.path.join(self.path, shard['file']))]
+        manifest = {'compression': None, 'schema': self.schema,
+                    'samples': sum(shard['samples'] for shard in shards), 'shards': shards}
+        with open(self.manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+
+class TFRecordShardWriter(SplitWriter):
+    """Pack the slices of all cases into tfrecord shards, see ShardedTFRecordWriter"""
+    per_case = False
+
+    def __init__(self, path, split, state=None, **kwargs):
+        super().__init__(path, split)
+        from .recorder import ShardedTFRecordWriter
+        self.writer = ShardedTFRecordWriter(path, prefix=split, state=state, **kwargs)
+
+    def write(self, idx, case, x, y):
+        first = max(len(self.writer.shards) - 1, 0)
+        self.writer.write(np.moveaxis(x, 1, 3), y)
+        return [shard['file'] for shard in self.writer.shards[first:]]
+
+    def checkpoint(self):
+        return self.writer.checkpoint()
+
+    def close(self):
+        self.writer.close()
+
+
+class NPYCaseWriter(SplitWriter):
+    """Write one npy file pair per case"""
+
+    def write(self, idx, case, x, y):
+        files = []
+        for name, data in [('x', x), ('y', y)]:
+            os.makedirs(os.path.join(self.path, name), exist_ok=True)
+            files.append(os.path.join(name, '{}_case_{}_{}.npy'.format(self.split, name.upper(), idx)))
+            np.save(os.path.join(self.path, files[-1]), data)
+        return files
+
+
+class NPYSplitWriter(SplitWriter):
+    """Write a single memory-mappable npy file per dataset, or compressed chunks, see NPYStore"""
+    per_case = False
+
+    def __init__(self, path, split, state=None, shapes=[(4, 128, 128), (128, 128)], **kwargs):
+        super().__init__(path, split)
+        self.store = NPYStore(path, ['x', 'y'], shapes=shapes, dtype=[np.float32, np.uint8], state=state, **kwargs)
+
+    def write(self, idx, case, x, y):
+        start = self.store.i
+        self.store.append_case(os.path.basename(case), [x, y])
+        return {'rows': [start, self.store.i]}
+
+    def checkpoint(self):
+        return self.store.checkpoint()
+
+    def close(self):
+        self.store.close()
+
+
+class H5SplitWriter(SplitWriter):
+    """Write normalized slices and one-hot ground truth to a single h5 file, see HDF5Store.
+    With the l2 normalization every pixel is divided by its norm across the modalities,
+    which makes any per slice scaling of x irrelevant. The minmax normalization is computed
+    per row, i.e. per slice, patch or volumetric block. With 'none', slices are written
+    as produced by the pipeline."""
+    per_case = False
+    file_name = 'h5_dataset.h5'
+
+    def __init__(self, path, split, state=None, shapes=[(4, 128, 128), (5, 128, 128)], normalization='l2', **kwargs):
+        super().__init__(path, split)
+        from .h5 import HDF5Store
+        self.normalization = None if normalization in (None, 'none') else normalization
+        self.store = HDF5Store(os.path.join(path, self.file_name), ['X', 'Y'], shapes=shapes,
+                               dtype=[np.float32, np.uint8], state=state, **kwargs)
+
+    def write(self, idx, case, x, y):
+        start = self.store.i['X']
+        if self.normalization == 'minmax':
+            x = minmax_normalize(x, axis=tuple(range(1, x.ndim)), out=x)
+        elif self.normalization is not None:
+            x = NORMALIZATIONS[self.normalization](x, out=x)
+        self.store.append_batch('X', x)
+        self.store.append_batch('Y', one_hot(y, 5, axis=1))
+        return {'rows': [start, self.store.i['X']]}
+
+    def checkpoint(self):
+        return self.store.checkpoint()
+
+    def close(self):
+        self.store.close()
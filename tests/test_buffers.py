@@ -0,0 +1,75 @@
+import pickle, unittest
+import numpy as np
+from pipeline.buffers import BufferPool, get_pool
+from pipeline.processing import slabs, extract_patches, normalize
+
+class TestBufferPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = BufferPool()
+        x = pool.acquire((4, 8, 8))
+        assert x.shape == (4, 8, 8) and x.dtype == np.float32 and x.flags.c_contiguous
+        pool.release(x[1:, 2])
+        y = pool.acquire((2, 8, 8))
+        assert np.shares_memory(x, y)
+        assert not np.shares_memory(y, pool.acquire((2, 8, 8)))
+        pool.release_all()
+        z = pool.acquire((8, 8, 8))
+        assert pool.nbytes == z.nbytes + y.nbytes
+
+    def test_types(self):
+        pool = BufferPool()
+        x = pool.acquire((16, ), np.uint8)
+        pool.release(x, np.zeros(3))
+        assert pool.acquire((4, ), np.float32).dtype == np.float32
+        assert np.shares_memory(x, pool.acquire((16, ), np.uint8))
+        pool.release_all()
+        pool.clear()
+        assert pool.nbytes == 0
+
+    def test_pickle(self):
+        assert pickle.loads(pickle.dumps(get_pool('test'))) is get_pool('test')
+        pool = BufferPool()
+        assert pickle.loads(pickle.dumps(pool)) is not pool
+
+
+class TestPooledOperations(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.random.rand(10, 4, 24, 24).astype('float32')
+        self.y = np.zeros((10, 24, 24), dtype='uint8')
+        self.y[3:7, 5:15, 5:15] = 2
+
+    def test_slabs(self):
+        pool = BufferPool()
+        expected = next(slabs([(self.x, self.y)], depth=4, pad=True))
+        for _ in range(2):
+            output = next(slabs([(self.x, self.y)], depth=4, pad=True, pool=pool))
+            for a, b in zip(output, expected):
+                np.testing.assert_array_equal(a, b)
+            pool.release(*output)
+
+    def test_patches(self):
+        pool = BufferPool()
+        x = pool.acquire(self.x.shape)
+        x[:] = self.x
+        expected = next(extract_patches([(self.x, self.y)], size=8, n_patches=6, seed=0))
+        output = next(extract_patches([(x, self.y)], size=8, n_patches=6, seed=0, pool=pool))
+        for a, b in zip(output, expected):
+            np.testing.assert_array_equal(a, b)
+        assert not any(np.shares_memory(x, a) for a in output)
+
+    def test_normalize(self):
+        pool = BufferPool()
+        x, y = next(normalize([(self.x * 1000, self.y)]))
+        assert x.shape == (10, 24, 24, 4) and x.dtype == np.uint8 and x.max() == 255
+        np.testing.assert_array_equal(x, (np.moveaxis(self.x, 1, 3) * 1000 * (255. / (self.x.max() * 1000))).astype('uint8'))
+        np.testing.assert_array_equal(y, self.y / 4)
+        output = next(normalize([(self.x * 1000, self.y)], pool=pool))
+        for a, b in zip(output, (x, y)):
+            np.testing.assert_array_equal(a, b)
+        assert pool.nbytes == x.nbytes + y.nbytes
+
+
+if __name__ == '__main__':
+    unittest.main()
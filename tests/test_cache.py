@@ -0,0 +1,98 @@
+import os, tempfile, unittest
+import numpy as np
+from pipeline.cache import VolumeCache
+from pipeline.processing import get_scans, read_case
+from benchmarks.synthetic import make_synthetic_dataset
+
+class TestVolumeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = VolumeCache(os.path.join(self.tmp_dir.name, 'cache'))
+        self.sources = []
+        for idx in range(3):
+            self.sources.append(os.path.join(self.tmp_dir.name, 'scan_{}.mha'.format(idx)))
+            with open(self.sources[-1], 'wb') as f:
+                f.write(b'scan')
+        self.volume = np.arange(2 * 8 * 8, dtype=np.int16).reshape(2, 8, 8)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def entries(self):
+        return sorted(os.listdir(self.cache.path))
+
+    def test_hit_and_miss(self):
+        assert self.cache.get(self.sources[0]) is None
+        self.cache.put(self.sources[0], self.volume)
+        cached = self.cache.get(self.sources[0])
+        assert isinstance(cached, np.memmap) and cached.dtype == np.int16
+        np.testing.assert_array_equal(cached, self.volume)
+        assert self.cache.get(self.sources[1]) is None
+
+    def test_invalidation(self):
+        self.cache.put(self.sources[0], self.volume)
+        key = self.cache.key(self.sources[0])
+        stat = os.stat(self.sources[0])
+        os.utime(self.sources[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert self.cache.key(self.sources[0]) != key and self.cache.get(self.sources[0]) is None
+        self.cache.put(self.sources[0], self.volume)
+        key = self.cache.key(self.sources[0])
+        with open(self.sources[0], 'ab') as f:
+            f.write(b'more')
+        os.utime(self.sources[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert self.cache.key(self.sources[0]) != key and self.cache.get(self.sources[0]) is None
+
+    def test_atomic_put(self):
+        self.cache.put(self.sources[0], self.volume)
+        self.cache.put(self.sources[0], self.volume + 1)
+        assert self.entries() == [self.cache.key(self.sources[0]) + '.npy']
+        np.testing.assert_array_equal(self.cache.get(self.sources[0]), self.volume + 1)
+        # A truncated entry, e.g. written without the cache, is a miss rather than an error
+        with open(os.path.join(self.cache.path, self.cache.key(self.sources[1]) + '.npy'), 'wb') as f:
+            f.write(b'\x93NUMPY')
+        assert self.cache.get(self.sources[1]) is None
+
+    def test_lru_eviction(self):
+        for idx, source in enumerate(self.sources[:2]):
+            self.cache.put(source, self.volume)
+            entry = os.path.join(self.cache.path, self.cache.key(source) + '.npy')
+            os.utime(entry, (idx, idx))
+        entry_size = os.path.getsize(entry)
+        self.cache.max_bytes = 2 * entry_size
+        # Reading the first volume makes the second one the least recently used
+        assert self.cache.get(self.sources[0]) is not None
+        self.cache.put(self.sources[2], self.volume)
+        assert self.cache.get(self.sources[1]) is None
+        assert self.cache.get(self.sources[0]) is not None and self.cache.get(self.sources[2]) is not None
+        self.cache.evict(0)
+        assert self.entries() == []
+
+
+class TestReadCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.case = make_synthetic_dataset(cls.tmp_dir.name, 1, shape=(6, 24, 24))[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def test_read_case(self):
+        scans = next(get_scans([self.case]))
+        x, y = read_case(scans)
+        assert x.shape == (6, 4, 24, 24) and x.dtype == np.float32 and x.flags.c_contiguous
+        assert y.shape == (6, 24, 24) and y.dtype == np.uint8
+        cache = VolumeCache(os.path.join(self.tmp_dir.name, 'cache'))
+        for _ in range(2):
+            x_cached, y_cached = read_case(scans, cache=cache)
+            np.testing.assert_array_equal(x_cached, x)
+            np.testing.assert_array_equal(y_cached, y)
+            assert isinstance(y_cached, np.ndarray) and not isinstance(y_cached, np.memmap)
+        assert len(os.listdir(cache.path)) == 5
+
+
+if __name__ == '__main__':
+    unittest.main()
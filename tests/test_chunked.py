@@ -0,0 +1,71 @@
+import os, tempfile, unittest
+import numpy as np
+from pipeline.chunked import ChunkedWriter, ChunkedArray, available_codecs, shuffle_bytes, unshuffle_bytes
+
+class TestChunked(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'x.chunks')
+        self.x = np.random.rand(30, 4, 8, 8).astype('float32')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_shuffle(self):
+        shuffled = shuffle_bytes(self.x)
+        assert shuffled[:len(self.x.ravel())] == self.x.view(np.uint8).reshape(-1, 4)[:, 0].tobytes()
+        np.testing.assert_array_equal(unshuffle_bytes(shuffled, np.float32), self.x.ravel())
+
+    def test_codecs(self):
+        assert {'zlib', 'lzma', 'none'} <= set(available_codecs())
+        for codec in available_codecs():
+            for workers in [0, 2]:
+                with ChunkedWriter(self.path, (4, 8, 8), np.float32, codec=codec, chunk_len=8, workers=workers) as w:
+                    w.append(self.x[:3])
+                    w.append(self.x[3:])
+                array = ChunkedArray(self.path, workers=workers)
+                assert array.shape == self.x.shape and len(array.chunks) == 4
+                np.testing.assert_array_equal(array.read(), self.x)
+                np.testing.assert_array_equal(array[5:20], self.x[5:20])
+                np.testing.assert_array_equal(array[-1], self.x[-1])
+                np.testing.assert_array_equal(array[[9, 2]], self.x[[9, 2]])
+
+    def test_resume(self):
+        writer = ChunkedWriter(self.path, (4, 8, 8), np.float32, chunk_len=8)
+        writer.append(self.x[:10])
+        state = writer.checkpoint()
+        writer.append(self.x[10:20])
+        writer.close()
+        with ChunkedWriter(self.path, (4, 8, 8), np.float32, chunk_len=8, state=state) as writer:
+            writer.append(self.x[20:])
+        np.testing.assert_array_equal(ChunkedArray(self.path).read(), self.x[list(range(10)) + list(range(20, 30))])
+
+    def test_checkpoint_keeps_chunks_full(self):
+        writer = ChunkedWriter(self.path, (4, 8, 8), np.float32, chunk_len=8, workers=2)
+        for start, stop in [(0, 5), (5, 12), (12, 15), (15, 26)]:
+            writer.append(self.x[start:stop])
+            state = writer.checkpoint()
+            assert [chunk[2] for chunk in writer.chunks] == [8] * (stop // 8) and state['tail'] == stop % 8
+        writer.close()
+        assert [chunk[2] for chunk in ChunkedArray(self.path).chunks] == [8, 8, 8, 2]
+        assert not os.path.exists(self.path + '.tail.npz')
+
+    def test_resume_partial_chunk(self):
+        for remove_tail in [False, True]:
+            writer = ChunkedWriter(self.path, (4, 8, 8), np.float32, chunk_len=8)
+            writer.append(self.x[:11])
+            state = writer.checkpoint()
+            writer.append(self.x[11:20])
+            writer.checkpoint()
+            if remove_tail:
+                # The rows of the partial chunk are then read from the chunk written after the checkpoint
+                os.remove(self.path + '.tail.npz')
+            with ChunkedWriter(self.path, (4, 8, 8), np.float32, chunk_len=8, state=state) as writer:
+                writer.append(self.x[20:])
+            array = ChunkedArray(self.path)
+            np.testing.assert_array_equal(array.read(), self.x[list(range(11)) + list(range(20, 30))])
+            assert [chunk[2] for chunk in array.chunks] == [8, 8, 5]
+
+if __name__ == '__main__':
+    unittest.main()
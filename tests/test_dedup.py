@@ -0,0 +1,54 @@
+import os, json, tempfile, unittest
+import numpy as np
+from pipeline.dedup import average_hash, SliceDeduplicator
+
+class TestSliceDeduplicator(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.x = rng.random((6, 4, 32, 32)).astype('float32')
+        self.y = np.zeros((6, 32, 32), dtype='uint8')
+        self.y[:, 8:16, 8:16] = 1
+        self.x[2] = self.x[0]
+        self.x[4] = self.x[1] + 0.01 * rng.random((4, 32, 32))
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, SliceDeduplicator.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def entries(self):
+        with open(self.path, 'r') as f:
+            return [json.loads(line) for line in f]
+
+    def test_average_hash(self):
+        hashes = average_hash(self.x)
+        assert hashes.dtype == np.uint64 and hashes[0] == hashes[2]
+        assert bin(int(hashes[1]) ^ int(hashes[4])).count('1') <= 2
+
+    def test_exact(self):
+        x, y = SliceDeduplicator(self.path).filter('case_0', self.x, self.y)
+        np.testing.assert_array_equal(x, self.x[[0, 1, 3, 4, 5]])
+        assert self.entries()[0]['duplicates'] == [{'slice': 2, 'of': ['case_0', 0], 'distance': 0}]
+
+    def test_near(self):
+        dedup = SliceDeduplicator(self.path, threshold=2)
+        x, _ = dedup.filter('case_0', self.x, self.y)
+        assert len(x) == 4 and dedup.dropped == 2
+        y = self.y.copy()
+        y[4] = 0
+        x, _ = SliceDeduplicator(self.path, threshold=2).filter('case_0', self.x, y)
+        assert len(x) == 5
+
+    def test_flag_and_resume(self):
+        dedup = SliceDeduplicator(self.path, mode='flag')
+        x, _ = dedup.filter('case_0', self.x, self.y)
+        assert len(x) == 6 and self.entries()[0]['written'] == list(range(6))
+        dedup.filter('case_1', self.x[:1], self.y[:1])
+        dedup = SliceDeduplicator(self.path, mode='flag', cases=['case_0'])
+        assert [entry['case'] for entry in self.entries()] == ['case_0']
+        dedup.filter('case_1', self.x[:1], self.y[:1])
+        assert self.entries()[1]['duplicates'][0]['of'] == ['case_0', 0]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os, tempfile, unittest
+import numpy as np
+import h5py
+from pipeline.h5 import HDF5Store
+
+class TestHDF5Store(unittest.TestCase):
+
+    shapes = [(4, 8, 8), (5, 8, 8)]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'dataset.h5')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_append(self):
+        x = np.random.rand(50, *self.shapes[0]).astype('float32')
+        y = np.random.randint(0, 2, size=(50, ) + self.shapes[1]).astype('uint8')
+        with HDF5Store(self.path, ['X', 'Y'], self.shapes, [np.float32, np.uint8],
+                       compression='lzf', chunk_len=4, buffer_len=16) as store:
+            store.append_batch('X', x[:3])
+            store.append_batch('X', x[3:40])
+            for row in x[40:]:
+                store.append('X', row, row.shape)
+            store.append_batch('Y', y)
+        with h5py.File(self.path, 'r') as h5f:
+            np.testing.assert_array_equal(h5f['X'][:], x)
+            np.testing.assert_array_equal(h5f['Y'][:], y)
+            assert h5f['X'].chunks == (4, ) + self.shapes[0]
+    def test_parallel_compression(self):
+        x = np.random.rand(50, *self.shapes[0]).astype('float32')
+        store = HDF5Store(self.path, ['X'], self.shapes[:1], [np.float32], chunk_len=4, buffer_len=10,
+                          shuffle=True, workers=2)
+        store.append_batch('X', x[:7])
+        state = store.checkpoint()
+        store.append_batch('X', x[7:9])
+        store._h5f.close()
+        with HDF5Store(self.path, ['X'], self.shapes[:1], [np.float32], chunk_len=4, buffer_len=10,
+                       shuffle=True, workers=2, state=state) as store:
+            store.append_batch('X', x[7:])
+        with h5py.File(self.path, 'r') as h5f:
+            np.testing.assert_array_equal(h5f['X'][:], x)
+            assert h5f['X'].shuffle and h5f['X'].compression == 'gzip'
+
+if __name__ == '__main__':
+    unittest.main()
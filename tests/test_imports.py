@@ -0,0 +1,12 @@
+import unittest
+from benchmarks.bench_startup import TARGETS, run_target
+
+class TestLazyImports(unittest.TestCase):
+
+    def test_no_heavy_backend_at_startup(self):
+        for name, code in TARGETS.items():
+            self.assertEqual(run_target(code)['heavy_modules'], [], name)
+
+
+if __name__ == '__main__':
+    unittest.main()
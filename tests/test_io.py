@@ -0,0 +1,33 @@
+import os, tempfile, unittest
+from utils.io import SPLIT_NAMES, create_split
+
+class TestCreateSplit(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        for stratum, n in [('HGG', 20), ('LGG', 10)]:
+            for idx in range(n):
+                os.makedirs(os.path.join(self.tmp_dir.name, stratum, '{}_pat{:03d}'.format(stratum, idx)))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_stratified(self):
+        split = create_split(self.tmp_dir.name, [0.6, 0.2, 0.2], seed=3)
+        cases = split['splits']
+        assert [len(cases[name]) for name in SPLIT_NAMES] == [18, 6, 6]
+        assert sorted(sum(cases.values(), [])) == sorted(
+            os.path.join(stratum, name) for stratum in ['HGG', 'LGG']
+            for name in os.listdir(os.path.join(self.tmp_dir.name, stratum)))
+        assert [sum(case.startswith('LGG') for case in cases[name]) for name in SPLIT_NAMES] == [6, 2, 2]
+        assert sorted(os.listdir(self.tmp_dir.name)) == ['HGG', 'LGG']
+
+    def test_deterministic(self):
+        split = create_split(self.tmp_dir.name, [0.8, 0., 0.2], seed=0)
+        assert split == create_split(self.tmp_dir.name, [0.8, 0., 0.2], seed=0)
+        assert split != create_split(self.tmp_dir.name, [0.8, 0., 0.2], seed=1)
+        assert split['splits']['validation'] == []
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os, tempfile, unittest
+import numpy as np
+from pipeline.npy import NPYStore, NPYDataset
+from pipeline.augmentations import Flip
+
+class TestNPYStore(unittest.TestCase):
+
+    shapes = [(4, 8, 8), (8, 8)]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_consolidated_dataset(self):
+        cases = [(np.random.rand(n, *self.shapes[0]).astype('float32'),
+                  np.random.randint(0, 5, size=(n, ) + self.shapes[1]).astype('uint8')) for n in [3, 5, 2]]
+        with NPYStore(self.tmp_dir.name, ['x', 'y'], self.shapes, [np.float32, np.uint8], capacity=100) as store:
+            for idx, (x, y) in enumerate(cases):
+                store.append_case('case_{}'.format(idx), [x[:, :, ::-1], y])
+
+        dataset = NPYDataset(self.tmp_dir.name)
+        assert len(dataset) == 10
+        assert isinstance(dataset.arrays[0], np.memmap)
+        x, y = dataset[4]
+        np.testing.assert_array_equal(x, cases[1][0][1, :, ::-1])
+        np.testing.assert_array_equal(y, cases[1][1][1])
+        assert dataset.case_slices(1) == slice(3, 8)
+        assert dataset.cases == ['case_0', 'case_1', 'case_2']
+        np.testing.assert_array_equal(dataset.index[3], [1, 0])
+
+    def test_resume(self):
+        x = np.random.rand(6, *self.shapes[0]).astype('float32')
+        y = np.zeros((6, ) + self.shapes[1], dtype='uint8')
+        store = NPYStore(self.tmp_dir.name, ['x', 'y'], self.shapes, [np.float32, np.uint8])
+        store.append_case('case_0', [x[:2], y[:2]])
+        state = store.checkpoint()
+        store.append_case('case_1', [x[2:5], y[2:5]])
+        store._files[0].close(), store._files[1].close()
+
+        with NPYStore(self.tmp_dir.name, ['x', 'y'], self.shapes, [np.float32, np.uint8], state=state) as store:
+            store.append_case('case_2', [x[5:], y[5:]])
+        dataset = NPYDataset(self.tmp_dir.name)
+        assert dataset.cases == ['case_0', 'case_2']
+        np.testing.assert_array_equal(dataset.arrays[0], x[[0, 1, 5]])
+
+    def test_compressed(self):
+        x = np.random.rand(20, *self.shapes[0]).astype('float32')
+        y = np.random.randint(0, 5, size=(20, ) + self.shapes[1]).astype('uint8')
+        store = NPYStore(self.tmp_dir.name, ['x', 'y'], self.shapes, [np.float32, np.uint8], compression='zlib',
+                         chunk_len=4, workers=2)
+        store.append_case('case_0', [x[:6], y[:6]])
+        state = store.checkpoint()
+        store.append_case('case_1', [x[6:], y[6:]])
+        with NPYStore(self.tmp_dir.name, ['x', 'y'], self.shapes, [np.float32, np.uint8], compression='zlib',
+                      chunk_len=4, state=state) as store:
+            store.append_case('case_2', [x[6:], y[6:]])
+        dataset = NPYDataset(self.tmp_dir.name)
+        assert not os.path.isfile(os.path.join(self.tmp_dir.name, 'x.npy')) and len(dataset) == 20
+        np.testing.assert_array_equal(dataset[7][0], x[7])
+        np.testing.assert_array_equal(dataset.batch(np.arange(20))[1], y)
+
+    def test_batches(self):
+        x = np.random.rand(10, *self.shapes[0]).astype('float32')
+        y = np.random.randint(0, 5, size=(10, ) + self.shapes[1]).astype('uint8')
+        with NPYStore(self.tmp_dir.name, ['x', 'y'], self.shapes, [np.float32, np.uint8]) as store:
+            store.append_case('case_0', [x, y])
+        dataset = NPYDataset(self.tmp_dir.name)
+        batches = list(dataset.batches(4, seed=0, workers=2))
+        assert len(batches) == 2 and batches[0][0].shape == (4, ) + self.shapes[0]
+        ids = [int(np.flatnonzero((x == b).all(axis=(1, 2, 3)))[0]) for b in np.concatenate([b[0] for b in batches])]
+        assert len(set(ids)) == 8
+        np.testing.assert_array_equal(np.concatenate([b[1] for b in batches]), y[ids])
+        for (bx, by), (cx, cy) in zip(batches, dataset.batches(4, seed=0)):
+            np.testing.assert_array_equal(bx, cx)
+        bx, by = next(dataset.batches(10, shuffle=False, augmentation=Flip(random=False)))
+        np.testing.assert_allclose(bx, x[..., ::-1])
+        np.testing.assert_array_equal(by, y[..., ::-1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import tempfile, unittest
+import numpy as np
+from pipeline import BraTSPipeline
+from pipeline.processing import resize
+from pipeline.buffers import BufferPool
+from benchmarks.synthetic import make_synthetic_dataset
+
+def fail_on_second(source):
+    for idx, item in enumerate(source):
+        if idx == 1:
+            raise RuntimeError('second case')
+        yield item
+
+class TestStagedExecution(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        make_synthetic_dataset(cls.tmp_dir.name, 3, shape=(20, 160, 160))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def pipeline(self, *operations):
+        pipeline = BraTSPipeline(self.tmp_dir.name)
+        for ops in operations:
+            pipeline.add_operation(ops)
+        return pipeline
+
+    def test_same_output(self):
+        pipeline = self.pipeline(resize)
+        serial = list(pipeline.process('training'))
+        staged = list(pipeline.process('training', staged=True, queue_size=1))
+        assert len(serial) == len(staged) == 3
+        for (x1, y1), (x2, y2) in zip(serial, staged):
+            np.testing.assert_array_equal(x1, x2)
+            np.testing.assert_array_equal(y1, y2)
+
+    def test_error_is_raised(self):
+        outputs = self.pipeline(fail_on_second, resize).process('training', staged=True)
+        next(outputs)
+        with self.assertRaises(RuntimeError):
+            next(outputs)
+
+    def test_early_stop(self):
+        outputs = self.pipeline(resize).process('training', staged=True, queue_size=1)
+        next(outputs)
+        outputs.close()
+
+    def test_workers(self):
+        with self.assertRaises(ValueError):
+            self.pipeline().process('training', workers=2, staged=True)
+
+    def test_slabs(self):
+        slices = list(self.pipeline(resize).process('training'))
+        pipeline = BraTSPipeline(self.tmp_dir.name, slab_depth=3, slab_stride=2, slab_pad=True)
+        pipeline.add_operation(resize)
+        for (x, y), (x_slab, y_slab) in zip(slices, pipeline.process('training')):
+            assert x_slab.shape[1:] == (4, 3) + x.shape[-2:] and y_slab.shape[1:] == (3, ) + y.shape[-2:]
+            first = int(np.flatnonzero(y_slab[0].any(axis=(1, 2)))[0])
+            np.testing.assert_array_equal(x_slab[0][:, first], x[0])
+            np.testing.assert_array_equal(y_slab[1, 0], y_slab[0, 2])
+        assert 'slabs' in str(pipeline.config()['operations'])
+
+    def test_pool(self):
+        pipeline = self.pipeline(resize)
+        expected = [(x.copy(), y.copy()) for x, y in pipeline.process('training')]
+        pipeline.pool = BufferPool()
+        for staged in [False, True]:
+            for (x1, y1), (x2, y2) in zip(expected, pipeline.process('training', staged=staged)):
+                np.testing.assert_array_equal(x1, x2)
+                np.testing.assert_array_equal(y1, y2)
+        assert pipeline.pool.nbytes > 0
+        assert pipeline.config() == self.pipeline(resize).config()
+
+
+class TestParallelExecution(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        make_synthetic_dataset(cls.tmp_dir.name, 4, shape=(12, 160, 160), seed=1)
+        cls.pipeline = BraTSPipeline(cls.tmp_dir.name)
+        cls.pipeline.add_operation(resize)
+        cls.serial = list(cls.pipeline.process('training'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def test_same_output(self):
+        parallel = list(self.pipeline.process('training', workers=2, max_in_flight=1))
+        assert len(parallel) == len(self.serial) == 4
+        for (x1, y1), (x2, y2) in zip(self.serial, parallel):
+            np.testing.assert_array_equal(x1, x2)
+            np.testing.assert_array_equal(y1, y2)
+
+    def test_case_order(self):
+        cases = self.pipeline.cases('training')[::-1]
+        parallel = list(self.pipeline.process('training', workers=2, cases=cases))
+        for (_, y1), (_, y2) in zip(self.serial[::-1], parallel):
+            np.testing.assert_array_equal(y1, y2)
+
+    def test_max_in_flight(self):
+        submitted = []
+
+        def cases():
+            for case in self.pipeline.cases('training'):
+                submitted.append(case)
+                yield case
+
+        outputs = self.pipeline.process('training', workers=2, max_in_flight=2, cases=cases())
+        next(outputs)
+        # The third case is taken from the source, and only submitted once the first result is consumed
+        assert len(submitted) == 3
+        assert len(list(outputs)) == 3
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+from pipeline.preprocessing import one_hot, l2_normalize, minmax_normalize
+
+class TestOneHot(unittest.TestCase):
+
+    def test_encoding(self):
+        y = np.random.randint(0, 5, size=(3, 16, 16)).astype('uint8')
+        target = one_hot(y, 5)
+        assert target.shape == (3, 5, 16, 16) and target.dtype == np.uint8
+        np.testing.assert_array_equal(target.argmax(axis=1), y)
+        np.testing.assert_array_equal(target.sum(axis=1), 1)
+
+    def test_channel_last(self):
+        y = np.random.randint(0, 5, size=(3, 16, 16))
+        np.testing.assert_array_equal(one_hot(y, 5, axis=-1, dtype=np.float32), np.eye(5, dtype=np.float32)[y])
+
+
+class TestNormalize(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.random.rand(3, 4, 16, 16).astype('float32')
+        self.x[0, :, 0, 0] = 0
+
+    def test_l2(self):
+        norm = np.linalg.norm(self.x, axis=1, keepdims=True)
+        norm[norm == 0] = 1
+        expected = self.x / norm
+        x = l2_normalize(self.x, axis=1, out=self.x)
+        assert x is self.x
+        np.testing.assert_allclose(x, expected, rtol=1e-6)
+
+    def test_minmax(self):
+        x = minmax_normalize(self.x)
+        np.testing.assert_allclose(x.min(axis=(1, 2, 3)), 0)
+        np.testing.assert_allclose(x.max(axis=(1, 2, 3)), 1)
+        np.testing.assert_array_equal(minmax_normalize(np.ones((2, 4, 3, 3))), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
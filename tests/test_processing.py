@@ -0,0 +1,163 @@
+import unittest
+import numpy as np
+from pipeline.processing import resize, brain_bbox, brain_crop, select_slices, augment, extract_patches, slabs
+from pipeline.augmentations import Flip, RandomAugmentation
+
+class TestResize(unittest.TestCase):
+
+    n, c, w, h = 3, 4, 240, 240
+
+    def setUp(self):
+        self.x = np.random.rand(self.n, self.c, self.w, self.h).astype('float32')
+        self.y = np.random.randint(0, 5, size=(self.n, self.w, self.h)).astype('uint8')
+
+    def test_default_crop(self):
+        x, y = next(resize([(self.x, self.y)]))
+        assert x.shape == (self.n, self.c, 128, 128)
+        assert y.shape == (self.n, 128, 128)
+        np.testing.assert_array_equal(x, self.x[..., 56:184, 56:184])
+
+    def test_crop_is_a_view(self):
+        x, y = next(resize([(self.x, self.y)]))
+        assert np.shares_memory(x, self.x) and np.shares_memory(y, self.y)
+        x, y = next(resize([(self.x, self.y)], copy=True))
+        assert x.flags['C_CONTIGUOUS'] and not np.shares_memory(x, self.x)
+
+    def test_box(self):
+        x, y = next(resize([(self.x, self.y)], box=((10, 50), (20, 100))))
+        assert x.shape == (self.n, self.c, 40, 80)
+        assert y.shape == (self.n, 40, 80)
+
+
+class TestBrainCrop(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.zeros((2, 4, 240, 240), dtype='float32')
+        self.x[:, 1, 30:200, 60:150] = 1.
+        self.y = np.zeros((2, 240, 240), dtype='uint8')
+
+    def test_bbox(self):
+        assert brain_bbox(self.x) == ((30, 200), (60, 150))
+        assert brain_bbox(self.x, margin=40) == ((0, 240), (20, 190))
+        assert brain_bbox(np.zeros_like(self.x)) == ((0, 240), (0, 240))
+
+    def test_fixed_size(self):
+        x, y = next(brain_crop([(self.x, self.y)], size=(128, 128)))
+        assert x.shape == (2, 4, 128, 128)
+        assert y.shape == (2, 128, 128)
+        assert x.sum() == self.x[..., 51:179, 41:169].sum()
+
+
+class TestSelectSlices(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.zeros((10, 4, 8, 8), dtype='float32')
+        self.x[1:9, 0] = 1.
+        self.y = np.zeros((10, 8, 8), dtype='uint8')
+        self.y[[6, 3, 4], 2, 2] = 1
+
+    def test_policies(self):
+        np.testing.assert_array_equal(select_slices(self.x, self.y), [3, 4, 6])
+        np.testing.assert_array_equal(select_slices(self.x, self.y, 'brain'), np.arange(1, 9))
+        np.testing.assert_array_equal(select_slices(self.x, self.y, 'all'), np.arange(10))
+
+    def test_contiguous(self):
+        np.testing.assert_array_equal(select_slices(self.x, self.y, contiguous=True), [3, 4, 5, 6])
+
+    def test_background_ratio(self):
+        np.testing.assert_array_equal(select_slices(self.x, self.y, background_ratio=1.), [1, 3, 4, 5, 6, 8])
+        assert len(select_slices(self.x, self.y, background_ratio=10.)) == 8
+
+
+class TestAugment(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.random.rand(20, 4, 32, 32).astype('float32')
+        self.y = np.random.randint(0, 5, size=(20, 32, 32)).astype('uint8')
+
+    def test_augment(self):
+        x, y = next(augment([(self.x, self.y)], augment_ratio=0.2, seed=0))
+        assert x.shape == (40, 4, 32, 32) and y.shape == (40, 32, 32)
+        np.testing.assert_array_equal(x[:20], self.x)
+        assert set(np.unique(y)) <= set(range(5))
+        x_bis, y_bis = next(augment([(self.x, self.y)], augment_ratio=0.2, seed=0))
+        np.testing.assert_array_equal(x, x_bis)
+        np.testing.assert_array_equal(y, y_bis)
+
+    def test_flip(self):
+        x, y = Flip(random=False)(self.x, self.y)
+        np.testing.assert_allclose(x, self.x[..., ::-1])
+        np.testing.assert_array_equal(y, self.y[..., ::-1])
+
+    def test_random_augmentation(self):
+        augmentation = RandomAugmentation([Flip(random=False)], ratio=0.5)
+        x, y = augmentation(self.x, self.y, np.random.default_rng(0))
+        flipped = np.all(x == self.x[..., ::-1], axis=(1, 2, 3))
+        assert np.all(flipped | np.all(x == self.x, axis=(1, 2, 3))) and 0 < flipped.sum() < 20
+        np.testing.assert_array_equal(y[flipped], self.y[flipped][..., ::-1])
+
+    def test_one_hot(self):
+        y = (self.y[:, None] == np.arange(5)[:, None, None]).astype('uint8')
+        _, y_out = Flip(random=False)(self.x, y)
+        np.testing.assert_array_equal(y_out, y[..., ::-1])
+        _, y_out = RandomAugmentation([Flip(random=False)], ratio=0)(self.x, y)
+        np.testing.assert_array_equal(y_out, y)
+
+
+class TestExtractPatches(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.random.rand(10, 4, 40, 40).astype('float32')
+        self.y = np.zeros((10, 40, 40), dtype='uint8')
+        self.y[4:6, 10:20, 10:20] = 2
+        self.y[5, 25:30, 25:30] = 4
+
+    def test_patches(self):
+        x, y = next(extract_patches([(self.x, self.y)], size=16, n_patches=20, seed=0))
+        assert x.shape == (20, 4, 16, 16) and y.shape == (20, 16, 16)
+        for patch_x, patch_y in zip(x, y):
+            n, r, c = [int(v[0]) for v in np.nonzero(self.x[:, 0] == patch_x[0, 0, 0])]
+            np.testing.assert_array_equal(patch_x, self.x[n, :, r:r + 16, c:c + 16])
+            np.testing.assert_array_equal(patch_y, self.y[n, r:r + 16, c:c + 16])
+
+    def test_rates(self):
+        _, y = next(extract_patches([(self.x, self.y)], size=8, n_patches=30, rates=(0, 0, 1, 0, 0), seed=0))
+        assert np.all(y[:, 4, 4] == 2)
+        _, y = next(extract_patches([(self.x, self.y)], size=8, n_patches=30, rates=(0, 0, 0.5, 0, 0.5), seed=0))
+        assert set(np.unique(y[:, 4, 4])) == {2, 4}
+        _, y = next(extract_patches([(self.x, self.y)], size=8, n_patches=30, rates=(0, 1, 0, 0, 0), seed=0))
+        assert y.shape == (0, 8, 8)
+
+    def test_no_patches(self):
+        x, y = next(extract_patches([(self.x, self.y)], size=8, n_patches=0, seed=0))
+        assert x.shape == (0, 4, 8, 8) and y.shape == (0, 8, 8)
+        x, y = next(extract_patches([(self.x, self.y)], size=8, n_patches=0, depth=3, seed=0))
+        assert x.shape == (0, 4, 3, 8, 8) and y.shape == (0, 3, 8, 8)
+
+    def test_volumetric(self):
+        x, y = next(extract_patches([(self.x, self.y)], size=16, n_patches=5, depth=3, seed=0))
+        assert x.shape == (5, 4, 3, 16, 16) and y.shape == (5, 3, 16, 16)
+
+
+class TestSlabs(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.random.rand(10, 4, 8, 8).astype('float32')
+        self.y = np.random.randint(0, 5, size=(10, 8, 8)).astype('uint8')
+
+    def test_slabs(self):
+        x, y = next(slabs([(self.x, self.y)], depth=4, stride=3))
+        assert x.shape == (3, 4, 4, 8, 8) and y.shape == (3, 4, 8, 8) and x.flags.c_contiguous
+        np.testing.assert_array_equal(x[1], self.x[3:7].swapaxes(0, 1))
+        np.testing.assert_array_equal(y[2], self.y[6:10])
+
+    def test_pad(self):
+        x, y = next(slabs([(self.x, self.y)], depth=4, pad=True))
+        assert x.shape == (3, 4, 4, 8, 8)
+        np.testing.assert_array_equal(y[2, :2], self.y[8:])
+        assert not y[2, 2:].any() and not x[2, :, 2:].any()
+        x, y = next(slabs([(self.x[:2], self.y[:2])], depth=4))
+        assert x.shape == (0, 4, 4, 8, 8)
+
+if __name__ == '__main__':
+    unittest.main()
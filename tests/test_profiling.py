@@ -0,0 +1,55 @@
+import time, unittest
+import numpy as np
+from functools import partial
+from pipeline.processing import resize
+from pipeline.profiling import PipelineProfiler
+
+def cases(source):
+    for n in source:
+        yield np.zeros((n, 4, 240, 240), dtype='float32'), np.zeros((n, 240, 240), dtype='uint8')
+
+def slow(source, seconds=0.):
+    for x, y in source:
+        time.sleep(seconds)
+        yield x, y
+
+class TestPipelineProfiler(unittest.TestCase):
+
+    def run_pipeline(self, profiler, operations):
+        source = [1, 2, 3]
+        for ops in profiler.instrument(operations):
+            source = ops(source)
+        return list(source)
+
+    def test_counts(self):
+        profiler = PipelineProfiler()
+        results = self.run_pipeline(profiler, [cases, resize, resize])
+        assert len(results) == 3
+        stages = {stage['name']: stage for stage in profiler.report()['stages']}
+        assert list(stages) == ['cases', 'resize', 'resize#2']
+        assert stages['cases']['items_in'] == 3 and stages['resize#2']['items_out'] == 3
+        assert stages['cases']['bytes_out'] == 6 * (4 * 4 + 1) * 240 * 240
+        assert stages['resize']['bytes_out'] == 6 * (4 * 4 + 1) * 128 * 128
+
+    def test_exclusive_time(self):
+        profiler = PipelineProfiler()
+        self.run_pipeline(profiler, [cases, partial(slow, seconds=0.02), resize])
+        stages = {stage['name']: stage for stage in profiler.report()['stages']}
+        assert stages['slow']['seconds'] >= 0.06
+        assert stages['resize']['seconds'] < 0.03 <= stages['resize']['inclusive_seconds'] - 0.03
+
+    def test_hooks_and_merge(self):
+        events = []
+        profiler = PipelineProfiler(profile=True, hooks=[lambda name, event: events.append((name, event))])
+        self.run_pipeline(profiler, [cases, resize])
+        assert events[:4] == [('resize', 'enter'), ('cases', 'enter'), ('cases', 'exit'), ('resize', 'exit')]
+        total = PipelineProfiler()
+        total.merge(profiler.state())
+        total.merge(profiler.state())
+        stages = {stage['name']: stage for stage in total.report()['stages']}
+        assert stages['resize']['items_out'] == 6
+        assert set(total.profiles) == {'cases', 'resize'}
+
+
+if __name__ == '__main__':
+    unittest.main()
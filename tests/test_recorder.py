@@ -0,0 +1,157 @@
+import os, json, tempfile, unittest
+import numpy as np
+from pipeline.writers import check_image_dtype
+try:
+    import tensorflow as tf
+    from pipeline.recorder import ShardedTFRecordWriter
+    from pipeline.writers import TFRecordCaseWriter
+    from .utils.tfrecorder import TrainingRecorder
+except ImportError:
+    tf = None
+
+def count_records(path, compression=None):
+    return sum(1 for _ in tf.data.TFRecordDataset(path, compression_type=compression))
+
+
+class TestImageDtype(unittest.TestCase):
+
+    def test_unscaled_uint8(self):
+        with self.assertRaises(ValueError):
+            check_image_dtype('uint8', rescale=False)
+        with self.assertRaises(ValueError):
+            check_image_dtype('int16', rescale=True)
+        for image_dtype in ['float32', 'float16', 'uint8']:
+            check_image_dtype(image_dtype, rescale=True)
+        check_image_dtype('float16', rescale=False)
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed')
+class TestShardedTFRecordWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = self.tmp_dir.name
+        rng = np.random.default_rng(0)
+        self.x = rng.random((10, 8, 8, 4), dtype=np.float32)
+        self.y = rng.integers(0, 5, (10, 8, 8)).astype(np.uint8)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def manifest(self):
+        with open(os.path.join(self.path, ShardedTFRecordWriter.manifest_name), 'r') as f:
+            return json.load(f)
+
+    def test_samples_per_shard(self):
+        with ShardedTFRecordWriter(self.path, prefix='training', samples_per_shard=4, workers=2,
+                                   compression='GZIP') as writer:
+            writer.write(self.x[:6].copy(), self.y[:6])
+            writer.write(self.x[6:].copy(), self.y[6:])
+        manifest = self.manifest()
+        assert [shard['samples'] for shard in manifest['shards']] == [4, 4, 2]
+        assert [shard['file'] for shard in manifest['shards']] == ['training-{:05d}.tfrecord'.format(i) for i in range(3)]
+        assert manifest['samples'] == 10 and manifest['compression'] == 'GZIP'
+        assert manifest['schema'] == {'image': {'dtype': 'float32', 'shape': [8, 8, 4]},
+                                      'ground_truth': {'encoding': 'int64', 'shape': [8, 8]}}
+        for shard in manifest['shards']:
+            assert count_records(os.path.join(self.path, shard['file']), 'GZIP') == shard['samples']
+
+    def test_shard_size(self):
+        record = ShardedTFRecordWriter(self.path, workers=1, rescale=False).serialize(self.x[:1], self.y[:1])[0]
+        with ShardedTFRecordWriter(self.path, shard_size_mb=3.5 * len(record) / 2 ** 20, rescale=False) as writer:
+            writer.write(self.x.copy(), self.y)
+        shards = self.manifest()['shards']
+        assert [shard['samples'] for shard in shards] == [3, 3, 3, 1]
+        assert all(shard['bytes'] == shard['samples'] * len(record) for shard in shards)
+
+    def test_resume(self):
+        writer = ShardedTFRecordWriter(self.path, samples_per_shard=4, rescale=False)
+        writer.write(self.x[:6].copy(), self.y[:6])
+        state = json.loads(json.dumps(writer.checkpoint()))
+        writer.write(self.x[6:].copy(), self.y[6:])
+        writer.close()
+        with ShardedTFRecordWriter(self.path, samples_per_shard=4, rescale=False, state=state) as writer:
+            writer.write(self.x[6:9].copy(), self.y[6:9])
+        manifest = self.manifest()
+        assert [shard['samples'] for shard in manifest['shards']] == [4, 4, 1] and manifest['samples'] == 9
+        assert sorted(os.listdir(self.path)) == [ShardedTFRecordWriter.manifest_name] + \
+            ['data-{:05d}.tfrecord'.format(i) for i in range(3)]
+        files = [os.path.join(self.path, shard['file']) for shard in manifest['shards']]
+        images = [tf.io.parse_single_example(record, {'image': tf.io.FixedLenFeature([], tf.string)})['image']
+                  for record in tf.data.TFRecordDataset(files)]
+        images = np.stack([np.frombuffer(image.numpy(), np.float32).reshape(8, 8, 4) for image in images])
+        np.testing.assert_array_equal(images, self.x[:9])
+
+    def test_empty_slice(self):
+        x = self.x.copy()
+        x[3] = 0
+        with ShardedTFRecordWriter(self.path, samples_per_shard=4) as writer:
+            writer.write(x.copy(), self.y)
+        TFRecordCaseWriter(self.path, 'training').write(0, 'case_0', np.moveaxis(x, 3, 1).copy(), self.y)
+        for name in ['data-00000.tfrecord', 'training_case_0.tfrecord']:
+            images = [tf.io.parse_single_example(record, {'image': tf.io.FixedLenFeature([], tf.string)})['image']
+                      for record in tf.data.TFRecordDataset(os.path.join(self.path, name))]
+            images = np.stack([np.frombuffer(image.numpy(), np.float32) for image in images])
+            assert np.isfinite(images).all() and not images[3].any()
+            np.testing.assert_allclose(images.max(axis=1)[:3], 255, rtol=1e-5)
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed')
+class TestSchemaRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = self.tmp_dir.name
+        rng = np.random.default_rng(0)
+        self.x = rng.integers(0, 256, (6, 4, 8, 8)).astype(np.float32)
+        # Slices are scaled by their maximum, which leaves them unchanged
+        self.x[:, 0, 0, 0] = 255
+        self.y = rng.integers(0, 5, (6, 8, 8)).astype(np.uint8)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read(self):
+        recorder, files, n_samples = TrainingRecorder.from_manifest(
+            os.path.join(self.path, ShardedTFRecordWriter.manifest_name), normalization=None)
+        protos = tf.stack(list(tf.data.TFRecordDataset(files, compression_type=recorder.compression_type)))
+        x, y = recorder.parse_batch(protos)
+        assert len(protos) == n_samples
+        return x.numpy(), np.argmax(y.numpy(), axis=-1)
+
+    def test_sharded(self):
+        for label_encoding in ['int64', 'uint8']:
+            for image_dtype in ['float32', 'float16', 'uint8']:
+                with ShardedTFRecordWriter(self.path, samples_per_shard=4, label_encoding=label_encoding,
+                                           image_dtype=image_dtype) as writer:
+                    writer.write(np.moveaxis(self.x, 1, 3).copy(), self.y)
+                x, y = self.read()
+                np.testing.assert_array_equal(x, np.moveaxis(self.x, 1, 3))
+                np.testing.assert_array_equal(y, self.y)
+
+    def test_per_case(self):
+        writer = TFRecordCaseWriter(self.path, 'training', label_encoding='uint8', image_dtype='uint8')
+        writer.write(0, 'case_0', self.x[:4].copy(), self.y[:4])
+        writer.close()
+        # A resumed run keeps the cases written before
+        writer = TFRecordCaseWriter(self.path, 'training', label_encoding='uint8', image_dtype='uint8')
+        writer.write(1, 'case_1', self.x[4:].copy(), self.y[4:])
+        writer.close()
+        with open(os.path.join(self.path, ShardedTFRecordWriter.manifest_name), 'r') as f:
+            manifest = json.load(f)
+        assert manifest['schema']['ground_truth']['encoding'] == 'uint8'
+        assert [shard['file'] for shard in manifest['shards']] == ['training_case_0.tfrecord', 'training_case_1.tfrecord']
+        x, y = self.read()
+        np.testing.assert_array_equal(x, np.moveaxis(self.x, 1, 3))
+        np.testing.assert_array_equal(y, self.y)
+
+    def test_unscaled_uint8(self):
+        with self.assertRaises(ValueError):
+            TFRecordCaseWriter(self.path, 'training', image_dtype='uint8', rescale=False)
+        with self.assertRaises(ValueError):
+            ShardedTFRecordWriter(self.path, image_dtype='uint8', rescale=False)
+        TFRecordCaseWriter(self.path, 'training', image_dtype='float16', rescale=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os, json, tempfile, unittest
+import numpy as np
+import h5py
+from pipeline.h5 import HDF5Store
+from pipeline.npy import NPYStore, NPYDataset
+from pipeline.sharding import case_shard, partition, merge_h5, merge_npy
+
+class TestPartition(unittest.TestCase):
+
+    def test_stable_partition(self):
+        cases = ['data/training/pat{:03d}'.format(i) for i in range(100)]
+        shards = [partition(cases, 4, k) for k in range(4)]
+        assert sorted(sum(shards, [])) == cases
+        assert all(len(shard) > 10 for shard in shards)
+        more = partition(cases + ['data/training/new_case'], 4, 1)
+        assert [case for case in more if case in cases] == shards[1]
+        assert case_shard('/other/root/pat007/', 4) == case_shard(cases[7], 4)
+        with self.assertRaises(ValueError):
+            partition(cases, 4, 4)
+
+
+class TestMerge(unittest.TestCase):
+
+    shapes = [(4, 8, 8), (8, 8)]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.sources = [os.path.join(self.tmp_dir.name, 'shard-{}'.format(k)) for k in range(3)]
+        self.merged = os.path.join(self.tmp_dir.name, 'merged')
+        for path in self.sources + [self.merged]:
+            os.makedirs(path)
+        self.x = np.random.rand(10, *self.shapes[0]).astype('float32')
+        self.y = np.random.randint(0, 5, size=(10, ) + self.shapes[1]).astype('uint8')
+        self.rows = [(0, 4), (4, 4), (4, 10)]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_h5(self):
+        for source, (start, stop) in zip(self.sources, self.rows):
+            with HDF5Store(os.path.join(source, 'data.h5'), ['X', 'Y'], self.shapes, [np.float32, np.uint8]) as store:
+                store.append_batch('X', self.x[start:stop])
+                store.append_batch('Y', self.y[start:stop])
+        merge_h5([os.path.join(source, 'data.h5') for source in self.sources], os.path.join(self.merged, 'data.h5'))
+        with h5py.File(os.path.join(self.merged, 'data.h5'), 'r') as h5f:
+            np.testing.assert_array_equal(h5f['X'][:], self.x)
+            np.testing.assert_array_equal(h5f['Y'][:], self.y)
+
+    def test_npy(self):
+        for k, (source, (start, stop)) in enumerate(zip(self.sources, self.rows)):
+            with NPYStore(source, ['x', 'y'], self.shapes, [np.float32, np.uint8]) as store:
+                if stop > start:
+                    store.append_case('case_{}'.format(k), [self.x[start:stop], self.y[start:stop]])
+        merge_npy(self.sources, self.merged)
+        dataset = NPYDataset(self.merged)
+        assert len(dataset) == 10 and dataset.cases == ['case_0', 'case_2']
+        np.testing.assert_array_equal(dataset[7][0], self.x[7])
+        np.testing.assert_array_equal(dataset[-1][1], self.y[-1])
+        assert dataset.case_slices(1) == slice(4, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
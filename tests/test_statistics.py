@@ -0,0 +1,57 @@
+import os, tempfile, unittest
+import numpy as np
+from pipeline.statistics import IntensityStats, affine_normalize
+from pipeline.processing import extract_patches
+
+class TestIntensityStats(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.volumes = [rng.normal(600, 150, (2, 10, 32, 32)).clip(0, None) for _ in range(3)]
+
+    def stats(self, volumes):
+        stats = IntensityStats(channels=2, bins=2048, high=2048)
+        for volume in volumes:
+            for channel in range(2):
+                stats.update(channel, volume[channel])
+        return stats
+
+    def test_merge(self):
+        merged = self.stats(self.volumes[:1]).merge(self.stats(self.volumes[1:]))
+        values = np.concatenate([v.reshape(2, -1) for v in self.volumes], axis=1)
+        values = [v[v > 0] for v in values]
+        np.testing.assert_allclose(merged.mean, [v.mean() for v in values])
+        np.testing.assert_allclose(merged.std, [v.std() for v in values])
+        np.testing.assert_allclose(merged.percentile(99), [np.percentile(v, 99) for v in values], atol=1)
+        np.testing.assert_array_equal(merged.histogram, self.stats(self.volumes).histogram)
+
+    def test_save(self):
+        stats = self.stats(self.volumes)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stats.save(os.path.join(tmp_dir, 'stats.json'))
+            loaded = IntensityStats.load(os.path.join(tmp_dir, 'stats.json'))
+        assert loaded.normalization('percentile') == stats.normalization('percentile')
+
+    def test_affine_normalize(self):
+        stats = self.stats(self.volumes)
+        x = np.moveaxis(self.volumes[0], 0, 1).astype('float32')
+        y = np.zeros((10, 32, 32), dtype='uint8')
+        out, _ = next(affine_normalize([(x, y)], **stats.normalization('zscore')))
+        assert out is x
+        np.testing.assert_allclose(out.mean(axis=(0, 2, 3)), 0, atol=0.1)
+        np.testing.assert_allclose(out.std(axis=(0, 2, 3)), 1, atol=0.1)
+
+    def test_volumetric_patches(self):
+        normalization = {'scale': [1., 2., 3., 4.], 'offset': [0., 1., 2., 3.]}
+        x = np.ones((10, 4, 32, 32), dtype='float32')
+        y = np.zeros((10, 32, 32), dtype='uint8')
+        for depth in [3, 4]:
+            patches, labels = next(extract_patches([(x.copy(), y)], size=16, n_patches=5, depth=depth, seed=0))
+            out, _ = next(affine_normalize([(patches, labels)], **normalization))
+            assert out.shape == (5, 4, depth, 16, 16)
+            for channel, value in enumerate([1, 3, 5, 7]):
+                assert np.all(out[:, channel] == value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,17 @@
 import unittest
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
-from .utils.tfrecorder import TrainingRecorder
+import numpy as np
 from glob import glob
+from pipeline.augmentations import Augmentation, Flip, ElasticTransform, RandomAugmentation
+from pipeline.preprocessing import l2_normalize, minmax_normalize
+try:
+    import tensorflow as tf
+    from .utils.tfrecorder import TrainingRecorder
+except ImportError:
+    tf = None
 
+@unittest.skipIf(tf is None, 'TensorFlow is not installed')
 class TestTFRecorder(unittest.TestCase):
 
     n, w, h, c  = 1, 128, 128, 4
@@ -23,5 +31,84 @@ class TestTFRecorder(unittest.TestCase):
         x, y = next(iter(training_dataset))
         assert y.shape == [self.n, self.w, self.h, self.n_class]
 
+@unittest.skipIf(tf is None, 'TensorFlow is not installed')
+class TestTFAugmentation(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.x = tf.constant(rng.random((3, 32, 32, 4), dtype=np.float32))
+        self.y = tf.constant(rng.integers(0, 5, (3, 32, 32)).astype(np.uint8))
+
+    def augment(self, augmentation, seed=(0, 0)):
+        recorder = TrainingRecorder(x_shape=[32, 32, 4], y_shape=[32, 32], augmentation=augmentation)
+        x, y = recorder.augment(self.x, self.y, tf.constant(seed, tf.int64))
+        return x.numpy(), y.numpy()
+
+    def test_shapes(self):
+        x, y = self.augment(RandomAugmentation(ratio=1))
+        assert x.shape == (3, 32, 32, 4) and x.dtype == np.float32
+        assert y.shape == (3, 32, 32) and y.dtype == np.uint8
+        assert set(np.unique(y)) <= set(range(5))
+
+    def test_identity(self):
+        x, y = self.augment(Augmentation())
+        np.testing.assert_allclose(x, self.x.numpy())
+        np.testing.assert_array_equal(y, self.y.numpy())
+        x, y = self.augment(RandomAugmentation(ratio=0))
+        np.testing.assert_array_equal(y, self.y.numpy())
+        _, y = self.augment(Flip(random=False))
+        np.testing.assert_array_equal(y, self.y.numpy()[:, :, ::-1])
+
+    def test_seed(self):
+        for augmentation in [RandomAugmentation(ratio=1), ElasticTransform(alpha=100, sigma=4)]:
+            x1, y1 = self.augment(augmentation, (1, 2))
+            x2, y2 = self.augment(augmentation, (1, 2))
+            x3, _ = self.augment(augmentation, (1, 3))
+            np.testing.assert_array_equal(x1, x2)
+            np.testing.assert_array_equal(y1, y2)
+            assert not np.array_equal(x1, x3)
+
+    def test_iterator_seed(self):
+        recorder = TrainingRecorder(x_shape=[32, 32, 4], y_shape=[32, 32], augmentation=RandomAugmentation(), seed=5)
+        protos = tf.constant(['a', 'b'])
+        np.testing.assert_array_equal(recorder._batch_seed(protos, 7).numpy(), [5, 7])
+        np.testing.assert_array_equal(recorder._batch_seed(protos, None).numpy(),
+                                      recorder._batch_seed(protos, None).numpy())
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed')
+class TestTFNormalization(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.x = rng.normal(500, 100, (3, 16, 16, 4)).astype(np.float32)
+        self.x[0, 2, 3] = 0
+        self.x[1, ..., 2] = 7
+
+    def normalize(self, normalization):
+        recorder = TrainingRecorder(x_shape=[16, 16, 4], y_shape=[16, 16], normalization=normalization)
+        x, _ = recorder.normalize(tf.constant(self.x), None)
+        return x.numpy()
+
+    def test_l2(self):
+        x = self.normalize('l2')
+        np.testing.assert_allclose(x, l2_normalize(self.x, axis=-1), rtol=1e-5)
+        np.testing.assert_allclose(x, tf.keras.utils.normalize(self.x, axis=-1), rtol=1e-5)
+        assert not x[0, 2, 3].any()
+
+    def test_minmax(self):
+        np.testing.assert_allclose(self.normalize('minmax'), minmax_normalize(self.x, axis=(1, 2)), atol=1e-6)
+
+    def test_zscore(self):
+        x = self.normalize('zscore')
+        mean, std = self.x.mean(axis=(1, 2), keepdims=True), self.x.std(axis=(1, 2), keepdims=True)
+        np.testing.assert_allclose(x, np.divide(self.x - mean, std, out=np.zeros_like(self.x), where=std > 0),
+                                   rtol=1e-3, atol=1e-4)
+        assert not x[1, ..., 2].any()
+
+    def test_none(self):
+        np.testing.assert_array_equal(self.normalize(None), self.x)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,9 @@
+import os, json
+import numpy as np
 import tensorflow as tf
 from abc import ABC, abstractmethod
+from pipeline.augmentations import (Augmentation, Rotation, Flip, Shear, Shift, ElasticTransform,
+                                    Compose, RandomAugmentation)
 
 class AbstractRecorder(ABC):
     """Class to read tfrecord and create tensorflow datasets
@@ -19,8 +23,8 @@ class AbstractRecorder(ABC):
         super().__init__()
         self.x_shape = x_shape
         self.y_shape = y_shape
-        self.x_dtype = tf.float32
-        self.y_dtype = tf.uint8
+        self.x_dtype = x_dtype
+        self.y_dtype = y_dtype
     
     @abstractmethod
     def parse_function(self):
@@ -31,6 +35,141 @@ class AbstractRecorder(ABC):
         raise NotImplementedError
 
 
+def _sub_seed(seed, k):
+    """Seed of the k-th random op derived from `seed`"""
+    return tf.random.stateless_uniform([k + 1, 2], seed, minval=0, maxval=2 ** 31 - 1, dtype=tf.int64)[k]
+
+def _homogeneous(linear, offset):
+    n = tf.shape(linear)[0]
+    bottom = tf.tile(tf.constant([[[0., 0., 1.]]]), tf.stack([n, 1, 1]))
+    return tf.concat([tf.concat([linear, offset[:, :, None]], axis=2), bottom], axis=1)
+
+def _linear(linear, shape):
+    """Homogeneous matrices applying linear transforms around the center of the slices."""
+    center = (tf.cast(shape, tf.float32) - 1) / 2
+    return _homogeneous(linear, center - tf.reduce_sum(linear * center, axis=-1))
+
+def _gaussian_kernel(sigma, truncate=4.0):
+    """Same kernel as scipy.ndimage.gaussian_filter"""
+    radius = int(truncate * sigma + 0.5)
+    kernel = np.exp(-0.5 * np.arange(-radius, radius + 1) ** 2 / sigma ** 2)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+def matrices(augmentation, n, shape, seed):
+    """Affine matrices of a batch drawn with TensorFlow ops, see Augmentation.matrices
+
+    Parameters
+    ----------
+    augmentation : pipeline.augmentations.Augmentation
+        Augmentation
+    n : tf.Tensor
+        Number of slices
+    shape : tf.Tensor
+        Shape (width, height) of the slices
+    seed : tf.Tensor
+        Seed of shape (2, ) of the random ops
+
+    Return
+    ----------
+    matrices : tf.Tensor
+        Matrices of shape (n, 3, 3)
+    """
+    identity = tf.tile(tf.eye(2)[None], tf.stack([n, 1, 1]))
+    if isinstance(augmentation, Compose):
+        result = _homogeneous(identity, tf.zeros(tf.stack([n, 2])))
+        for k, child in enumerate(augmentation.augmentations):
+            result = tf.matmul(result, matrices(child, n, shape, _sub_seed(seed, k)))
+        return result
+    if isinstance(augmentation, Rotation):
+        if augmentation.random:
+            angles = tf.random.stateless_uniform(tf.stack([n]), seed, -augmentation.degrees, augmentation.degrees)
+        else:
+            angles = tf.fill(tf.stack([n]), float(augmentation.degrees))
+        angles = angles * (np.pi / 180)
+        cos, sin = tf.cos(angles), tf.sin(angles)
+        return _linear(tf.stack([tf.stack([cos, -sin], -1), tf.stack([sin, cos], -1)], 1), shape)
+    if isinstance(augmentation, Flip):
+        if augmentation.random:
+            flip = tf.random.stateless_uniform(tf.stack([n]), seed) < 0.5
+        else:
+            flip = tf.ones(tf.stack([n]), dtype=tf.bool)
+        sign = tf.where(flip, -tf.ones(tf.stack([n])), tf.ones(tf.stack([n])))
+        diagonal = [tf.ones(tf.stack([n])), tf.ones(tf.stack([n]))]
+        diagonal[augmentation.axis] = sign
+        return _linear(tf.linalg.diag(tf.stack(diagonal, -1)), shape)
+    if isinstance(augmentation, Shear):
+        shear = tf.random.stateless_uniform(tf.stack([n]), seed, -augmentation.intensity, augmentation.intensity)
+        ones, zeros = tf.ones_like(shear), tf.zeros_like(shear)
+        return _linear(tf.stack([tf.stack([ones, -tf.sin(shear)], -1), tf.stack([zeros, tf.cos(shear)], -1)], 1), shape)
+    if isinstance(augmentation, Shift):
+        ranges = tf.cast(shape, tf.float32) * [augmentation.hrg, augmentation.wrg]
+        return _homogeneous(identity, tf.random.stateless_uniform(tf.stack([n, 2]), seed, -1, 1) * ranges)
+    if type(augmentation).matrices is Augmentation.matrices:
+        return _homogeneous(identity, tf.zeros(tf.stack([n, 2])))
+    raise ValueError('{} has no TensorFlow implementation'.format(type(augmentation).__name__))
+
+def displacement(augmentation, n, shape, seed):
+    """Displacement fields of a batch drawn with TensorFlow ops, see Augmentation.displacement
+
+    Return
+    ----------
+    displacement : tf.Tensor
+        Displacement of shape (2, n, width, height), None for affine only augmentations
+    """
+    if isinstance(augmentation, Compose):
+        fields = [displacement(child, n, shape, _sub_seed(seed, k)) for k, child in enumerate(augmentation.augmentations)]
+        fields = [field for field in fields if field is not None]
+        return tf.add_n(fields) if fields else None
+    if isinstance(augmentation, ElasticTransform):
+        field = tf.random.stateless_uniform(tf.concat([[2 * n], shape, [1]], 0), seed, -1, 1)
+        # Separable gaussian filter, zero padded as with mode='constant'
+        kernel = _gaussian_kernel(augmentation.sigma)
+        field = tf.nn.conv2d(field, kernel.reshape(-1, 1, 1, 1), strides=1, padding='SAME')
+        field = tf.nn.conv2d(field, kernel.reshape(1, -1, 1, 1), strides=1, padding='SAME')
+        return tf.reshape(field, tf.concat([[2, n], shape], 0)) * augmentation.alpha
+    if type(augmentation).displacement is Augmentation.displacement:
+        return None
+    raise ValueError('{} has no TensorFlow implementation'.format(type(augmentation).__name__))
+
+def coordinates(augmentation, n, shape, seed):
+    """Input coordinates of every output pixel of a batch, computed with TensorFlow ops
+    only so batches can be augmented inside a parallel tf.data map. Same distributions
+    as Augmentation.coordinates, drawn with stateless random ops.
+
+    Parameters
+    ----------
+    augmentation : pipeline.augmentations.Augmentation
+        Augmentation
+    n : tf.Tensor
+        Number of slices
+    shape : tf.Tensor
+        Shape (width, height) of the slices
+    seed : tf.Tensor
+        Seed of shape (2, ) of the random ops
+
+    Return
+    ----------
+    coordinates : tf.Tensor
+        Coordinates of shape (2, n, width, height)
+    """
+    rows, cols = tf.meshgrid(tf.range(shape[0]), tf.range(shape[1]), indexing='ij')
+    grid = tf.cast(tf.stack([rows, cols]), tf.float32)
+    if isinstance(augmentation, RandomAugmentation):
+        selected = tf.random.stateless_uniform(tf.stack([n]), _sub_seed(seed, 0)) < augmentation.ratio
+        choice = tf.random.stateless_uniform(tf.stack([n]), _sub_seed(seed, 1), 0, len(augmentation.augmentations),
+                                             dtype=tf.int32)
+        choice = tf.where(selected, choice, -tf.ones_like(choice))
+        result = tf.tile(grid[:, None], tf.stack([1, n, 1, 1]))
+        for i, child in enumerate(augmentation.augmentations):
+            result = tf.where((choice == i)[None, :, None, None],
+                              coordinates(child, n, shape, _sub_seed(seed, i + 2)), result)
+        return result
+    affine = matrices(augmentation, n, shape, _sub_seed(seed, 0))
+    result = tf.einsum('nij,jwh->inwh', affine[:, :2, :2], grid) + tf.transpose(affine[:, :2, 2])[..., None, None]
+    field = displacement(augmentation, n, shape, _sub_seed(seed, 1))
+    return result if field is None else result + field
+
+
 class TrainingRecorder(AbstractRecorder):
     """Class to read tfrecords and create the training dataset
     ...
@@ -44,9 +183,63 @@ class TrainingRecorder(AbstractRecorder):
         Type to use for data array
     y_dtype: str
         Type to use for label array
+    image_dtype : str
+        Type of the image bytes stored in tfrecord files
+    label_encoding : str
+        'int64' if the ground truth is stored as an Int64List, 'uint8' if stored as raw bytes
+    compression_type : str
+        Compression of the tfrecord files, None, 'GZIP' or 'ZLIB'
+    normalization : str
+        Normalization of the images, 'l2', 'minmax', 'zscore' or None
+    augmentation : pipeline.augmentations.Augmentation
+        Augmentation applied to every batch while reading, e.g. RandomAugmentation,
+        so only original slices need to be stored. Default to None
+    seed : int
+        Seed of the augmentations, which then only depend on the seed and the position
+        of the batch. Default to None (not reproducible)
     """
-    def __init__(self, x_shape, y_shape, x_dtype = tf.float32, y_dtype = tf.uint8):
+    normalizations = ['l2', 'minmax', 'zscore', None]
+
+    def __init__(self, x_shape, y_shape, x_dtype = tf.float32, y_dtype = tf.uint8,
+                 image_dtype = tf.float32, label_encoding = 'int64', compression_type = None,
+                 normalization = 'l2', augmentation = None, seed = None):
         super().__init__(x_shape, y_shape, x_dtype, y_dtype)
+        if normalization not in self.normalizations:
+            raise ValueError('normalization has to be in {}'.format(self.normalizations))
+        self.normalization = normalization
+        self.image_dtype = tf.as_dtype(image_dtype)
+        self.label_encoding = label_encoding
+        self.compression_type = compression_type
+        self.augmentation = augmentation
+        self.seed = seed
+
+    @classmethod
+    def from_manifest(cls, path, **kwargs):
+        """Create a recorder matching the schema of a shards.json manifest
+        
+        Parameters
+        ----------
+        path : str
+            Path of the manifest written by ShardedTFRecordWriter
+            
+        Return
+        ----------
+        recorder : TrainingRecorder
+        filenames : list
+            Paths of the shards listed in the manifest
+        n_samples : int
+            Total number of examples
+        """
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        schema = manifest['schema']
+        recorder = cls(x_shape = schema['image']['shape'],
+                       y_shape = schema['ground_truth']['shape'],
+                       image_dtype = schema['image']['dtype'],
+                       label_encoding = schema['ground_truth']['encoding'],
+                       compression_type = manifest['compression'], **kwargs)
+        filenames = [os.path.join(os.path.dirname(path), shard['file']) for shard in manifest['shards']]
+        return recorder, filenames, manifest['samples']
 
     def parse_function(self, proto):
         """Parse function to create the training Dataset object
@@ -56,30 +249,126 @@ class TrainingRecorder(AbstractRecorder):
         proto : str
             A scalar string Tensor, single serialized tf Example.
         """
-        features = {
+        record = tf.io.parse_single_example(proto, self._features())
+        image, label = self._decode(record, [])
+        if self.augmentation is not None:
+            image, label = self.augment(image[None], label[None], self._batch_seed(proto, None))
+            image, label = image[0], label[0]
+        return self.normalize(image, self._one_hot(label))
+
+    def parse_batch(self, protos, index = None):
+        """Parse a batch of examples at once with tf.io.parse_example
+        
+        Parameters
+        ----------
+        protos : str
+            A string Tensor of shape (batch_size, ), serialized tf Examples.
+        index : int
+            Position of the batch in the dataset, from which its augmentations are
+            seeded. Default to None (seeded from the content of the batch)
+        """
+        record = tf.io.parse_example(protos, self._features())
+        image, label = self._decode(record, [-1])
+        if self.augmentation is not None:
+            image, label = self.augment(image, label, self._batch_seed(protos, index))
+        return self.normalize(image, self._one_hot(label))
+
+    def _features(self):
+        if self.label_encoding == 'uint8':
+            label_feature = tf.io.FixedLenFeature([], dtype=tf.string)
+        else:
+            label_feature = tf.io.FixedLenFeature(self.y_shape, dtype=tf.int64)
+        return {
             'image': tf.io.FixedLenFeature([], dtype=tf.string),
-            'ground_truth': tf.io.FixedLenFeature(self.y_shape, dtype=tf.int64)
+            'ground_truth': label_feature
         }
-        record = tf.io.parse_single_example(proto, features)
-        image_raw = tf.io.decode_raw(record['image'], self.x_dtype)
-        image_raw = tf.reshape(image_raw, shape=self.x_shape)
 
-        label_raw = tf.one_hot(record["ground_truth"], 5, dtype=tf.int32)
-        label_raw = tf.cast(label_raw, self.y_dtype)
-        return image_raw, label_raw
+    def _decode(self, record, batch_shape):
+        image_raw = tf.io.decode_raw(record['image'], self.image_dtype)
+        image_raw = tf.cast(tf.reshape(image_raw, shape=batch_shape + list(self.x_shape)), self.x_dtype)
 
-    def set_vector_shape(self, x, y):
-        x.set_shape(self.x_shape)
-        y.set_shape(self.y_shape.append(5))
-        return x, y
+        label = record["ground_truth"]
+        if self.label_encoding == 'uint8':
+            label = tf.reshape(tf.io.decode_raw(label, tf.uint8), shape=batch_shape + list(self.y_shape))
+        return image_raw, label
+
+    def _one_hot(self, label):
+        return tf.cast(tf.one_hot(label, 5, dtype=tf.int32), self.y_dtype)
+
+    def _batch_seed(self, protos, index):
+        if self.seed is None:
+            return tf.random.uniform([2], maxval=2 ** 31 - 1, dtype=tf.int64)
+        if index is None:
+            # Batches parsed outside create_data_iterator are identified by their content
+            index = tf.reduce_sum(tf.strings.to_hash_bucket_fast(protos, 2 ** 31 - 1))
+        return tf.stack([tf.constant(self.seed, tf.int64), tf.cast(index, tf.int64)])
+
+    def augment(self, x, label, seed):
+        """Augment a batch with TensorFlow ops. The affine matrices and displacement
+        fields follow the distributions of pipeline.augmentations and are drawn with
+        stateless random ops from `seed`, so a batch is always augmented the same way
+        for a given seed. All images and labels of the batch are resampled at once:
+        bilinear for images, nearest for labels, points outside the slices being 0.
+
+        Parameters
+        ----------
+        x : tf.Tensor
+            Images of shape (batch_size, width, height, channels)
+        label : tf.Tensor
+            Integer labels of shape (batch_size, width, height)
+        seed : tf.Tensor
+            Seed of shape (2, ) of the random ops
+        """
+        shape = tf.shape(label)
+        rows, cols = tf.unstack(coordinates(self.augmentation, shape[0], shape[1:3], seed))
+        batch = tf.broadcast_to(tf.range(shape[0])[:, None, None], shape)
+
+        def gather(values, r, c):
+            inside = (r >= 0) & (r <= tf.cast(shape[1] - 1, r.dtype)) & (c >= 0) & (c <= tf.cast(shape[2] - 1, c.dtype))
+            r = tf.clip_by_value(tf.cast(r, tf.int32), 0, shape[1] - 1)
+            c = tf.clip_by_value(tf.cast(c, tf.int32), 0, shape[2] - 1)
+            gathered = tf.gather_nd(values, tf.stack([batch, r, c], axis=-1))
+            if values.shape.rank == 4:
+                inside = inside[..., None]
+            return tf.where(inside, gathered, tf.zeros_like(gathered))
+
+        r0, c0 = tf.floor(rows), tf.floor(cols)
+        dr, dc = (rows - r0)[..., None], (cols - c0)[..., None]
+        dr, dc = tf.cast(dr, x.dtype), tf.cast(dc, x.dtype)
+        x = (gather(x, r0, c0) * (1 - dr) * (1 - dc) + gather(x, r0, c0 + 1) * (1 - dr) * dc +
+             gather(x, r0 + 1, c0) * dr * (1 - dc) + gather(x, r0 + 1, c0 + 1) * dr * dc)
+        label = gather(label, tf.round(rows), tf.round(cols))
+        return x, label
 
     def normalize(self, x, y):
-        x, y = x.numpy(), y.numpy()
-        x = tf.keras.utils.normalize(x)
-        return tf.convert_to_tensor(x, dtype=self.x_dtype), y
+        """Normalize images with TensorFlow ops, per example and per channel.
+        'l2' divides by the L2 norm over channels as tf.keras.utils.normalize does,
+        'minmax' rescales to [0, 1] and 'zscore' to zero mean and unit variance.
+        
+        Parameters
+        ----------
+        x : tf.Tensor
+            Images of shape (..., width, height, channels)
+        y : tf.Tensor
+            Labels, returned unchanged
+        """
+        if self.normalization == 'l2':
+            norm = tf.norm(x, axis=-1, keepdims=True)
+            x = x / tf.where(norm == 0, tf.ones_like(norm), norm)
+        elif self.normalization == 'minmax':
+            x_min = tf.reduce_min(x, axis=[-3, -2], keepdims=True)
+            x_max = tf.reduce_max(x, axis=[-3, -2], keepdims=True)
+            x = tf.math.divide_no_nan(x - x_min, x_max - x_min)
+        elif self.normalization == 'zscore':
+            mean, variance = tf.nn.moments(x, axes=[-3, -2], keepdims=True)
+            x = tf.math.divide_no_nan(x - mean, tf.sqrt(variance))
+        return x, y
 
     def create_data_iterator(self, filenames_tensor, batch_size, repeat=False):
-        """Create a Dataset iterator from a list of tfrecord files
+        """Create a Dataset iterator from a list of tfrecord files.
+        Serialized examples are batched first and parsed together, and batches are
+        augmented in the parallel map when the recorder has an augmentation. Batches
+        are numbered across epochs, so every epoch sees new augmentations.
         
         Parameters
         ----------
@@ -91,12 +380,11 @@ class TrainingRecorder(AbstractRecorder):
             Whether to repeat the iteration over the dataset if the iterator runs out
             samples.
         """
-        dataset = tf.data.TFRecordDataset(filenames_tensor)
-        dataset = dataset.map(self.parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-        dataset = dataset.map(lambda x, y: tf.py_function(self.normalize, [x, y], [self.x_dtype, self.y_dtype]))
-        dataset = dataset.map(self.set_vector_shape)
+        dataset = tf.data.TFRecordDataset(filenames_tensor, compression_type=self.compression_type)
         dataset = dataset.batch(batch_size, drop_remainder=True)
         if repeat:
             dataset = dataset.repeat()
+        dataset = dataset.enumerate().map(lambda index, protos: self.parse_batch(protos, index),
+                                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
         dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-        return dataset
\ No newline at end of file
+        return dataset
@@ -1,7 +1,10 @@
-import os, random, shutil
+import os, json, random, shutil
 import numpy as np
 from glob import glob
 
+SPLIT_NAMES = ['training', 'validation', 'testing']
+SPLIT_FILE = 'split.json'
+
 
 def check_file(path : str, ext : str) -> str:
     """Ask the user to enter a file path.
@@ -74,7 +77,7 @@ def organize_dataset(data_path, split_names):
             splits = np.cumsum(perc)/100.
             splits = splits[:-1]
             splits *= len(l)
-            splits = splits.round().astype(np.int)
+            splits = splits.round().astype(int)
             return np.split(l, splits)
 
         for i in split_names:
@@ -99,4 +102,71 @@ def organize_dataset(data_path, split_names):
         
         print('Dataset reorganized with success.')
     
-    return
\ No newline at end of file
+    return
+
+def create_split(data_path : str, ratios : list = [0.9, 0., 0.1], seed : int = 0,
+                 strata : list = ['HGG', 'LGG']) -> dict:
+    """Assign the cases of the original BraTS layout to the training, validation and
+    testing splits without moving them. Cases of each stratum (glioma grade) are
+    shuffled with a seeded generator and split with the same ratios, so the split
+    only depends on the case names, the ratios and the seed.
+
+    Parameters
+    ----------
+    data_path : str
+        Path of the dataset, containing one folder per stratum
+    ratios : list
+        Fraction of the cases of each stratum in every split of SPLIT_NAMES.
+        Default to [0.9, 0., 0.1]
+    seed : int
+        Seed of the shuffling. Default to 0
+    strata : list
+        Folders of the strata. Default to ['HGG', 'LGG']
+
+    Return
+    ----------
+    split : dict
+        Settings of the split and case paths, relative to data_path, of every split
+    """
+    if len(ratios) != len(SPLIT_NAMES) or min(ratios) < 0 or sum(ratios) <= 0:
+        raise ValueError('ratios has to give a non negative fraction for each of {}'.format(SPLIT_NAMES))
+    bounds = np.cumsum(ratios) / np.sum(ratios)
+    splits = {name: [] for name in SPLIT_NAMES}
+    for stratum in strata:
+        cases = sorted(os.path.relpath(case, data_path) for case in glob(os.path.join(data_path, stratum, '*'))
+                       if os.path.isdir(case))
+        random.Random('{}-{}'.format(seed, stratum)).shuffle(cases)
+        stops = (bounds * len(cases)).round().astype(int)
+        for name, start, stop in zip(SPLIT_NAMES, np.concatenate([[0], stops[:-1]]), stops):
+            splits[name] += sorted(cases[start:stop])
+    return {'seed': seed, 'ratios': list(ratios), 'strata': list(strata), 'splits': splits}
+
+def save_split(split : dict, path : str):
+    """Write a split created by create_split
+
+    Parameters
+    ----------
+    split : dict
+        Split
+    path : str
+        Path of the split file
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(split, f, indent=2)
+    os.replace(tmp, path)
+
+def load_split(path : str) -> dict:
+    """Read a split written by save_split
+
+    Parameters
+    ----------
+    path : str
+        Path of the split file
+
+    Return
+    ----------
+    split : dict
+    """
+    with open(path, 'r') as f:
+        return json.load(f)